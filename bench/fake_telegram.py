@@ -0,0 +1,234 @@
+"""
+Local stand-in for api.telegram.org, enough of it for HttpBot.
+
+Serves /bot<token>/<method> and /file/bot<token>/<path>, and generates
+inbound traffic (messages, media, edits, reactions) across a set of fake
+private chats at a fixed rate. Every generated text carries the wall-clock
+time it was produced, so a client can measure update-to-websocket latency.
+Sends beyond flood_limit per second are refused with 429 and retry_after,
+like the real flood control.
+
+Run on its own for manual testing:
+
+    python bench/fake_telegram.py --port 8081 --chats 50 --rate 20
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import time
+
+from aiohttp import web
+
+media_kinds = ("photo", "document", "voice", "video", "sticker")
+
+
+class FakeTelegram:
+    def __init__(self, chats=100, rate=10.0, media_ratio=0.1, edit_ratio=0.05,
+                 reaction_ratio=0.05, media_bytes=64 * 1024, skew=1.2, seed=1, flood_limit=30):
+        self.chats = [7_000_000 + i for i in range(chats)]
+        self.rate = rate
+        self.media_ratio = media_ratio
+        self.edit_ratio = edit_ratio
+        self.reaction_ratio = reaction_ratio
+        self.media_body = os.urandom(media_bytes)
+        self.rand = random.Random(seed)
+        # a few chats are far busier than the rest, like real inboxes
+        self.weights = [1 / (i + 1) ** skew for i in range(chats)]
+        self.flood_limit = flood_limit
+        self._send_times: list[float] = []
+
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._msg_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._sent_by_chat: dict[int, list[int]] = {}
+        self._new_updates = asyncio.Event()
+        self._generator: asyncio.Task | None = None
+
+        self.generated = 0
+        self.calls: dict[str, int] = {}
+
+    # traffic
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id % 100000}",
+                "username": f"user{chat_id}"}
+
+    def _push(self, kind: str, payload: dict):
+        self._updates.append({"update_id": next(self._update_ids), kind: payload})
+        self._new_updates.set()
+
+    def emit_one(self):
+        chat_id = self.rand.choices(self.chats, self.weights)[0]
+        user = self._user(chat_id)
+        chat = {**user, "type": "private"}
+        del chat["is_bot"]
+        now = time.time()
+        sent = self._sent_by_chat.setdefault(chat_id, [])
+        roll = self.rand.random()
+
+        if sent and roll < self.edit_ratio:
+            self._push("edited_message", {
+                "message_id": self.rand.choice(sent), "from": user, "chat": chat,
+                "date": int(now), "edit_date": int(now), "text": f"edited t={now:.6f}",
+            })
+        elif sent and roll < self.edit_ratio + self.reaction_ratio:
+            self._push("message_reaction", {
+                "chat": chat, "message_id": self.rand.choice(sent), "user": user, "date": int(now),
+                "old_reaction": [], "new_reaction": [{"type": "emoji", "emoji": "👍"}],
+            })
+        else:
+            mid = next(self._msg_ids)
+            sent.append(mid)
+            msg = {"message_id": mid, "from": user, "chat": chat, "date": int(now)}
+            if self.rand.random() < self.media_ratio:
+                kind = self.rand.choice(media_kinds)
+                fid = f"f{next(self._file_ids)}"
+                if kind == "photo":
+                    msg["photo"] = [{"file_id": fid, "width": 320, "height": 240}]
+                elif kind == "document":
+                    msg["document"] = {"file_id": fid, "file_name": f"doc{mid}.bin",
+                                       "mime_type": "application/octet-stream"}
+                else:
+                    msg[kind] = {"file_id": fid}
+                msg["caption"] = f"bench t={now:.6f}"
+            else:
+                msg["text"] = f"bench t={now:.6f}"
+            self._push("message", msg)
+        self.generated += 1
+
+    async def _generate(self, duration: float | None):
+        start = time.monotonic()
+        n = 0
+        while duration is None or time.monotonic() - start < duration:
+            self.emit_one()
+            n += 1
+            # schedule against the start time so slow iterations don't lower the rate
+            delay = start + n / self.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif n % 100 == 0:
+                await asyncio.sleep(0)
+
+    def start_traffic(self, duration: float | None = None):
+        self._generator = asyncio.create_task(self._generate(duration))
+        return self._generator
+
+    async def stop_traffic(self):
+        if self._generator:
+            self._generator.cancel()
+            try:
+                await self._generator
+            except asyncio.CancelledError:
+                pass
+
+    # bot api
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        deadline = time.monotonic() + timeout
+        while True:
+            # acknowledged updates are forgotten, as Telegram does
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if self._updates or time.monotonic() >= deadline:
+                return self._updates[:100]
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    def _sent(self, chat_id, method: str = "sendMessage") -> dict:
+        sent = {"message_id": next(self._msg_ids), "chat": {"id": int(chat_id), "type": "private"},
+                "date": int(time.time())}
+        kind = method.removeprefix("send").lower()
+        if kind != "message":
+            media = {"file_id": f"sent{next(self._file_ids)}"}
+            sent[kind] = [media] if kind == "photo" else media
+        return sent
+
+    def _flooded(self) -> bool:
+        """More than flood_limit sends in the last second."""
+        now = time.monotonic()
+        self._send_times = [t for t in self._send_times if now - t < 1]
+        if len(self._send_times) >= self.flood_limit:
+            return True
+        self._send_times.append(now)
+        return False
+
+    async def handle_method(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "multipart/form-data":
+            form = await request.post()
+            params = {k: v for k, v in form.items() if isinstance(v, str)}
+        elif request.can_read_body:
+            params = await request.json()
+        else:
+            params = {}
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in ("sendMessage", "sendPhoto", "sendVideo", "sendAudio", "sendDocument"):
+            if self.flood_limit and self._flooded():
+                self.calls["flooded"] = self.calls.get("flooded", 0) + 1
+                return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                          "parameters": {"retry_after": 1}}, status=429)
+            result = self._sent(params.get("chat_id", 0), method)
+        elif method == "getFile":
+            result = {"file_id": params.get("file_id"), "file_path": f"files/{params.get('file_id')}"}
+        elif method == "getChat":
+            result = {"id": int(params.get("chat_id", 0)), "type": "private"}
+        elif method == "getUserProfilePhotos":
+            result = {"total_count": 0, "photos": []}
+        elif method == "getChatMemberCount":
+            result = 2
+        elif method == "getChatAdministrators":
+            result = []
+        elif method in ("editMessageText", "setMessageReaction", "deleteMessage", "banChatMember",
+                        "unbanChatMember", "pinChatMessage", "unpinChatMessage", "leaveChat"):
+            result = True
+        else:
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request):
+        return web.Response(body=self.media_body, content_type="application/octet-stream")
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+
+async def serve(fake: FakeTelegram, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(fake.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def _main(args):
+    fake = FakeTelegram(chats=args.chats, rate=args.rate)
+    await serve(fake, "127.0.0.1", args.port)
+    print(f"[+] fake bot api on http://127.0.0.1:{args.port}, {args.rate}/s over {args.chats} chats")
+    fake.start_traffic()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--rate", type=float, default=20)
+    try:
+        asyncio.run(_main(p.parse_args()))
+    except KeyboardInterrupt:
+        pass
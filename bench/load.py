@@ -0,0 +1,240 @@
+"""
+End-to-end load test. Starts the fake Bot API (bench/fake_telegram.py),
+runs `python bot.py` against it with a throwaway data dir, points a fleet of
+websocket and REST clients at the web server, and prints a JSON report:
+
+  ingest      messages generated vs delivered over websocket, per second
+  e2e         update generated -> websocket frame received (ms percentiles)
+  api         per-endpoint REST latency (ms percentiles) and error counts
+  memory      server RSS (current and peak, kB, Linux only)
+
+    python bench/load.py --chats 200 --rate 100 --duration 30 --ws-clients 20 --rest-clients 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from fake_telegram import FakeTelegram, serve  # noqa: E402
+
+root = Path(__file__).resolve().parent.parent
+_stamp = re.compile(r"t=(\d+\.\d+)")
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    v = sorted(values)
+
+    def pick(q):
+        return round(v[min(len(v) - 1, int(q * len(v)))], 2)
+    return {"count": len(v), "p50": pick(.5), "p90": pick(.9), "p99": pick(.99), "max": round(v[-1], 2)}
+
+
+def rss_kb(pid: int) -> dict:
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return {}
+    out = {}
+    for line in status.splitlines():
+        key, _, rest = line.partition(":")
+        if key in ("VmRSS", "VmHWM"):
+            out[key] = int(rest.split()[0])
+    return out
+
+
+class Stats:
+    def __init__(self):
+        self.e2e_ms: list[float] = []
+        self.delivered: set = set()
+        self.api_ms: dict[str, list[float]] = {}
+        self.api_errors: dict[str, int] = {}
+        self.ws_drops = 0
+
+
+async def ws_client(url: str, stats: Stats, stop: asyncio.Event, primary: bool):
+    async with aiohttp.ClientSession() as s:
+        while not stop.is_set():
+            try:
+                async with s.ws_connect(url, heartbeat=30) as ws:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        now = time.time()
+                        data = json.loads(msg.data)
+                        events = data["events"] if data.get("type") == "batch" else [data]
+                        for e in events:
+                            if e.get("type") != "new_message":
+                                continue
+                            m = _stamp.search(e["message"].get("text") or "")
+                            if m:
+                                stats.e2e_ms.append((now - float(m.group(1))) * 1000)
+                            if primary:
+                                stats.delivered.add((e["user_id"], e["message"]["msg_id"]))
+                        if stop.is_set():
+                            return
+            except aiohttp.ClientError:
+                pass
+            if not stop.is_set():
+                stats.ws_drops += 1
+                await asyncio.sleep(0.5)
+
+
+async def rest_client(base: str, chats: list, stats: Stats, stop: asyncio.Event, rand: random.Random):
+    endpoints = [
+        ("users", lambda: "/api/users"),
+        ("messages", lambda: f"/api/messages/{rand.choice(chats)}"),
+        ("changes", lambda: "/api/changes?since=0&limit=100"),
+    ]
+    async with aiohttp.ClientSession() as s:
+        while not stop.is_set():
+            name, path = rand.choice(endpoints)
+            start = time.perf_counter()
+            try:
+                async with s.get(base + path()) as r:
+                    await r.read()
+                    ok = r.status < 400
+            except aiohttp.ClientError:
+                ok = False
+            stats.api_ms.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+            if not ok:
+                stats.api_errors[name] = stats.api_errors.get(name, 0) + 1
+            await asyncio.sleep(rand.uniform(0, 0.05))
+
+
+async def wait_ready(base: str, proc: subprocess.Popen, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as s:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"bot.py exited with {proc.returncode}")
+            try:
+                async with s.get(base + "/api/bot-info") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("server did not come up")
+
+
+async def run(args) -> dict:
+    fake = FakeTelegram(chats=args.chats, rate=args.rate, media_ratio=args.media,
+                        edit_ratio=args.edits, reaction_ratio=args.reactions,
+                        media_bytes=args.media_kb * 1024, seed=args.seed)
+    fake_runner = await serve(fake, "127.0.0.1", args.api_port)
+
+    data_dir = tempfile.mkdtemp(prefix="telechat-bench-")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": "bench",
+        "CREATE_USER_BOT": "False",
+        "TELEGRAM_API_BASE": f"http://127.0.0.1:{args.api_port}",
+        "TELECHAT_DATA_DIR": data_dir,
+        "WEB_HOST": "127.0.0.1",
+        "WEB_PORT": str(args.port),
+        "WEB_WORKERS": str(args.workers),
+        "allowed_users": ",".join(str(c) for c in fake.chats),
+    }
+    log = open(Path(data_dir) / "server.log", "w")
+    proc = subprocess.Popen([sys.executable, str(root / "bot.py")], env=env, cwd=root,
+                            stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{args.port}"
+    stats = Stats()
+    stop = asyncio.Event()
+    rand = random.Random(args.seed)
+    peak = {}
+    try:
+        await wait_ready(base, proc)
+        ws_url = base.replace("http", "ws", 1) + "/ws"
+        tasks = [asyncio.create_task(ws_client(ws_url, stats, stop, i == 0)) for i in range(args.ws_clients)]
+        tasks += [asyncio.create_task(rest_client(base, fake.chats, stats, stop, rand))
+                  for _ in range(args.rest_clients)]
+        await asyncio.sleep(1)  # let the websockets connect
+
+        start = time.monotonic()
+        traffic = fake.start_traffic(args.duration)
+        while not traffic.done():
+            await asyncio.sleep(1)
+            peak = rss_kb(proc.pid) or peak
+        generated_new = sum(len(v) for v in fake._sent_by_chat.values())
+        # give the pipeline a moment to drain before counting deliveries
+        drain_until = time.monotonic() + args.drain
+        while time.monotonic() < drain_until and len(stats.delivered) < generated_new:
+            await asyncio.sleep(0.2)
+        elapsed = time.monotonic() - start
+        memory = rss_kb(proc.pid) or peak
+
+        stop.set()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        await fake.stop_traffic()
+        await fake_runner.cleanup()
+
+    return {
+        "config": vars(args),
+        "data_dir": data_dir,
+        "ingest": {
+            "updates_generated": fake.generated,
+            "messages_generated": generated_new,
+            "messages_delivered": len(stats.delivered),
+            "delivered_per_sec": round(len(stats.delivered) / elapsed, 1),
+        },
+        "e2e_ms": percentiles(stats.e2e_ms),
+        "api_ms": {name: percentiles(v) for name, v in sorted(stats.api_ms.items())},
+        "api_errors": stats.api_errors,
+        "ws_reconnects": stats.ws_drops,
+        "bot_api_calls": fake.calls,
+        "memory_kb": memory,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--rate", type=float, default=50, help="inbound updates per second")
+    p.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    p.add_argument("--drain", type=float, default=10, help="max seconds to wait for delivery afterwards")
+    p.add_argument("--media", type=float, default=0.1, help="share of messages carrying media")
+    p.add_argument("--media-kb", type=int, default=64)
+    p.add_argument("--edits", type=float, default=0.05, help="share of updates that are edits")
+    p.add_argument("--reactions", type=float, default=0.05, help="share of updates that are reactions")
+    p.add_argument("--ws-clients", type=int, default=10)
+    p.add_argument("--rest-clients", type=int, default=4)
+    p.add_argument("--workers", type=int, default=0, help="WEB_WORKERS for the server under test")
+    p.add_argument("--port", type=int, default=18080)
+    p.add_argument("--api-port", type=int, default=18081)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="also write the report to this file")
+    args = p.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Storage micro-benchmarks at realistic scale.
+
+For each requested size a fresh database is filled with messages spread
+over chats with a skewed (zipf-like) size distribution, then the hot
+Storage methods are timed against it. A separate database with --users
+chats is used for load_users. Results go to stdout as JSON (and --out),
+tagged with the git commit, so runs can be diffed between commits.
+
+    python bench/storage_bench.py --sizes 10k,100k,1m --out storage-$(git rev-parse --short HEAD).json
+
+Databases are built in a temp dir and removed afterwards unless --keep.
+10m takes a while and a few GB of disk.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+_work = Path(tempfile.mkdtemp(prefix="telechat-storage-bench-"))
+# config creates its dirs on import, keep them out of the real data/
+os.environ.setdefault("TELECHAT_DATA_DIR", str(_work / "data"))
+sys.path.insert(0, str(root))
+
+import src.storage as storage_mod  # noqa: E402
+from src.storage import Storage  # noqa: E402
+
+_units = {"k": 1_000, "m": 1_000_000}
+
+
+def parse_size(s: str) -> int:
+    s = s.strip().lower()
+    return int(float(s[:-1]) * _units[s[-1]]) if s[-1] in _units else int(s)
+
+
+def summarize(samples: list, ops: int | None = None) -> dict:
+    v = sorted(samples)
+    total = sum(v)
+    pick = lambda q: round(v[min(len(v) - 1, int(q * len(v)))] * 1000, 3)  # noqa: E731
+    return {
+        "n": len(v),
+        "ops_per_sec": round((ops or len(v)) / total, 1) if total else None,
+        "p50_ms": pick(.5), "p99_ms": pick(.99), "max_ms": round(v[-1] * 1000, 3),
+    }
+
+
+async def timed(n: int, fn) -> list:
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _payload(msg_id: int, ts: str, rand: random.Random) -> dict:
+    media = rand.random() < 0.1
+    return {
+        "msg_id": msg_id,
+        "direction": "in" if rand.random() < 0.6 else "out",
+        "text": "lorem ipsum dolor sit amet " * rand.randint(1, 6),
+        "timestamp": ts,
+        "media_type": "photo" if media else None,
+        "media_file": f"{msg_id}.jpg" if media else None,
+        "reply_to": None,
+        "forwarded_from": None,
+        "forwarded_from_username": None,
+        "source": "bot",
+        "sender_id": None,
+        "sender_name": None,
+    }
+
+
+def build_db(path: Path, messages: int, chats: int, skew: float, rand: random.Random) -> dict:
+    """Fill the schema Storage.init() created. Returns {chat_id: [msg_ids]} for sampling."""
+    weights = [1 / (i + 1) ** skew for i in range(chats)]
+    chat_ids = [str(5_000_000 + i) for i in range(chats)]
+    counts = [0] * chats
+    for i in rand.choices(range(chats), weights, k=messages):
+        counts[i] += 1
+
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA synchronous=OFF")
+    now = datetime.now().isoformat()
+    db.execute("BEGIN")
+    db.executemany(
+        "INSERT INTO users (user_id, first_name, last_name, username, full_name, type, folder_name, "
+        "unread_count, last_seen, last_interaction) VALUES (?, ?, '', ?, ?, 'private', ?, 0, ?, ?)",
+        [(c, f"User{c}", f"user{c}", f"User{c}", c, now, now) for c in chat_ids])
+    db.execute("COMMIT")
+
+    ids = {}
+    start = datetime(2023, 1, 1)
+    msg_id = 1
+    batch = []
+    for c, n in zip(chat_ids, counts):
+        ids[c] = list(range(msg_id, msg_id + n))
+        for k in range(n):
+            ts = (start + timedelta(seconds=k * 37)).isoformat()
+            p = _payload(msg_id, ts, rand)
+            batch.append((msg_id, c, p["direction"], ts, json.dumps(p)))
+            msg_id += 1
+            if len(batch) >= 50_000:
+                db.execute("BEGIN")
+                db.executemany("INSERT INTO messages (msg_id, chat_id, direction, timestamp, payload) "
+                               "VALUES (?, ?, ?, ?, ?)", batch)
+                db.execute("COMMIT")
+                batch.clear()
+    if batch:
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO messages (msg_id, chat_id, direction, timestamp, payload) "
+                       "VALUES (?, ?, ?, ?, ?)", batch)
+        db.execute("COMMIT")
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.close()
+    return ids
+
+
+def disk_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.parent.glob(path.name + "*"))
+
+
+async def bench_size(messages: int, args, rand: random.Random) -> dict:
+    path = _work / f"messages-{messages}.db"
+    storage_mod.db_path = path
+    st = Storage()
+    await st.init()
+
+    chats = max(10, messages // args.msgs_per_chat)
+    t = time.perf_counter()
+    ids = build_db(path, messages, chats, args.skew, rand)
+    build_s = time.perf_counter() - t
+    await st.load_users()
+
+    by_size = sorted(ids, key=lambda c: len(ids[c]), reverse=True)
+    biggest = by_size[0]
+    weights = [len(ids[c]) for c in by_size]
+    next_id = messages + 1
+    n = args.ops
+    out = {"messages": messages, "chats": chats, "largest_chat": len(ids[biggest]), "build_s": round(build_s, 1)}
+
+    async def save(i):
+        nonlocal next_id
+        c = rand.choices(by_size, weights)[0]
+        await st.save_message(c, _payload(next_id, datetime.now().isoformat(), rand))
+        ids[c].append(next_id)
+        next_id += 1
+    out["save_message"] = summarize(await timed(n, save))
+
+    out["get_messages_shallow"] = summarize(await timed(
+        n, lambda i: st.get_messages(rand.choices(by_size, weights)[0], offset=0, limit=30)))
+    deep = int(len(ids[biggest]) * 0.9)
+    out["get_messages_deep"] = {"offset": deep, **summarize(await timed(
+        n, lambda i: st.get_messages(biggest, offset=deep, limit=30)))}
+
+    def random_msg():
+        c = rand.choices(by_size, weights)[0]
+        return c, rand.choice(ids[c])
+    out["get_message_by_id"] = summarize(await timed(n, lambda i: st.get_message_by_id(*random_msg())))
+
+    out["add_reaction"] = summarize(await timed(n, lambda i: st.add_reaction(*random_msg(), "👍", "bench")))
+    out["edit_message"] = summarize(await timed(
+        n, lambda i: st.edit_message(*random_msg(), f"edited {i}")))
+
+    batch = args.delete_batch
+
+    async def delete(i):
+        c = by_size[i % min(len(by_size), 20)]
+        victims, ids[c] = ids[c][:batch], ids[c][batch:]
+        if victims:
+            await st.delete_messages(c, victims)
+    samples = await timed(max(1, n // 10), delete)
+    out["delete_messages"] = {"batch": batch, **summarize(samples, ops=len(samples) * batch)}
+
+    raw = sqlite3.connect(path)
+    raw.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    raw.close()
+    out["disk_bytes"] = disk_size(path)
+    out["bytes_per_message"] = round(out["disk_bytes"] / messages, 1)
+    return out
+
+
+async def bench_load_users(users: int) -> dict:
+    path = _work / f"users-{users}.db"
+    storage_mod.db_path = path
+    st = Storage()
+    await st.init()
+    now = datetime.now().isoformat()
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("BEGIN")
+    db.executemany(
+        "INSERT INTO users (user_id, first_name, last_name, username, full_name, type, folder_name, "
+        "unread_count, last_seen, last_interaction) VALUES (?, ?, '', ?, ?, 'private', ?, 0, ?, ?)",
+        [(str(u), f"User{u}", f"user{u}", f"User{u}", str(u), now, now) for u in range(1, users + 1)])
+    db.execute("COMMIT")
+    db.close()
+    samples = await timed(3, lambda i: st.load_users())
+    return {"users": users, **summarize(samples)}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    rand = random.Random(args.seed)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": vars(args),
+        "sizes": [],
+    }
+    for size in [parse_size(s) for s in args.sizes.split(",")]:
+        print(f"[bench] {size} messages", file=sys.stderr)
+        report["sizes"].append(await bench_size(size, args, rand))
+    if args.users:
+        print(f"[bench] load_users with {args.users} users", file=sys.stderr)
+        report["load_users"] = await bench_load_users(args.users)
+    return report
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--sizes", default="10k,100k", help="comma separated message counts: 10k,100k,1m,10m")
+    p.add_argument("--users", type=int, default=100_000, help="chats for the load_users run (0 = skip)")
+    p.add_argument("--ops", type=int, default=500, help="operations timed per method")
+    p.add_argument("--msgs-per-chat", type=int, default=200, help="average chat size; sets the chat count")
+    p.add_argument("--skew", type=float, default=1.1, help="zipf exponent for chat sizes")
+    p.add_argument("--delete-batch", type=int, default=50)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="also write the report to this file")
+    p.add_argument("--keep", action="store_true", help="keep the generated databases")
+    args = p.parse_args()
+    try:
+        report = asyncio.run(main(args))
+    finally:
+        if args.keep:
+            print(f"[bench] databases kept in {_work}", file=sys.stderr)
+        else:
+            shutil.rmtree(_work, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text)
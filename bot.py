@@ -6,53 +6,101 @@ import sys
 
 from aiohttp import web
 
-from src.config import web_host, web_port, bot_token, phone_number, create_user_bot
+from src.config import (web_host, web_port, bot_token, phone_number, create_user_bot,
+                        web_workers, is_web_worker, worker_index, bus_socket, primary_socket)
 from src.clients import userbot, bot, is_http_bot
+from src.acl import acl
+from src import fileio
 from src.handlers import setup_handlers
+from src.inbox import inbox
+from src.outbox import outbox
+from src.broadcast import broadcasts
+from src.archive import archive
+from src.retention import retention
+from src.shards import shards
+from src.snapshots import snapshots
+from src import log as logs
 from src.storage import storage
 from src.server import create_app
+from src import workers
+from src.bus import BusServer, BusClient
+from src.ws_hub import forwarders
+
+log = logs.get_logger("main")
 
 
 async def main():
+    logs.setup()
+    try:
+        if is_web_worker:
+            await worker_main()
+        else:
+            await primary_main()
+    finally:
+        logs.stop()
+
+
+async def primary_main():
+
     await storage.init()
     await storage.load_users()
-    print("[+] storage loaded")
+    await acl.init()
+    await outbox.init()
+    await broadcasts.init()
+    await retention.init()
+    await fileio.deletions.sweep()
+    log.info("storage loaded")
 
     setup_handlers()
 
     # start clients
     if is_http_bot:
-        print("[...] connecting bot (http mode)")
+        log.info("connecting bot (http mode)")
         bot_me = await bot.start()
-        print(f"[+] bot connected as @{bot_me.username}")
+        log.info("bot connected as @%s", bot_me.username)
     else:
         if create_user_bot and userbot is not None:
-            print("[...] connecting userbot")
+            log.info("connecting userbot")
             await userbot.start(phone=phone_number)
             me = await userbot.get_me()
-            print(f"[+] userbot connected as {me.first_name} (@{me.username})")
+            log.info("userbot connected as %s (@%s)", me.first_name, me.username)
 
-        print("[...] connecting bot (telethon)")
+        log.info("connecting bot (telethon)")
         await bot.start(bot_token=bot_token)
         bot_me = await bot.get_me()
-        print(f"[+] bot connected as @{bot_me.username}")
+        log.info("bot connected as @%s", bot_me.username)
 
     # start web server
+    use_workers = web_workers > 0 and workers.supported()
+    if web_workers > 0 and not use_workers:
+        log.warning("WEB_WORKERS needs unix sockets and SO_REUSEPORT, running single-process")
+
     app = create_app()
     runner = web.AppRunner(app)
     await runner.setup()
 
-    try:
-        site = web.TCPSite(runner, web_host, web_port)
-        await site.start()
-    except OSError as exc:
-        if "address already in use" in str(exc).lower() or "10048" in str(exc):
-            print(f"\n[x] port {web_port} is already in use!")
-            print(f"    kill the other process or change WEB_PORT in .env")
-            print(f"    to find it: netstat -ano | findstr :{web_port}")
-            await _cleanup(runner)
-            return
-        raise
+    bus = pool = None
+    if use_workers:
+        # workers own the public port; this process serves them over a unix socket
+        bus = BusServer(bus_socket)
+        await bus.start()
+        forwarders.append(bus.publish)
+        primary_socket.unlink(missing_ok=True)
+        await web.UnixSite(runner, str(primary_socket)).start()
+        pool = workers.WorkerPool(web_workers)
+        await pool.start()
+    else:
+        try:
+            site = web.TCPSite(runner, web_host, web_port)
+            await site.start()
+        except OSError as exc:
+            if "address already in use" in str(exc).lower() or "10048" in str(exc):
+                print(f"\n[x] port {web_port} is already in use!")
+                print(f"    kill the other process or change WEB_PORT in .env")
+                print(f"    to find it: netstat -ano | findstr :{web_port}")
+                await _cleanup(runner)
+                return
+            raise
 
     mode = "bot-only (http)" if is_http_bot else (
         "userbot + bot (telethon)" if create_user_bot else "bot-only (telethon)")
@@ -63,18 +111,85 @@ async def main():
     print(f"   {bot_name} is live!")
     print(f"   chat ui  ->  http://{web_host}:{web_port}")
     print(f"   mode     ->  {mode}")
+    if use_workers:
+        print(f"   workers  ->  {web_workers} web processes")
     print("   press ctrl+c to stop")
     print("=" * 52)
     print()
 
-    poll_task = None
+    # sends from the web ui are queued; this delivers them (and any left from last run)
+    queued = await outbox.pending()
+    if queued:
+        log.info("resuming %d queued sends", queued)
+    send_task = asyncio.create_task(outbox.run())
+    broadcast_task = asyncio.create_task(broadcasts.run())
+    # old history moves to the compressed archive in the background
+    archive_task = asyncio.create_task(archive.run(storage.archive_old))
+    # retention rules, then free pages handed back to the filesystem
+    retention_task = asyncio.create_task(retention.run())
+    snapshot_task = asyncio.create_task(snapshots.run())
+    # chats still in the single-file layout move to their shards in the background
+    shard_task = asyncio.create_task(shards.run())
+
+    poll_task = consume_task = None
     if is_http_bot:
-        poll_task = asyncio.create_task(bot.start_polling())
+        # updates land in the durable inbox first; consumers handle them from there
+        await inbox.init()
+        offset = await inbox.load_offset()
+        backlog = await inbox.pending()
+        if backlog:
+            log.info("resuming %d queued updates", backlog)
+        consume_task = asyncio.create_task(inbox.run(bot.process_update))
+        poll_task = asyncio.create_task(bot.start_polling(offset=offset, sink=inbox.append))
+
+    try:
+        await _wait_for_stop()
+    finally:
+        for task in (poll_task, consume_task, send_task, broadcast_task, archive_task,
+                     retention_task, snapshot_task, shard_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if pool:
+            await pool.stop()
+        if bus:
+            await bus.stop()
+        await fileio.deletions.stop()
+        await shards.close()
+        await _cleanup(runner)
+        log.info("stopped")
 
+
+async def worker_main():
+    """A web worker: reads and websockets locally, everything else via the primary."""
+    await storage.init()
+    await storage.load_users()
+
+    sync = workers.WorkerSync()
+    sync.last_seq = await storage.last_change_seq()
+    bus_task = asyncio.create_task(BusClient(bus_socket, sync.on_event).run(sync.catch_up))
+
+    runner = web.AppRunner(create_app(primary_socket=primary_socket))
+    await runner.setup()
+    await web.TCPSite(runner, web_host, web_port, reuse_port=True).start()
+    log.info("web worker %s serving http://%s:%s", worker_index, web_host, web_port)
+
+    try:
+        await _wait_for_stop(quiet=True)
+    finally:
+        bus_task.cancel()
+        await runner.cleanup()
+
+
+async def _wait_for_stop(quiet=False):
     stop = asyncio.Event()
 
     def _signal_handler():
-        print("\n[...] shutting down")
+        if not quiet:
+            log.info("shutting down")
         stop.set()
 
     loop = asyncio.get_running_loop()
@@ -87,16 +202,8 @@ async def main():
     try:
         await stop.wait()
     except KeyboardInterrupt:
-        print("\n[...] shutting down")
-    finally:
-        if poll_task:
-            poll_task.cancel()
-            try:
-                await poll_task
-            except asyncio.CancelledError:
-                pass
-        await _cleanup(runner)
-        print("[+] stopped.")
+        if not quiet:
+            log.info("shutting down")
 
 
 async def _cleanup(runner):
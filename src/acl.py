@@ -0,0 +1,133 @@
+"""
+Access control: who may message the bot (allowed) and who is blocked
+(banned). The lists live in an indexed acl table and are mirrored into
+in-memory sets, so the per-message checks are O(1). ALLOWED_USERS /
+BANNED_USERS in .env seed the table: whenever their value differs from
+what was imported last time, the listed ids are added and ids dropped
+from the variable since then are removed. Otherwise the table is the
+source of truth and .env is never written.
+"""
+
+import aiosqlite
+
+from src.config import allowed_users as _env_allowed, banned_users as _env_banned
+from src.storage import db_path
+from src.ws_hub import forwarders
+
+lists = ("allowed", "banned")
+
+
+class Acl:
+    def __init__(self):
+        self._sets: dict[str, set[int]] = {name: set() for name in lists}
+
+    @property
+    def allowed(self) -> set[int]:
+        return self._sets["allowed"]
+
+    @property
+    def banned(self) -> set[int]:
+        return self._sets["banned"]
+
+    def is_allowed(self, user_id) -> bool:
+        return int(user_id) in self._sets["allowed"]
+
+    def is_banned(self, user_id) -> bool:
+        return int(user_id) in self._sets["banned"]
+
+    async def init(self, seed=True):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS acl (
+                    list TEXT,
+                    user_id INTEGER,
+                    PRIMARY KEY (list, user_id)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            if seed:
+                for name, ids in (("allowed", _env_allowed), ("banned", _env_banned)):
+                    env_value = ",".join(str(i) for i in ids)
+                    async with db.execute("SELECT value FROM state WHERE key = ?", (f"acl_env_{name}",)) as cursor:
+                        row = await cursor.fetchone()
+                    if row and row[0] == env_value:
+                        continue
+                    # taking an id out of .env still revokes (or unbans) it
+                    dropped = {int(i) for i in row[0].split(",") if i} - set(ids) if row else set()
+                    await db.executemany("DELETE FROM acl WHERE list = ? AND user_id = ?",
+                                         [(name, i) for i in dropped])
+                    await db.executemany("INSERT OR IGNORE INTO acl (list, user_id) VALUES (?, ?)",
+                                         [(name, i) for i in ids])
+                    await db.execute(
+                        "INSERT INTO state (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        (f"acl_env_{name}", env_value))
+            await db.commit()
+        await self.reload()
+
+    async def reload(self, notify=False):
+        """Re-read both lists from the table (after an external edit, or on a web worker).
+
+        With notify, web workers are told to reload too.
+        """
+        fresh = {name: set() for name in lists}
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT list, user_id FROM acl") as cursor:
+                async for name, uid in cursor:
+                    if name in fresh:
+                        fresh[name].add(uid)
+        self._sets = fresh
+        if notify:
+            _broadcast({"type": "acl_reload"})
+
+    async def set(self, name: str, user_id, on: bool):
+        """Add or remove one id."""
+        uid = int(user_id)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            if on:
+                await db.execute("INSERT OR IGNORE INTO acl (list, user_id) VALUES (?, ?)", (name, uid))
+            else:
+                await db.execute("DELETE FROM acl WHERE list = ? AND user_id = ?", (name, uid))
+            await db.commit()
+        if on:
+            self._sets[name].add(uid)
+        else:
+            self._sets[name].discard(uid)
+        _broadcast({"type": "acl_update", "list": name, "user_id": uid, "on": on})
+
+    async def bulk(self, name: str, ids: list, mode: str = "add") -> int:
+        """Apply a whole list in one transaction. mode is add, remove or replace. Returns the new size."""
+        ids = {int(i) for i in ids}
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            if mode == "replace":
+                await db.execute("DELETE FROM acl WHERE list = ?", (name,))
+            if mode == "remove":
+                await db.executemany("DELETE FROM acl WHERE list = ? AND user_id = ?", [(name, i) for i in ids])
+            else:
+                await db.executemany("INSERT OR IGNORE INTO acl (list, user_id) VALUES (?, ?)",
+                                     [(name, i) for i in ids])
+            await db.commit()
+        await self.reload(notify=True)
+        return len(self._sets[name])
+
+    def export(self, name: str) -> list[int]:
+        return sorted(self._sets[name])
+
+    async def apply_remote(self, event: dict):
+        """Web workers: mirror a change the primary made."""
+        if event["type"] == "acl_update":
+            if event["on"]:
+                self._sets[event["list"]].add(event["user_id"])
+            else:
+                self._sets[event["list"]].discard(event["user_id"])
+        else:
+            await self.reload()
+
+
+def _broadcast(event: dict):
+    """Tell web workers over the bus; browsers don't need these."""
+    for forward in forwarders:
+        forward(event)
+
+
+acl = Acl()
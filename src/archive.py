@@ -0,0 +1,341 @@
+"""
+Cold tier for old history. Messages older than archive_after_days move out
+of the hot messages table into data/archive.db as one zlib-compressed JSON
+segment per chat and month, plus a small (chat_id, msg_id) -> month index.
+Storage falls through to the archive when a read reaches past the hot rows
+(paging, windows, lookups by id, whole-chat reads), so clients never see
+the difference, and the hot database keeps only recent history.
+
+Each process keeps the newest archived key and message count per chat in
+memory, so reads of chats with nothing archived (or pages that stay above
+the archived range) never open archive.db. Decompressed segments are
+cached by revision, which also keeps web workers' caches honest.
+"""
+
+import asyncio
+import json
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+from src import fileio
+from src.config import data_dir, archive_after_days, archive_interval_hours, archive_cache_segments
+from src.log import get_logger
+from src.ws_hub import forwarders
+
+log = get_logger("archive")
+
+archive_path = data_dir / "archive.db"
+
+
+def key(msg: dict) -> tuple:
+    """Sort key of a message in history order."""
+    return msg.get("timestamp") or "", msg["msg_id"]
+
+
+def _encode(msgs: list) -> bytes:
+    return zlib.compress(json.dumps(msgs, separators=(",", ":")).encode(), 6)
+
+
+def _decode(data: bytes) -> list:
+    return json.loads(zlib.decompress(data))
+
+
+class Archive:
+    def __init__(self):
+        self._edges: dict[str, tuple] = {}  # chat_id -> newest archived key
+        self._counts: dict[str, int] = {}
+        self._cache: OrderedDict[tuple, list] = OrderedDict()  # (chat_id, month, rev) -> messages
+
+    async def init(self):
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS segments (
+                    chat_id TEXT,
+                    month TEXT,
+                    first_ts TEXT,
+                    last_ts TEXT,
+                    last_id INTEGER,
+                    count INTEGER,
+                    rev INTEGER DEFAULT 0,
+                    data BLOB,
+                    PRIMARY KEY (chat_id, month)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS archived (
+                    chat_id TEXT,
+                    msg_id INTEGER,
+                    month TEXT,
+                    PRIMARY KEY (chat_id, msg_id)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_archived_msg ON archived (msg_id)")
+            await db.commit()
+        await self.reload()
+
+    async def reload(self, chat_ids: list | None = None):
+        """Re-read the per-chat edges and counts (all chats, or just `chat_ids`)."""
+        where, params = "", []
+        if chat_ids is not None:
+            if not chat_ids:
+                return
+            where = f"WHERE chat_id IN ({','.join('?' for _ in chat_ids)})"
+            params = [str(c) for c in chat_ids]
+            for uid in params:
+                self._edges.pop(uid, None)
+                self._counts.pop(uid, None)
+        else:
+            self._edges, self._counts = {}, {}
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            async with db.execute(f"""
+                SELECT s.chat_id, t.n, s.last_ts, s.last_id FROM segments s
+                JOIN (SELECT chat_id, SUM(count) AS n, MAX(month) AS m FROM segments {where} GROUP BY chat_id) t
+                  ON s.chat_id = t.chat_id AND s.month = t.m
+            """, params) as cursor:
+                async for uid, n, last_ts, last_id in cursor:
+                    self._edges[uid] = (last_ts, last_id)
+                    self._counts[uid] = n
+
+    def edge(self, chat_id) -> tuple | None:
+        """Newest archived (timestamp, msg_id) of a chat, or None if nothing is archived."""
+        return self._edges.get(str(chat_id))
+
+    def count(self, chat_id) -> int:
+        return self._counts.get(str(chat_id), 0)
+
+    # reads
+    async def _segment(self, db, uid: str, month: str, rev: int) -> list:
+        cache_key = (uid, month, rev)
+        msgs = self._cache.get(cache_key)
+        if msgs is not None:
+            self._cache.move_to_end(cache_key)
+            return msgs
+        async with db.execute("SELECT data FROM segments WHERE chat_id = ? AND month = ?", (uid, month)) as cursor:
+            row = await cursor.fetchone()
+        msgs = await fileio.run(_decode, row[0]) if row else []
+        self._cache[cache_key] = msgs
+        while len(self._cache) > archive_cache_segments:
+            self._cache.popitem(last=False)
+        return msgs
+
+    async def _months(self, db, uid: str, where: str = "", params=(), order: str = "ASC") -> list:
+        async with db.execute(f"SELECT month, rev FROM segments WHERE chat_id = ? {where} ORDER BY month {order}",
+                              (uid, *params)) as cursor:
+            return await cursor.fetchall()
+
+    async def before(self, chat_id, k: tuple, n: int) -> list:
+        """Up to n messages with key < k, newest first."""
+        uid, out = str(chat_id), []
+        if uid not in self._edges:
+            return out
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            for month, rev in await self._months(db, uid, "AND month <= ?", (k[0][:7],), "DESC"):
+                for m in reversed(await self._segment(db, uid, month, rev)):
+                    if key(m) < k:
+                        out.append(m)
+                        if len(out) >= n:
+                            return out
+        return out
+
+    async def after(self, chat_id, k: tuple, n: int, inclusive=False) -> list:
+        """Up to n messages with key > k (or >= k), oldest first."""
+        uid, out = str(chat_id), []
+        if uid not in self._edges:
+            return out
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            for month, rev in await self._months(db, uid, "AND month >= ?", (k[0][:7],)):
+                for m in await self._segment(db, uid, month, rev):
+                    if key(m) > k or (inclusive and key(m) == k):
+                        out.append(m)
+                        if len(out) >= n:
+                            return out
+        return out
+
+    async def newest(self, chat_id, skip: int, n: int) -> list:
+        """n messages after skipping the `skip` newest, oldest first (offset paging)."""
+        uid, out = str(chat_id), []
+        if uid not in self._edges or n <= 0:
+            return out
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            async with db.execute("SELECT month, rev, count FROM segments WHERE chat_id = ? ORDER BY month DESC",
+                                  (uid,)) as cursor:
+                months = await cursor.fetchall()
+            for month, rev, count in months:
+                if skip >= count:
+                    # whole segment is above the page, no need to open it
+                    skip -= count
+                    continue
+                msgs = await self._segment(db, uid, month, rev)
+                end = len(msgs) - skip
+                out = msgs[max(0, end - (n - len(out))):end] + out
+                skip = 0
+                if len(out) >= n:
+                    break
+        return out
+
+    async def get(self, chat_id, msg_id) -> dict | None:
+        uid = str(chat_id)
+        if uid not in self._edges:
+            return None
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            async with db.execute("SELECT s.month, s.rev FROM archived a JOIN segments s "
+                                  "ON s.chat_id = a.chat_id AND s.month = a.month "
+                                  "WHERE a.chat_id = ? AND a.msg_id = ?", (uid, int(msg_id))) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            for m in await self._segment(db, uid, *row):
+                if m["msg_id"] == int(msg_id):
+                    return m
+        return None
+
+    async def chat_of(self, msg_id) -> str | None:
+        if not self._edges:
+            return None
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            async with db.execute("SELECT chat_id FROM archived WHERE msg_id = ? LIMIT 1", (int(msg_id),)) as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def all(self, chat_id) -> list:
+        uid, out = str(chat_id), []
+        if uid not in self._edges:
+            return out
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            for month, rev in await self._months(db, uid):
+                out.extend(await self._segment(db, uid, month, rev))
+        return out
+
+    # writes (primary only)
+    async def _write(self, db, uid: str, month: str, msgs: list):
+        if not msgs:
+            await db.execute("DELETE FROM segments WHERE chat_id = ? AND month = ?", (uid, month))
+            return
+        data = await fileio.run(_encode, msgs)
+        await db.execute("""
+            INSERT INTO segments (chat_id, month, first_ts, last_ts, last_id, count, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, month) DO UPDATE SET
+                first_ts=excluded.first_ts, last_ts=excluded.last_ts, last_id=excluded.last_id,
+                count=excluded.count, data=excluded.data, rev=rev + 1
+        """, (uid, month, key(msgs[0])[0], key(msgs[-1])[0], msgs[-1]["msg_id"], len(msgs), data))
+
+    async def _load(self, db, uid: str, month: str) -> list:
+        async with db.execute("SELECT rev FROM segments WHERE chat_id = ? AND month = ?", (uid, month)) as cursor:
+            row = await cursor.fetchone()
+        return list(await self._segment(db, uid, month, row[0])) if row else []
+
+    async def store(self, chat_id, msgs: list):
+        """Merge messages of one chat into their month segments (a message already there is replaced)."""
+        uid = str(chat_id)
+        by_month: dict[str, list] = {}
+        for m in msgs:
+            by_month.setdefault(key(m)[0][:7], []).append(m)
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            for month, batch in by_month.items():
+                merged = {m["msg_id"]: m for m in await self._load(db, uid, month)}
+                merged.update((m["msg_id"], m) for m in batch)
+                await self._write(db, uid, month, sorted(merged.values(), key=key))
+                await db.executemany(
+                    "INSERT INTO archived (chat_id, msg_id, month) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id, msg_id) DO UPDATE SET month = excluded.month",
+                    [(uid, m["msg_id"], month) for m in batch])
+            await db.commit()
+        await self.reload([uid])
+
+    async def remove(self, chat_id, msg_ids: list) -> list:
+        """Delete archived messages. Returns the ones that were there (for media cleanup)."""
+        uid = str(chat_id)
+        if uid not in self._edges or not msg_ids:
+            return []
+        ids = [int(i) for i in msg_ids]
+        removed = []
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            placeholders = ",".join("?" for _ in ids)
+            async with db.execute(f"SELECT DISTINCT month FROM archived WHERE chat_id = ? AND msg_id IN ({placeholders})",
+                                  (uid, *ids)) as cursor:
+                months = [r[0] for r in await cursor.fetchall()]
+            if not months:
+                return []
+            wanted = set(ids)
+            for month in months:
+                msgs = await self._load(db, uid, month)
+                removed.extend(m for m in msgs if m["msg_id"] in wanted)
+                await self._write(db, uid, month, [m for m in msgs if m["msg_id"] not in wanted])
+            await db.execute(f"DELETE FROM archived WHERE chat_id = ? AND msg_id IN ({placeholders})", (uid, *ids))
+            await db.commit()
+        await self.reload([uid])
+        _broadcast({"type": "archive_reload", "chat_ids": [uid]})
+        return removed
+
+    async def drop_chat(self, chat_id):
+        uid = str(chat_id)
+        if uid not in self._edges:
+            return
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            await db.execute("DELETE FROM segments WHERE chat_id = ?", (uid,))
+            await db.execute("DELETE FROM archived WHERE chat_id = ?", (uid,))
+            await db.commit()
+        await self.reload([uid])
+        _broadcast({"type": "archive_reload", "chat_ids": [uid]})
+
+    async def purge(self, chat_id, before: str, match, strip_media=False) -> list:
+        """Delete archived messages older than `before` for which match(msg) is true, or with
+        strip_media only forget their media file. One segment per transaction. Returns the hits."""
+        uid = str(chat_id)
+        if uid not in self._edges:
+            return []
+        hits = []
+        async with aiosqlite.connect(archive_path, timeout=30.0) as db:
+            for month, _ in await self._months(db, uid, "AND month <= ?", (before[:7],)):
+                msgs = await self._load(db, uid, month)
+                found = [m for m in msgs if key(m)[0] < before and match(m)]
+                if not found:
+                    continue
+                hits.extend(found)
+                ids = {m["msg_id"] for m in found}
+                if strip_media:
+                    msgs = [{**m, "media_file": None, "media_expired": True} if m["msg_id"] in ids else m
+                            for m in msgs]
+                else:
+                    msgs = [m for m in msgs if m["msg_id"] not in ids]
+                    await db.executemany("DELETE FROM archived WHERE chat_id = ? AND msg_id = ?",
+                                         [(uid, i) for i in ids])
+                await self._write(db, uid, month, msgs)
+                await db.commit()
+                await asyncio.sleep(0)
+        if hits:
+            await self.reload([uid])
+            _broadcast({"type": "archive_reload", "chat_ids": [uid]})
+        return hits
+
+    async def run(self, move):
+        """Every archive_interval_hours, call move(cutoff) to move older messages out of the hot table."""
+        if archive_after_days <= 0:
+            return
+        while True:
+            cutoff = (datetime.now() - timedelta(days=archive_after_days)).isoformat()
+            try:
+                chats = await move(cutoff)
+                if chats:
+                    log.info("archived old messages", extra={"chats": len(chats), "before": cutoff[:10]})
+                    _broadcast({"type": "archive_reload", "chat_ids": chats})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("archiving failed")
+            await asyncio.sleep(archive_interval_hours * 3600)
+
+
+def _broadcast(event: dict):
+    """Tell web workers to re-read their edges; browsers don't need these."""
+    for forward in forwarders:
+        forward(event)
+
+
+archive = Archive()
@@ -0,0 +1,105 @@
+"""
+Static asset pipeline. On startup every file under web/ is read once, given a
+content-hashed url and precompressed with gzip (and brotli when the optional
+`brotli` package is installed). index.html is rewritten to use the hashed
+urls, so those can be cached forever while index.html is revalidated.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_compressible = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+immutable = "public, max-age=31536000, immutable"
+revalidate = "no-cache"
+
+
+class Asset:
+    """One file's bytes in every encoding we can serve it in."""
+    def __init__(self, body: bytes, content_type: str):
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()[:12]
+        # weak, since the encodings differ byte-wise but are the same resource
+        self.etag = f'W/"{self.digest}"'
+        self.variants = {"identity": body}
+        if content_type.startswith(_compressible):
+            gz = gzip.compress(body, 9, mtime=0)
+            if len(gz) < len(body):
+                self.variants["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants["br"] = br
+
+
+def _accepted(header: str) -> set:
+    """Encodings named in Accept-Encoding, minus any refused with q=0."""
+    ok = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if name and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            ok.add(name.lower())
+    return ok
+
+
+class AssetStore:
+    def __init__(self, root: Path):
+        self.root = root
+        self._files: dict[str, tuple[Asset, str]] = {}  # url path -> (asset, cache-control)
+        self.index: Asset | None = None
+
+    def build(self):
+        """Hash, compress and index everything under root. Runs once at startup."""
+        self._files = {}
+        urls = {}
+        for fp in sorted(self.root.rglob("*")):
+            if not fp.is_file() or fp.name == "index.html":
+                continue
+            ct, _ = mimetypes.guess_type(fp.name)
+            asset = Asset(fp.read_bytes(), ct or "application/octet-stream")
+            rel = fp.relative_to(self.root).as_posix()
+            hashed = fp.relative_to(self.root).with_name(f"{fp.stem}.{asset.digest}{fp.suffix}").as_posix()
+            self._files[rel] = (asset, revalidate)
+            self._files[hashed] = (asset, immutable)
+            urls[f"/static/{rel}"] = f"/static/{hashed}"
+
+        html = (self.root / "index.html").read_text(encoding="utf-8")
+        for plain, hashed in urls.items():
+            html = html.replace(f'"{plain}"', f'"{hashed}"')
+        self.index = Asset(html.encode("utf-8"), "text/html")
+
+    def get(self, rel: str) -> tuple[Asset, str] | None:
+        return self._files.get(rel)
+
+
+def respond(request: web.Request, asset: Asset, cache_control: str) -> web.Response:
+    """Serve an asset with validators, 304s and Accept-Encoding negotiation."""
+    headers = {"ETag": asset.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    inm = request.headers.get("If-None-Match", "")
+    if inm == "*" or asset.digest in inm:
+        return web.Response(status=304, headers=headers)
+
+    accepted = _accepted(request.headers.get("Accept-Encoding", ""))
+    encoding = "identity"
+    for candidate in ("br", "gzip"):
+        if candidate in accepted and candidate in asset.variants:
+            encoding = candidate
+            break
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    ct = asset.content_type
+    if ct.startswith("text/") or ct == "application/javascript":
+        ct += "; charset=utf-8"
+    headers["Content-Type"] = ct
+    return web.Response(body=asset.variants[encoding], headers=headers)
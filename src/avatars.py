@@ -0,0 +1,110 @@
+"""
+Profile photo cache. Concurrent requests for the same uid share a single
+download, "no photo" answers are remembered for a while, and cached photos
+are refreshed in the background once they are older than the TTL.
+"""
+
+import asyncio
+import os
+import time
+from pathlib import Path
+
+from src import fileio
+from src.clients import bot, is_http_bot
+from src.config import data_dir, avatar_ttl_hours, avatar_miss_ttl_minutes
+from src.log import get_logger
+
+log = get_logger("avatars")
+
+avatar_dir = data_dir / "avatars"
+avatar_dir.mkdir(exist_ok=True)
+
+
+class Avatar:
+    """A cached photo on disk plus its validator."""
+    def __init__(self, path: Path, st: os.stat_result):
+        self.path = path
+        # same format aiohttp's FileResponse uses, so both sides agree on 304s
+        self.etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def _stat(fp: Path) -> os.stat_result | None:
+    try:
+        return fp.stat()
+    except FileNotFoundError:
+        return None
+
+
+def _finish(tmp: Path, fp: Path, ok: bool) -> bool:
+    """Move a finished download into place. Returns whether a photo is on disk."""
+    if ok and tmp.exists():
+        os.replace(tmp, fp)
+        return True
+    tmp.unlink(missing_ok=True)
+    if fp.exists():
+        # refresh failed, keep the old photo and try again after another ttl
+        os.utime(fp)
+        return True
+    return False
+
+
+class AvatarCache:
+    def __init__(self, root: Path):
+        self.root = root
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._missing: dict[str, float] = {}  # uid -> monotonic expiry
+
+    def _path(self, uid: str) -> Path:
+        return self.root / f"{uid}.jpg"
+
+    async def get(self, user_id) -> Avatar | None:
+        """Return the cached avatar, fetching it once if it is not on disk yet."""
+        uid = str(user_id)
+        fp = self._path(uid)
+        st = await fileio.run(_stat, fp)
+
+        if st is not None:
+            if time.time() - st.st_mtime > avatar_ttl_hours * 3600:
+                self._fetch(uid)  # serve the stale copy, refresh behind it
+            return Avatar(fp, st)
+
+        expiry = self._missing.get(uid)
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return None
+            self._missing.pop(uid, None)
+
+        # shield so a client hanging up doesn't cancel the shared download
+        if not await asyncio.shield(self._fetch(uid)):
+            return None
+        st = await fileio.run(_stat, fp)
+        return Avatar(fp, st) if st else None
+
+    def _fetch(self, uid: str) -> asyncio.Task:
+        """Start a download for uid, or join the one already running."""
+        task = self._inflight.get(uid)
+        if task is None:
+            task = asyncio.ensure_future(self._download(uid))
+            self._inflight[uid] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(uid, None))
+        return task
+
+    async def _download(self, uid: str) -> bool:
+        fp = self._path(uid)
+        tmp = fp.with_suffix(".part")
+        try:
+            if is_http_bot:
+                ok = await bot.get_user_profile_photo(int(uid), str(tmp))
+            else:
+                ok = await bot.download_profile_photo(int(uid), file=str(tmp)) is not None
+        except Exception as exc:
+            log.warning("profile photo failed: %s", exc, extra={"chat_id": uid})
+            ok = False
+
+        if await fileio.run(_finish, tmp, fp, ok):
+            return True
+        self._missing[uid] = time.monotonic() + avatar_miss_ttl_minutes * 60
+        return False
+
+
+avatars = AvatarCache(avatar_dir)
@@ -0,0 +1,421 @@
+"""
+Broadcast jobs: one message (text or media) sent to many chats.
+
+Targets are resolved from a selector when the job is created and stored in
+broadcast_targets together with each chat's outcome, so a job survives
+restarts and can be paused, resumed or cancelled. Jobs run one at a time;
+sends go through a shared rate limiter (broadcast_rate per second,
+broadcast_concurrency in flight). A flood error holds every sender back for
+the retry_after Telegram asks for, 400/403 answers (bot blocked, chat gone)
+fail the chat at once, anything else is retried. Media is uploaded once and
+then resent by file_id.
+
+Outcomes are written in batches every half second, so after a crash at
+most the last half second of sends can go out twice.
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+import aiosqlite
+
+from src import fileio
+from src.clients import bot, is_http_bot
+from src.config import data_dir, broadcast_rate, broadcast_concurrency, broadcast_max_attempts
+from src.handlers import _notify_ws, _notify_chat
+from src.log import get_logger
+from src.storage import storage, db_path
+
+log = get_logger("broadcast")
+
+# uploaded broadcast media waits here until its job is done or cancelled
+broadcast_dir = data_dir / "broadcasts"
+
+selector_types = ("all", "private", "group")
+actions = ("pause", "resume", "cancel")
+
+
+class RateLimiter:
+    """Spaces calls `1 / rate` apart; pause() holds every caller back for a while."""
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # a pause that started while we slept applies to us too
+            if time.monotonic() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _target_filter(selector: dict) -> tuple[str, list]:
+    """WHERE clause over users for a selector: {type, active_days, inactive_days}."""
+    kind = selector.get("type", "all")
+    if kind not in selector_types:
+        raise ValueError(f"type must be one of {', '.join(selector_types)}")
+    where = ["CAST(user_id AS INTEGER) NOT IN (SELECT user_id FROM acl WHERE list = 'banned')"]
+    params = []
+    if kind == "private":
+        where.append("COALESCE(type, 'private') = 'private'")
+    elif kind == "group":
+        where.append("type IN ('group', 'supergroup')")
+    if selector.get("active_days"):
+        where.append("last_seen >= ?")
+        params.append((datetime.now() - timedelta(days=float(selector["active_days"]))).isoformat())
+    if selector.get("inactive_days"):
+        where.append("last_seen < ?")
+        params.append((datetime.now() - timedelta(days=float(selector["inactive_days"]))).isoformat())
+    return " AND ".join(where), params
+
+
+def _retry_after(exc) -> float | None:
+    """Seconds Telegram wants us to wait, for flood errors from either client."""
+    wait = getattr(exc, "retry_after", None)
+    if wait is None and getattr(exc, "code", None) == 420:  # telethon FloodWaitError
+        wait = getattr(exc, "seconds", None)
+    return wait
+
+
+class Broadcasts:
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._limiter = RateLimiter(broadcast_rate)
+        self._current: int | None = None
+        self._halt = False
+        self._ref = None
+        self._upload_lock = asyncio.Lock()
+        self._results: list[tuple] = []
+        self._last_progress = 0.0
+
+    async def init(self):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    status TEXT,
+                    payload TEXT,
+                    total INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    file_ref TEXT,
+                    created TEXT,
+                    started TEXT,
+                    finished TEXT
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_targets (
+                    job_id INTEGER,
+                    chat_id TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    msg_id INTEGER,
+                    PRIMARY KEY (job_id, chat_id)
+                ) WITHOUT ROWID
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_targets_status "
+                             "ON broadcast_targets (job_id, status, chat_id)")
+            await db.commit()
+
+    # jobs
+
+    async def count_targets(self, selector: dict) -> int:
+        where, params = _target_filter(selector)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def create(self, text: str, selector: dict, media_path: str | None = None,
+                     media_type: str | None = None) -> dict:
+        """Store a job and its targets; it starts as soon as the jobs before it are finished."""
+        where, params = _target_filter(selector)
+        payload = {"text": text, "selector": selector, "media_path": media_path, "media_type": media_type}
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            cursor = await db.execute(
+                "INSERT INTO broadcast_jobs (status, payload, created) VALUES ('queued', ?, ?)",
+                (json.dumps(payload), datetime.now().isoformat()))
+            job_id = cursor.lastrowid
+            cursor = await db.execute(
+                f"INSERT INTO broadcast_targets (job_id, chat_id) SELECT ?, user_id FROM users WHERE {where}",
+                [job_id] + params)
+            total = cursor.rowcount
+            await db.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (total, job_id))
+            await db.commit()
+        log.info("job created", extra={"job_id": job_id, "targets": total})
+        self._wakeup.set()
+        job = await self.get(job_id)
+        await self._progress(job_id, force=True)
+        return job
+
+    async def get(self, job_id: int) -> dict | None:
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(
+                "SELECT id, status, payload, total, sent, failed, created, started, finished "
+                "FROM broadcast_jobs WHERE id = ?", (job_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            async with db.execute(
+                "SELECT error, COUNT(*) FROM broadcast_targets WHERE job_id = ? AND status = 'failed' "
+                "GROUP BY error ORDER BY COUNT(*) DESC LIMIT 5", (job_id,)
+            ) as cursor:
+                errors = [{"error": e, "count": n} for e, n in await cursor.fetchall()]
+        return _summary(row, errors)
+
+    async def list(self, limit=50) -> list:
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(
+                "SELECT id, status, payload, total, sent, failed, created, started, finished "
+                "FROM broadcast_jobs ORDER BY id DESC LIMIT ?", (limit,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return [_summary(row) for row in rows]
+
+    async def control(self, job_id: int, action: str) -> dict:
+        """pause, resume or cancel. Raises ValueError when the job is not in a state that allows it."""
+        allowed = {
+            "pause": (("queued", "running"), "paused"),
+            "resume": (("paused",), "queued"),
+            "cancel": (("queued", "running", "paused"), "cancelled"),
+        }
+        if action not in allowed:
+            raise ValueError(f"action must be one of {', '.join(actions)}")
+        sources, target = allowed[action]
+        placeholders = ",".join("?" for _ in sources)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            cursor = await db.execute(
+                f"UPDATE broadcast_jobs SET status = ? WHERE id = ? AND status IN ({placeholders})",
+                (target, job_id, *sources))
+            await db.commit()
+        if not cursor.rowcount:
+            raise ValueError(f"job {job_id} can't {action} now")
+        if action != "resume" and self._current == job_id:
+            self._halt = True
+        elif action == "cancel":
+            await self._drop_media(job_id)
+        self._wakeup.set()
+        await self._progress(job_id, force=True)
+        return await self.get(job_id)
+
+    # delivery
+
+    async def run(self):
+        """Work through queued jobs, oldest first. Jobs left running by a restart carry on."""
+        while True:
+            self._wakeup.clear()
+            async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                async with db.execute(
+                    "SELECT id, payload, file_ref, started FROM broadcast_jobs "
+                    "WHERE status IN ('running', 'queued') ORDER BY id LIMIT 1"
+                ) as cursor:
+                    row = await cursor.fetchone()
+            if row is None:
+                await self._wakeup.wait()
+                continue
+            await self._run_job(*row)
+
+    async def _run_job(self, job_id: int, payload: str, file_ref: str | None, started: str | None):
+        payload = json.loads(payload)
+        self._current, self._halt, self._ref = job_id, False, file_ref
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            # paused or cancelled since run() picked it
+            cursor = await db.execute("UPDATE broadcast_jobs SET status = 'running', started = ? "
+                                      "WHERE id = ? AND status IN ('queued', 'running')",
+                                      (started or datetime.now().isoformat(), job_id))
+            await db.commit()
+        if not cursor.rowcount:
+            self._current = None
+            return
+        log.info("job running", extra={"job_id": job_id})
+
+        queue = asyncio.Queue(maxsize=broadcast_concurrency * 4)
+        workers = [asyncio.create_task(self._worker(job_id, payload, queue)) for _ in range(broadcast_concurrency)]
+        done = asyncio.Event()
+        flusher = asyncio.create_task(self._flush_loop(job_id, payload, done))
+        try:
+            last = ""
+            while not self._halt:
+                async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                    async with db.execute(
+                        "SELECT chat_id FROM broadcast_targets WHERE job_id = ? AND status = 'pending' "
+                        "AND chat_id > ? ORDER BY chat_id LIMIT 500", (job_id, last)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                if not rows:
+                    break
+                for (chat_id,) in rows:
+                    if self._halt:
+                        break
+                    await queue.put(chat_id)
+                    last = chat_id
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            done.set()
+            await flusher
+            self._current = None
+
+        if not self._halt:
+            async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                await db.execute("UPDATE broadcast_jobs SET status = 'done', finished = ? "
+                                 "WHERE id = ? AND status = 'running'", (datetime.now().isoformat(), job_id))
+                await db.commit()
+            log.info("job done", extra={"job_id": job_id})
+        job = await self.get(job_id)
+        if job and job["status"] in ("done", "cancelled"):
+            await self._drop_media(job_id)
+        await self._progress(job_id, force=True)
+
+    async def _drop_media(self, job_id: int):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT payload FROM broadcast_jobs WHERE id = ?", (job_id,)) as cursor:
+                row = await cursor.fetchone()
+        path = json.loads(row[0]).get("media_path") if row else None
+        if path:
+            await fileio.unlink(path)
+
+    async def _worker(self, job_id: int, payload: dict, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            if self._halt:
+                continue
+            attempts = 0
+            while True:
+                await self._limiter.acquire()
+                if self._halt:
+                    break
+                try:
+                    sent = await self._send(job_id, chat_id, payload)
+                    self._results.append((chat_id, "sent", attempts + 1, None, sent.id))
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    wait = _retry_after(exc)
+                    if wait:
+                        log.warning("flood limit, holding sends for %ss", wait, extra={"job_id": job_id})
+                        self._limiter.pause(float(wait))
+                        continue
+                    attempts += 1
+                    if getattr(exc, "code", None) in (400, 403) or attempts >= broadcast_max_attempts:
+                        self._results.append((chat_id, "failed", attempts, str(exc)[:200], None))
+                        break
+                    await asyncio.sleep(2 ** attempts)
+
+    async def _send(self, job_id: int, chat_id: str, payload: dict):
+        text = payload["text"]
+        path = payload.get("media_path")
+        if not path:
+            return await bot.send_message(int(chat_id), text)
+        if self._ref is None:
+            # upload once; everyone else waits and then reuses telegram's copy
+            async with self._upload_lock:
+                if self._ref is None:
+                    sent = await self._send_media(chat_id, path, text, None)
+                    await self._keep_ref(job_id, sent)
+                    return sent
+        return await self._send_media(chat_id, path, text, self._ref)
+
+    async def _send_media(self, chat_id: str, path: str, caption: str, ref):
+        if is_http_bot:
+            return await bot.send_file(int(chat_id), path, caption=caption or None, file_id=ref)
+        return await bot.send_file(int(chat_id), ref or path, caption=caption or None)
+
+    async def _keep_ref(self, job_id: int, sent):
+        if is_http_bot:
+            self._ref = getattr(sent, "file_id", None)
+            if self._ref:
+                async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                    await db.execute("UPDATE broadcast_jobs SET file_ref = ? WHERE id = ?", (self._ref, job_id))
+                    await db.commit()
+        else:
+            # telethon accepts the sent media object itself; it only lives as long as this process
+            self._ref = getattr(sent, "media", None)
+
+    async def _flush_loop(self, job_id: int, payload: dict, done: asyncio.Event):
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush(job_id, payload)
+
+    async def _flush(self, job_id: int, payload: dict):
+        """Write outcomes collected since the last flush and add the sent messages to chat history."""
+        results, self._results = self._results, []
+        if not results:
+            return
+        sent = [r for r in results if r[1] == "sent"]
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.executemany(
+                "UPDATE broadcast_targets SET status = ?, attempts = ?, error = ?, msg_id = ? "
+                "WHERE job_id = ? AND chat_id = ?",
+                [(status, attempts, error, msg_id, job_id, chat_id)
+                 for chat_id, status, attempts, error, msg_id in results])
+            await db.execute("UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+                             (len(sent), len(results) - len(sent), job_id))
+            await db.commit()
+
+        now = datetime.now().isoformat()
+        messages = [(chat_id, {
+            "msg_id": msg_id, "direction": "out", "text": payload["text"], "timestamp": now,
+            "media_type": payload.get("media_type"), "media_file": None, "reply_to": None,
+            "forwarded_from": None, "forwarded_from_username": None, "source": "bot",
+            "broadcast_id": job_id,
+        }) for chat_id, _, _, _, msg_id in sent]
+        await storage.save_messages(messages)
+        # open chats show the announcement and the chat list moves them up, one update per chat
+        for chat_id, msg in messages:
+            await _notify_ws({"type": "message_sent", "user_id": int(chat_id), "message": msg})
+            await _notify_chat(chat_id, msg)
+        await self._progress(job_id)
+
+    async def _progress(self, job_id: int, force=False):
+        """broadcast_progress over the websocket, at most once a second unless forced."""
+        now = time.monotonic()
+        if not force and now - self._last_progress < 1:
+            return
+        self._last_progress = now
+        job = await self.get(job_id)
+        if job:
+            await _notify_ws({"type": "broadcast_progress", "job": job})
+
+
+def _summary(row, errors=None) -> dict:
+    job_id, status, payload, total, sent, failed, created, started, finished = row
+    payload = json.loads(payload)
+    pending = total - sent - failed
+    out = {
+        "id": job_id, "status": status,
+        "text": payload["text"], "media_type": payload.get("media_type"), "selector": payload["selector"],
+        "total": total, "sent": sent, "failed": failed, "pending": pending,
+        "created": created, "started": started, "finished": finished,
+        "eta_seconds": round(pending / broadcast_rate) if status in ("queued", "running") else None,
+    }
+    if errors is not None:
+        out["errors"] = errors
+    return out
+
+
+broadcasts = Broadcasts()
@@ -0,0 +1,88 @@
+"""
+Local event bus between the primary process and web workers. The primary
+listens on a unix socket and writes every websocket event to each worker
+as one json line; workers re-publish them to their own clients.
+"""
+
+import asyncio
+import json
+from pathlib import Path
+
+from src.log import get_logger
+
+log = get_logger("bus")
+
+# a worker further behind than this is disconnected and catches up on reconnect
+_max_backlog = 8 * 1024 * 1024
+
+
+class BusServer:
+    def __init__(self, path: Path):
+        self.path = path
+        self._server = None
+        self._workers: set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self.path.unlink(missing_ok=True)
+        self._server = await asyncio.start_unix_server(self._on_connect, path=str(self.path))
+
+    async def stop(self):
+        for w in list(self._workers):
+            w.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        self.path.unlink(missing_ok=True)
+
+    async def _on_connect(self, reader, writer):
+        self._workers.add(writer)
+        try:
+            # workers never talk back; this just notices them going away
+            await reader.read()
+        finally:
+            self._workers.discard(writer)
+            writer.close()
+
+    def publish(self, data: dict):
+        """Write an event to every worker without waiting on any of them."""
+        if not self._workers:
+            return
+        line = json.dumps(data, default=str).encode() + b"\n"
+        for w in list(self._workers):
+            if w.transport.get_write_buffer_size() > _max_backlog:
+                self._workers.discard(w)
+                w.close()
+                continue
+            w.write(line)
+
+
+class BusClient:
+    def __init__(self, path: Path, on_event):
+        self.path = path
+        self.on_event = on_event
+
+    async def run(self, on_connect=None):
+        """Read events forever, reconnecting if the primary goes away.
+
+        on_connect runs after every (re)connect, before any line is read, so
+        the caller can catch up on what it missed while disconnected.
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(self.path), limit=_max_backlog)
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            try:
+                if on_connect:
+                    await on_connect()
+                while line := await reader.readline():
+                    try:
+                        await self.on_event(json.loads(line))
+                    except Exception as exc:
+                        log.warning("bad event: %s", exc)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                pass
+            finally:
+                writer.close()
+            await asyncio.sleep(1)
@@ -1,16 +1,24 @@
 """
 Client factory. Bot-only mode uses HttpBot (just bot_token needed),
-full mode uses Telethon for both userbot and bot.
+full mode uses Telethon for both userbot and bot. Web worker processes
+get no clients at all.
 """
 
 import sys
-from src.config import api_id, api_hash, bot_token, sessions_dir, create_user_bot
+from src.config import (api_id, api_hash, bot_token, sessions_dir, create_user_bot, is_web_worker,
+                        telegram_api_base)
 
 if not bot_token:
     print("[x] bot_token is missing in .env")
     sys.exit(1)
 
-if create_user_bot:
+if is_web_worker:
+    # web workers never talk to Telegram; those routes are proxied to the primary
+    userbot = None
+    bot = None
+    is_http_bot = not create_user_bot
+
+elif create_user_bot:
     if not api_id or not api_hash:
         print("[x] create_user_bot=True requires API_ID and API_HASH in .env")
         print("    get them at https://my.telegram.org")
@@ -34,5 +42,5 @@ else:
     from src.http_bot import HttpBot
 
     userbot = None
-    bot = HttpBot(bot_token)
+    bot = HttpBot(bot_token, api_base=telegram_api_base)
     is_http_bot = True
@@ -12,40 +12,108 @@ create_user_bot = os.getenv("create_user_bot", os.getenv("CREATE_USER_BOT", "Fal
 api_id = int(os.getenv("api_id", os.getenv("API_ID", "0"))) if create_user_bot else 0
 api_hash = os.getenv("api_hash", os.getenv("API_HASH", "")) if create_user_bot else ""
 phone_number = os.getenv("phone_number", os.getenv("PHONE_NUMBER", "")) if create_user_bot else ""
+# bot-only mode; point at a local stand-in for load tests (see bench/)
+telegram_api_base = os.getenv("telegram_api_base", os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")).rstrip("/")
 
 # web server
 web_host = os.getenv("web_host", os.getenv("WEB_HOST", "127.0.0.1"))
 web_port = int(os.getenv("web_port", os.getenv("WEB_PORT", "8080")))
+web_workers = int(os.getenv("web_workers", os.getenv("WEB_WORKERS", "0")))  # 0 = everything in one process
+# set by the primary on the web worker processes it spawns
+worker_index = os.getenv("TELECHAT_WORKER")
+is_web_worker = worker_index is not None
 
 # chat config
 messages_per_load = 30
+users_per_page = 50             # chat list page size
+user_cache_size = 5000          # users kept in memory; the rest are looked up in sqlite on demand
+response_cache_size = 256       # encoded /api/users and /api/messages bodies kept in memory
 
+# websocket fan-out
+ws_queue_size = 256             # outbound frames buffered per client
+ws_overflow_policy = os.getenv("ws_overflow_policy", os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")).strip().lower()  # drop_oldest | coalesce | disconnect
+ws_heartbeat = 30               # seconds between server pings
+ws_batch_ms = int(os.getenv("ws_batch_ms", os.getenv("WS_BATCH_MS", "0")))  # collect events this long and send one frame (0 = off)
+ws_compress = True              # permessage-deflate
+change_log_size = 10000         # websocket events kept for clients to catch up on
+
+# diagnostics
+slow_request_ms = int(os.getenv("slow_request_ms", os.getenv("SLOW_REQUEST_MS", "500")))  # log requests slower than this
+profile_max_seconds = 60        # longest run allowed for /api/admin/profile
+
+# logging (src/log.py)
+log_level = os.getenv("log_level", os.getenv("LOG_LEVEL", "INFO")).strip().upper()
+log_levels = os.getenv("log_levels", os.getenv("LOG_LEVELS", ""))  # per module, e.g. handlers=DEBUG,bus=WARNING
+log_format = os.getenv("log_format", os.getenv("LOG_FORMAT", "text")).strip().lower()  # text | json
+log_queue_size = 10000          # records waiting for the writer thread; beyond this they are dropped
+log_rate_limit = 20             # same log line at most this many times per window (0 = no limit)
+log_rate_window = 10            # seconds
+
+# seed the acl table (src/acl.py); changes made in the UI are stored there, not here
 _au = os.getenv("allowed_users", "")
 allowed_users = [int(x.strip().strip("'\"")) for x in _au.split(",") if x.strip().strip("'\"")] if _au else []
 
 _bu = os.getenv("banned_users", "")
 banned_users = [int(x.strip().strip("'\"")) for x in _bu.split(",") if x.strip().strip("'\"")] if _bu else []
 
+# inbound update queue (bot-only mode)
+inbox_workers = 4               # parallel consumer lanes; a chat always maps to the same lane
+inbox_max_attempts = 5          # handler retries before an update is set aside as failed
+
+# outgoing message queue
+outbox_workers = 4              # parallel sender lanes; a chat always maps to the same lane
+outbox_max_attempts = 5         # send attempts before a message is marked failed
+
+# broadcasts to many chats (src/broadcast.py)
+broadcast_rate = 25             # messages per second over all chats; telegram allows about 30
+broadcast_concurrency = 10      # sends in flight at once
+broadcast_max_attempts = 3      # tries per chat on transient errors before it counts as failed
+
+# cold archive for old history (src/archive.py)
+archive_after_days = int(os.getenv("archive_after_days", os.getenv("ARCHIVE_AFTER_DAYS", "180")))  # 0 = keep everything hot
+archive_interval_hours = 6      # how often old messages are moved out
+archive_batch = 2000            # messages moved per transaction
+archive_cache_segments = 32     # decompressed month segments kept in memory per process
+
+# retention (src/retention.py); rules are a json list, e.g. [{"chat_type": "group", "older_than_days": 90}]
+retention_rules = os.getenv("retention_rules", os.getenv("RETENTION_RULES", ""))
+retention_interval_minutes = 30  # how often the rules are applied and free pages handed back
+retention_batch = 500           # rows deleted per transaction
+vacuum_step_ms = 20             # longest one incremental_vacuum step may hold the write lock
+vacuum_convert_max_mb = 256     # older databases up to this size are switched to incremental vacuum at startup
+
 # afk auto reply
 afk_message = "will reply very soon if not afk (or not ignoring)"
 
+# blocking file work runs on this many threads
+io_threads = 8
+
+# avatar cache
+avatar_ttl_hours = 24           # refresh cached photos in the background after this
+avatar_miss_ttl_minutes = 30    # remember "no photo" for this long
+avatar_max_age = 3600           # browser cache lifetime (seconds)
+
 # paths
-data_dir = base_dir / "data"
+data_dir = Path(os.getenv("telechat_data_dir", os.getenv("TELECHAT_DATA_DIR", base_dir / "data")))
 chats_dir = data_dir / "chats"
 users_file = data_dir / "users.json"
 sessions_dir = base_dir / "sessions"
 
+# snapshots (src/snapshots.py); put SNAPSHOT_DIR on another disk for real backups
+snapshot_dir = Path(os.getenv("snapshot_dir", os.getenv("SNAPSHOT_DIR", "")) or data_dir / "snapshots")
+snapshot_interval_hours = float(os.getenv("snapshot_interval_hours", os.getenv("SNAPSHOT_INTERVAL_HOURS", "0")))  # 0 = only on request
+snapshot_keep = 7               # newest snapshots kept; older ones are deleted
+snapshot_step_pages = 1024      # database pages copied per backup step
+snapshot_step_sleep_ms = 5      # pause between backup steps
+snapshot_copy_mb_s = 50         # media copy bandwidth limit (0 = unlimited)
+
+# message shards (src/shards.py); messages are split across this many files in data/shards by chat
+message_shards = int(os.getenv("message_shards", os.getenv("MESSAGE_SHARDS", "0")))  # 0 = all in telechat.db
+shard_move_batch = 2000         # messages copied per transaction when a chat moves between shards
+
+# unix sockets between the primary and web workers
+bus_socket = data_dir / "bus.sock"
+primary_socket = data_dir / "primary.sock"
+
 for d in (data_dir, chats_dir, sessions_dir):
     d.mkdir(parents=True, exist_ok=True)
-
-def update_banned_users(uid, block=True):
-    from dotenv import set_key
-    global banned_users
-    uid = int(uid)
-    if block and uid not in banned_users:
-        banned_users.append(uid)
-    elif not block and uid in banned_users:
-        banned_users.remove(uid)
-    
-    val = ",".join(str(x) for x in banned_users)
-    set_key(str(base_dir / ".env"), "banned_users", val)
@@ -0,0 +1,117 @@
+"""
+Blocking filesystem work, kept off the event loop. Small operations run on
+a bounded thread pool (io_threads); whole chat folders are deleted by
+renaming them into data/.trash (instant, same filesystem) and removing
+them one at a time on a separate thread, so a huge media folder never
+competes with message traffic for the pool.
+"""
+
+import asyncio
+import functools
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.config import data_dir, io_threads
+from src.log import get_logger
+
+log = get_logger("fileio")
+
+executor = ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="fileio")
+_deleter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fileio-rm")
+
+trash_dir = data_dir / ".trash"
+
+
+async def run(fn, *args, **kwargs):
+    """Run a blocking callable on the I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+def _unlink_all(paths):
+    for p in paths:
+        Path(p).unlink(missing_ok=True)
+
+
+async def unlink(*paths):
+    await run(_unlink_all, paths)
+
+
+async def exists(path) -> bool:
+    return await run(os.path.exists, path)
+
+
+async def makedirs(path):
+    await run(os.makedirs, path, exist_ok=True)
+
+
+async def rename(src, dst):
+    await run(os.replace, src, dst)
+
+
+async def write_bytes(path, data: bytes):
+    await run(Path(path).write_bytes, data)
+
+
+async def copy(src, dst):
+    await run(shutil.copy2, src, dst)
+
+
+async def rmtree(path):
+    """Remove a small directory tree in place (temp dirs and the like)."""
+    await run(shutil.rmtree, path, True)
+
+
+class DeletionQueue:
+    """Background removal of large directory trees."""
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def _ensure_worker(self):
+        if self._task is None or self._task.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._task = asyncio.create_task(self._work())
+
+    async def remove_tree(self, path):
+        """Make `path` disappear now; its contents are deleted in the background."""
+        path = Path(path)
+        if not await exists(path):
+            return
+        target = trash_dir / f"{path.name}.{uuid.uuid4().hex[:8]}"
+        await makedirs(trash_dir)
+        await rename(path, target)
+        self._ensure_worker()
+        self._queue.put_nowait(target)
+
+    async def sweep(self):
+        """Queue whatever a previous run left in the trash."""
+        if not await exists(trash_dir):
+            return
+        leftovers = await run(lambda: list(trash_dir.iterdir()))
+        if leftovers:
+            self._ensure_worker()
+            for p in leftovers:
+                self._queue.put_nowait(p)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            target = await self._queue.get()
+            try:
+                await loop.run_in_executor(_deleter, shutil.rmtree, target, True)
+            except Exception as exc:
+                log.warning("removing %s failed: %s", target, exc)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+deletions = DeletionQueue()
@@ -1,29 +1,65 @@
 """Incoming message handlers for both HttpBot and Telethon modes."""
 
-import json
+import logging
+import time
 from datetime import datetime, timedelta
 
 from src.clients import userbot, bot, is_http_bot
-from src.config import allowed_users, afk_message, create_user_bot, banned_users
+from src.acl import acl
+from src.config import afk_message, create_user_bot
+from src.log import get_logger
+from src.metrics import handler_seconds, ws_fanout_seconds, ws_fanout_clients
 from src.storage import storage
+from src.ws_hub import publish, ws_clients
 
-# websocket clients (populated by server.py)
-ws_clients: set = set()
+log = get_logger("handlers")
 
 # hours before afk reply is sent again to same user
 afk_cooldown_hours = 2
 
 
 async def _notify_ws(data: dict):
-    """Push json payload to all connected websocket clients."""
-    payload = json.dumps(data, default=str)
-    dead = set()
-    for ws in ws_clients:
-        try:
-            await ws.send_str(payload)
-        except Exception:
-            dead.add(ws)
-    ws_clients.difference_update(dead)
+    """Record payload in the change log, then queue it for all connected websocket clients.
+
+    append_change wakes its callers in seq order and nothing here awaits after it, so events
+    are published in seq order (clients drop seqs they've seen) without a lock around the commit.
+    """
+    data["seq"] = await storage.append_change(data)
+    ws_fanout_clients.observe(len(ws_clients))
+    with ws_fanout_seconds.time():
+        publish(data)
+
+
+def _preview(msg: dict | None) -> dict | None:
+    """Just what the chat list shows for a last message."""
+    if not msg:
+        return None
+    return {
+        "msg_id": msg.get("msg_id"),
+        "direction": msg.get("direction"),
+        "text": (msg.get("text") or "")[:100],
+        "media_type": msg.get("media_type"),
+        "timestamp": msg.get("timestamp"),
+    }
+
+
+async def _notify_chat(user_id, last_message: dict | None = None):
+    """Push a chat_updated delta (preview, unread, order) to chat-list subscribers."""
+    info = storage.get_user(user_id)
+    if not info:
+        return
+    if last_message is None:
+        # just the newest row; get_messages would also count the whole chat
+        last_message = (await storage.last_messages([user_id])).get(str(user_id))
+    await _notify_ws({
+        "type": "chat_updated",
+        "user_id": info["user_id"],
+        "chat": {
+            **info,
+            "last_message": _preview(last_message),
+            "is_banned": acl.is_banned(info["user_id"]),
+        },
+    })
 
 
 def _should_send_afk(user_id) -> bool:
@@ -45,63 +81,76 @@ def _should_send_afk(user_id) -> bool:
 
 async def _save_and_notify(chat, sender, msg_id, text, media_type, media_file,
                            reply_to, fwd_name, fwd_uname, source):
-    """Store message, conditionally send afk reply, push to websocket."""
-    is_group = bool(getattr(chat, 'type', None) in ('group', 'supergroup'))
-    send_afk = False if is_group else _should_send_afk(chat.id)
-
-    user_info = await storage.update_user(chat)
-    await storage.touch_interaction(chat.id)
-
-    msg_data = {
-        "msg_id": msg_id,
-        "direction": "in",
-        "text": text or "",
-        "timestamp": datetime.now().isoformat(),
-        "media_type": media_type,
-        "media_file": media_file,
-        "reply_to": reply_to,
-        "forwarded_from": fwd_name,
-        "forwarded_from_username": fwd_uname,
-        "source": source,
-        "sender_id": sender.id if getattr(sender, 'id', None) else None,
-        "sender_name": f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}".strip() if sender else None,
-    }
-
-    await storage.save_message(chat.id, msg_data)
-    await storage.increment_unread(chat.id)
-
-    if send_afk:
-        try:
-            await bot.send_message(chat.id, afk_message)
-        except Exception as exc:
-            print(f"[afk reply] {exc}")
+    """Store message, conditionally send afk reply, push to websocket.
+
+    Safe to call twice for the same message (updates are redelivered after a
+    crash): the row is upserted and unread/afk only happen the first time.
+    """
+    start = time.perf_counter()
+    with handler_seconds.time(source):
+        is_group = bool(getattr(chat, 'type', None) in ('group', 'supergroup'))
+        seen = await storage.get_message_by_id(chat.id, msg_id) is not None
+        send_afk = False if (is_group or seen) else _should_send_afk(chat.id)
+
+        user_info = await storage.update_user(chat)
+        await storage.touch_interaction(chat.id)
+
+        msg_data = {
+            "msg_id": msg_id,
+            "direction": "in",
+            "text": text or "",
+            "timestamp": datetime.now().isoformat(),
+            "media_type": media_type,
+            "media_file": media_file,
+            "reply_to": reply_to,
+            "forwarded_from": fwd_name,
+            "forwarded_from_username": fwd_uname,
+            "source": source,
+            "sender_id": sender.id if getattr(sender, 'id', None) else None,
+            "sender_name": f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}".strip() if sender else None,
+        }
+
+        await storage.save_message(chat.id, msg_data)
+        if not seen:
+            await storage.increment_unread(chat.id)
+
+        if send_afk:
+            try:
+                await bot.send_message(chat.id, afk_message)
+            except Exception as exc:
+                log.warning("afk reply failed: %s", exc, extra={"chat_id": chat.id})
 
-    await _notify_ws({
-        "type": "new_message",
-        "user_id": chat.id,
-        "message": msg_data,
-        "user_info": user_info,
-    })
+        await _notify_ws({
+            "type": "new_message",
+            "user_id": chat.id,
+            "message": msg_data,
+            "user_info": user_info,
+        })
+        await _notify_chat(chat.id, msg_data)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("message stored", extra={"chat_id": chat.id, "msg_id": msg_id, "source": source,
+                                           "duplicate": seen, "ms": round((time.perf_counter() - start) * 1000, 1)})
 
 
 # httpbot mode handler
 
 async def _http_bot_handler(msg):
     """Called by HttpBot polling for every message."""
-    print(f"DEBUG recv: sender={getattr(msg.sender, 'id', None)}, chat={getattr(msg.chat, 'id', None)}, type={getattr(msg.chat, 'type', None)}")
     if not msg.sender or getattr(msg.sender, 'bot', False):
-        print("DEBUG: blocked because no sender or bot")
+        log.debug("ignored: no sender or sent by a bot", extra={"msg_id": msg.id})
         return
 
     chat = msg.chat if getattr(msg, 'chat', None) else msg.sender
     is_group = getattr(chat, 'type', 'private') in ('group', 'supergroup')
 
-    if not is_group and msg.sender.id not in allowed_users:
-        print(f"DEBUG: blocked because not group and not allowed")
+    if not is_group and not acl.is_allowed(msg.sender.id):
+        log.debug("ignored: sender not allowed",
+                  extra={"chat_id": chat.id, "msg_id": msg.id, "sender_id": msg.sender.id})
         return
 
-    if msg.sender.id in banned_users:
-        print(f"DEBUG: blocked because banned")
+    if acl.is_banned(msg.sender.id):
+        log.debug("ignored: sender banned",
+                  extra={"chat_id": chat.id, "msg_id": msg.id, "sender_id": msg.sender.id})
         return
 
     media_type = getattr(msg, 'media_type', None)
@@ -114,7 +163,7 @@ async def _http_bot_handler(msg):
             try:
                 await msg.download_media(str(dest))
             except Exception as exc:
-                print(f"[media download] {exc}")
+                log.warning("media download failed: %s", exc, extra={"chat_id": chat.id, "msg_id": msg.id})
                 media_type = media_file = None
 
     fwd_name = fwd_uname = None
@@ -184,9 +233,9 @@ def _setup_telethon_handlers():
         sender = await event.get_sender()
         if not sender or getattr(sender, "bot", False):
             return
-        if sender.id not in allowed_users:
+        if not acl.is_allowed(sender.id):
             return
-        if sender.id in banned_users:
+        if acl.is_banned(sender.id):
             return
 
         await storage.update_user(sender)
@@ -198,7 +247,8 @@ def _setup_telethon_handlers():
                 await event.message.download_media(
                     file=str(folder / "media" / media_file))
             except Exception as exc:
-                print(f"[media download] {exc}")
+                log.warning("media download failed: %s", exc,
+                            extra={"chat_id": sender.id, "msg_id": event.message.id})
                 media_type = media_file = None
 
         fwd_name = fwd_uname = None
@@ -241,7 +291,8 @@ def _setup_telethon_handlers():
                             "user_id": int(chat_id),
                             "msg_ids": [msg_id]
                         })
-        print("[+] userbot handler registered")
+                        await _notify_chat(chat_id)
+        log.info("userbot handler registered")
 
     @bot.on(events.NewMessage(incoming=True, func=lambda e: e.is_private))
     async def on_bot_msg(event):
@@ -262,6 +313,7 @@ def _setup_telethon_handlers():
                         "user_id": int(chat_id),
                         "msg_ids": [msg_id]
                     })
+                    await _notify_chat(chat_id)
 async def _http_edit_handler(msg):
     """Called when a user edits a message in Telegram (http mode)."""
     if not getattr(msg, 'sender', None) or getattr(msg.sender, 'bot', False):
@@ -270,7 +322,7 @@ async def _http_edit_handler(msg):
     chat = msg.chat if getattr(msg, 'chat', None) else msg.sender
     is_group = getattr(chat, 'type', 'private') in ('group', 'supergroup')
 
-    if not is_group and msg.sender.id not in allowed_users:
+    if not is_group and not acl.is_allowed(msg.sender.id):
         return
 
     new_text = getattr(msg, 'text', "") or ""
@@ -282,6 +334,7 @@ async def _http_edit_handler(msg):
         "msg_id": msg.id,
         "message": updated,
     })
+    await _notify_chat(chat.id)
 
 async def _http_reaction_handler(data):
     """Called when a user reacts to a message in Telegram (http mode)."""
@@ -307,7 +360,7 @@ async def _http_reaction_handler(data):
     rname = f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or reactor
 
     if emoji:
-        await storage.add_reaction(chat_id, msg_id, emoji, reactor, rname)
+        await storage.set_reaction(chat_id, msg_id, emoji, reactor, rname)
     else:
         # User removed their reaction
         await storage.remove_reaction(chat_id, msg_id, reactor)
@@ -327,9 +380,9 @@ def setup_handlers():
         bot.on_message(_http_bot_handler)
         bot.on_edit(_http_edit_handler)
         bot.on_reaction(_http_reaction_handler)
-        print("[+] http bot handler registered")
+        log.info("http bot handler registered")
     else:
         _setup_telethon_handlers()
         if not create_user_bot:
-            print("[-] userbot disabled")
-    print("[+] bot handler registered")
+            log.info("userbot disabled")
+    log.info("bot handler registered")
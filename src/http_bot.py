@@ -6,13 +6,24 @@ Used in bot-only mode, no API_ID/API_HASH needed.
 import asyncio
 import json
 import mimetypes
+import time
 from pathlib import Path
 
+import aiofiles
 import aiohttp
 
+from src import fileio, tracing
+from src.log import get_logger
+from src.metrics import (bot_api_seconds, media_download_seconds, media_download_bytes,
+                         polling_lag_seconds)
+
+log = get_logger("http_bot")
+
 
 class BotUser:
     """Minimal user object matching fields we use from Telethon."""
+    __slots__ = ("id", "first_name", "last_name", "username", "bot")
+
     def __init__(self, d: dict):
         self.id = d["id"]
         self.first_name = d.get("first_name", "")
@@ -23,6 +34,8 @@ class BotUser:
 
 class BotChat:
     """Minimal chat object for private and group chats."""
+    __slots__ = ("id", "type", "title", "first_name", "last_name", "username")
+
     def __init__(self, d: dict):
         self.id = d["id"]
         self.type = d.get("type", "private")
@@ -33,24 +46,33 @@ class BotChat:
 
 
 class BotForward:
+    __slots__ = ("sender",)
+
     def __init__(self, d: dict):
         self.sender = BotUser(d) if d else None
 
 
 class BotReplyTo:
+    __slots__ = ("reply_to_msg_id",)
+
     def __init__(self, msg_id: int):
         self.reply_to_msg_id = msg_id
 
 
 class BotMessage:
-    """Wraps a Bot API message dict into an object with Telethon-like attributes."""
+    """Wraps a Bot API message dict into an object with Telethon-like attributes.
+
+    Only the fields we use are copied out; the raw dict is not kept.
+    """
+    __slots__ = ("id", "text", "sender", "chat", "is_private", "_bot", "forward", "reply_to",
+                 "media_type", "media_file_id", "_original_filename")
+
     def __init__(self, data: dict, bot: "HttpBot"):
         self.id = data["message_id"]
         self.text = data.get("text", "") or data.get("caption", "")
         self.sender = BotUser(data["from"]) if "from" in data else None
         self.chat = BotChat(data["chat"]) if "chat" in data else None
         self.is_private = self.chat.type == "private" if self.chat else False
-        self._data = data
         self._bot = bot
 
         self.forward = None
@@ -126,17 +148,33 @@ class BotMessage:
 
 
 class SentMessage:
+    __slots__ = ("id", "file_id")
+
     def __init__(self, data: dict):
         self.id = data["message_id"]
+        # telegram's id for uploaded media, so the same file can be sent again without re-uploading
+        media = data.get("photo") or data.get("video") or data.get("audio") or data.get("document")
+        if isinstance(media, list):
+            media = media[-1] if media else None
+        self.file_id = media.get("file_id") if media else None
+
+
+class BotApiError(Exception):
+    """A Bot API call that returned ok=false. `retry_after` is set on flood limits (429)."""
+
+    def __init__(self, description: str, code: int | None = None, retry_after: int | None = None):
+        super().__init__(description)
+        self.code = code
+        self.retry_after = retry_after
 
 
 class HttpBot:
     """Async Telegram Bot API client, drop-in for TelegramClient in bot-only mode."""
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, api_base: str = "https://api.telegram.org"):
         self.token = token
-        self._base = f"https://api.telegram.org/bot{token}"
-        self._file_base = f"https://api.telegram.org/file/bot{token}"
+        self._base = f"{api_base}/bot{token}"
+        self._file_base = f"{api_base}/file/bot{token}"
         self._session: aiohttp.ClientSession | None = None
         self._me: BotUser | None = None
         self._msg_handler = None
@@ -161,19 +199,27 @@ class HttpBot:
             await self._session.close()
             self._session = None
 
+    async def _post(self, method: str, **post_kw):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self._session.post(f"{self._base}/{method}", **post_kw) as r:
+                status = str(r.status)
+                body = await r.json()
+                if not body.get("ok"):
+                    raise BotApiError(body.get("description", "Bot API error"), body.get("error_code"),
+                                      (body.get("parameters") or {}).get("retry_after"))
+                return body["result"]
+        finally:
+            elapsed = time.perf_counter() - start
+            bot_api_seconds.observe(elapsed, method, status)
+            tracing.record("bot_api", elapsed)
+
     async def _call(self, method: str, **kwargs):
-        async with self._session.post(f"{self._base}/{method}", json=kwargs) as r:
-            body = await r.json()
-            if not body.get("ok"):
-                raise Exception(body.get("description", "Bot API error"))
-            return body["result"]
+        return await self._post(method, json=kwargs)
 
     async def _call_form(self, method: str, data: aiohttp.FormData):
-        async with self._session.post(f"{self._base}/{method}", data=data) as r:
-            body = await r.json()
-            if not body.get("ok"):
-                raise Exception(body.get("description", "Bot API error"))
-            return body["result"]
+        return await self._post(method, data=data)
 
     async def send_message(self, chat_id, text, reply_to=None, **_kw):
         params = {"chat_id": chat_id, "text": text}
@@ -195,7 +241,8 @@ class HttpBot:
                          chat_id=chat_id, message_id=message_id,
                          reaction=reaction)
 
-    async def send_file(self, chat_id, file_path, caption=None, reply_to=None, **_kw):
+    async def send_file(self, chat_id, file_path, caption=None, reply_to=None, file_id=None, **_kw):
+        """Upload file_path, or with file_id resend media Telegram already has (file_path then only picks the type)."""
         p = Path(file_path)
         mime, _ = mimetypes.guess_type(str(p))
         mime = mime or "application/octet-stream"
@@ -209,26 +256,42 @@ class HttpBot:
         else:
             field, method = "document", "sendDocument"
 
+        if file_id:
+            params = {"chat_id": chat_id, field: file_id}
+            if caption:
+                params["caption"] = caption
+            if reply_to:
+                params["reply_to_message_id"] = reply_to
+            return SentMessage(await self._call(method, **params))
+
         fd = aiohttp.FormData()
         fd.add_field("chat_id", str(chat_id))
         if caption:
             fd.add_field("caption", caption)
         if reply_to:
             fd.add_field("reply_to_message_id", str(reply_to))
-        fd.add_field(field, open(p, "rb"), filename=p.name,
-                     content_type=mime)
-
-        return SentMessage(await self._call_form(method, fd))
+        # streamed from the handle (aiohttp reads it in chunks off the loop), never held whole in memory
+        f = await fileio.run(open, p, "rb")
+        try:
+            fd.add_field(field, f, filename=p.name, content_type=mime)
+            return SentMessage(await self._call_form(method, fd))
+        finally:
+            await fileio.run(f.close)
 
     async def download_file(self, file_id: str, dest: str):
         info = await self._call("getFile", file_id=file_id)
         file_path = info["file_path"]
         url = f"{self._file_base}/{file_path}"
+        start = time.perf_counter()
         async with self._session.get(url) as r:
-            Path(dest).parent.mkdir(parents=True, exist_ok=True)
-            with open(dest, "wb") as f:
-                async for chunk in r.content.iter_chunked(8192):
-                    f.write(chunk)
+            await fileio.makedirs(Path(dest).parent)
+            async with aiofiles.open(dest, "wb", executor=fileio.executor) as f:
+                async for chunk in r.content.iter_chunked(64 * 1024):
+                    await f.write(chunk)
+                    media_download_bytes.inc(amount=len(chunk))
+        elapsed = time.perf_counter() - start
+        media_download_seconds.observe(elapsed)
+        tracing.record("bot_api", elapsed)
 
     async def delete_messages(self, chat_id, msg_ids: list):
         """Delete messages from telegram. Raises exception if failed."""
@@ -277,7 +340,7 @@ class HttpBot:
                 await self.download_file(best, dest)
                 return True
         except Exception as exc:
-            print(f"[avatar] entity {user_id}: {exc}")
+            log.warning("profile photo failed: %s", exc, extra={"chat_id": user_id})
             return False
 
     def on_message(self, handler):
@@ -292,41 +355,56 @@ class HttpBot:
         """Register an async callback for message_reaction updates."""
         self._reaction_handler = handler
 
-    async def start_polling(self):
-        """Long-poll getUpdates in a loop."""
+    async def process_update(self, u: dict):
+        """Run the registered handler for one raw update. Handler errors propagate."""
+        raw = u.get("message")
+        if raw and self._msg_handler:
+            msg = BotMessage(raw, self)
+            if msg.sender:
+                await self._msg_handler(msg)
+        edited_raw = u.get("edited_message")
+        if edited_raw and self._edit_handler:
+            msg = BotMessage(edited_raw, self)
+            if msg.sender:
+                await self._edit_handler(msg)
+        reaction_raw = u.get("message_reaction")
+        if reaction_raw and self._reaction_handler:
+            await self._reaction_handler(reaction_raw)
+
+    async def start_polling(self, offset=0, sink=None):
+        """Long-poll getUpdates in a loop.
+
+        Without a sink every update is handled inline. With one, each batch is
+        passed to `await sink(updates, next_offset)` and the offset only moves
+        on once the sink has stored it.
+        """
         self._running = True
-        offset = 0
         while self._running:
             try:
                 updates = await self._call("getUpdates",
                                            offset=offset, timeout=30,
                                            allowed_updates=["message", "edited_message", "message_reaction"])
+                if not updates:
+                    continue
+                now = time.time()
+                for u in updates:
+                    raw = u.get("message") or u.get("edited_message") or u.get("message_reaction") or {}
+                    sent = raw.get("edit_date") or raw.get("date")
+                    if sent:
+                        polling_lag_seconds.observe(max(0, now - sent))
+                next_offset = updates[-1]["update_id"] + 1
+                if sink:
+                    await sink(updates, next_offset)
+                    offset = next_offset
+                    continue
                 for u in updates:
                     offset = u["update_id"] + 1
-                    raw = u.get("message")
-                    if raw and self._msg_handler:
-                        msg = BotMessage(raw, self)
-                        if msg.sender:
-                            try:
-                                await self._msg_handler(msg)
-                            except Exception as exc:
-                                print(f"[handler] {exc}")
-                    edited_raw = u.get("edited_message")
-                    if edited_raw and self._edit_handler:
-                        msg = BotMessage(edited_raw, self)
-                        if msg.sender:
-                            try:
-                                await self._edit_handler(msg)
-                            except Exception as exc:
-                                print(f"[edit handler] {exc}")
-                    reaction_raw = u.get("message_reaction")
-                    if reaction_raw and self._reaction_handler:
-                        try:
-                            await self._reaction_handler(reaction_raw)
-                        except Exception as exc:
-                            print(f"[reaction handler] {exc}")
+                    try:
+                        await self.process_update(u)
+                    except Exception as exc:
+                        log.exception("handler failed", extra={"update_id": u["update_id"]})
             except asyncio.CancelledError:
                 break
             except Exception as exc:
-                print(f"[polling] {exc}")
+                log.warning("polling failed: %s", exc)
                 await asyncio.sleep(3)
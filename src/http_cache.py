@@ -0,0 +1,53 @@
+"""
+Conditional GET for the read endpoints. Responses are keyed by
+(endpoint, params) plus the storage version they were built from, so a
+client polling unchanged data gets a 304 and the server skips the
+database entirely on a cache hit.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+
+from aiohttp import web
+
+from src.config import response_cache_size
+from src.tracing import span
+
+
+class ResponseCache:
+    """Small LRU of encoded JSON bodies."""
+    def __init__(self, size: int):
+        self.size = size
+        self._bodies: OrderedDict = OrderedDict()
+
+    def get(self, key) -> bytes | None:
+        body = self._bodies.get(key)
+        if body is not None:
+            self._bodies.move_to_end(key)
+        return body
+
+    def put(self, key, body: bytes):
+        self._bodies[key] = body
+        self._bodies.move_to_end(key)
+        while len(self._bodies) > self.size:
+            self._bodies.popitem(last=False)
+
+
+response_cache = ResponseCache(response_cache_size)
+
+
+async def cached_json(request: web.Request, key: tuple, version: str, build) -> web.Response:
+    """Answer from the cache or If-None-Match when `version` hasn't moved, else await build()."""
+    etag = hashlib.sha1(repr((key, version)).encode()).hexdigest()[:20]
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+
+    body = response_cache.get((key, version))
+    if body is None:
+        data = await build()
+        with span("serialize"):
+            body = json.dumps(data).encode()
+        response_cache.put((key, version), body)
+    return web.Response(body=body, content_type="application/json", headers=headers)
@@ -0,0 +1,199 @@
+"""
+Durable inbound queue for bot-api updates. Polling appends each getUpdates
+batch to SQLite together with the next offset (so Telegram is acknowledged
+right away and a restart resumes where it left off); consumer lanes then
+handle the updates in order per chat, deleting each row only once its
+handler has finished. Handlers must therefore be idempotent.
+
+An update that still fails after inbox_max_attempts is kept as a dead
+letter (status 'failed') rather than dropped; GET /api/admin/inbox lists
+them and POST /api/admin/inbox/replay puts them back in the queue.
+"""
+
+import asyncio
+import json
+
+import aiosqlite
+
+from src.config import inbox_workers, inbox_max_attempts
+from src.log import get_logger
+from src.storage import db_path
+
+log = get_logger("inbox")
+
+
+def _chat_of(update: dict) -> str:
+    for kind in ("message", "edited_message", "message_reaction"):
+        if kind in update:
+            return str(update[kind].get("chat", {}).get("id", ""))
+    return ""
+
+
+class Inbox:
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._dispatched_upto = 0
+        self._inflight: set[int] = set()  # handed to a lane, not finished yet
+        self._rewind: int | None = None   # lowest replayed update_id, for run() to go back to
+        # caps how many updates sit parsed in memory ahead of the handlers
+        self._slots = asyncio.Semaphore(1000)
+
+    async def init(self):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS inbox (
+                    update_id INTEGER PRIMARY KEY,
+                    chat_id TEXT,
+                    payload TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'pending',
+                    error TEXT
+                )
+            """)
+            async with db.execute("PRAGMA table_info(inbox)") as cursor:
+                columns = {r[1] for r in await cursor.fetchall()}
+            if "status" not in columns:
+                await db.execute("ALTER TABLE inbox ADD COLUMN status TEXT DEFAULT 'pending'")
+                await db.execute("ALTER TABLE inbox ADD COLUMN error TEXT")
+            await db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+            await db.commit()
+
+    async def load_offset(self) -> int:
+        """The getUpdates offset persisted by the last append()."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT value FROM state WHERE key = 'updates_offset'") as cursor:
+                row = await cursor.fetchone()
+        return int(row[0]) if row else 0
+
+    async def append(self, updates: list, next_offset: int):
+        """Store a getUpdates batch and the offset that acknowledges it, atomically."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO inbox (update_id, chat_id, payload) VALUES (?, ?, ?)",
+                [(u["update_id"], _chat_of(u), json.dumps(u)) for u in updates]
+            )
+            await db.execute(
+                "INSERT INTO state (key, value) VALUES ('updates_offset', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (str(next_offset),)
+            )
+            await db.commit()
+        self._wakeup.set()
+
+    async def pending(self) -> int:
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT COUNT(*) FROM inbox WHERE status = 'pending'") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def failed(self, limit=100) -> list[dict]:
+        """Dead letters, oldest first."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(
+                "SELECT update_id, chat_id, attempts, error, payload FROM inbox "
+                "WHERE status = 'failed' ORDER BY update_id LIMIT ?", (limit,)
+            ) as cursor:
+                return [{"update_id": uid, "chat_id": chat_id, "attempts": attempts, "error": error,
+                         "update": json.loads(payload)} async for uid, chat_id, attempts, error, payload in cursor]
+
+    async def replay(self, update_ids: list | None = None) -> int:
+        """Queue dead letters again (all of them, or just update_ids). Returns how many."""
+        if update_ids is not None and not update_ids:
+            return 0
+        where, params = "", ()
+        if update_ids is not None:
+            where = f" AND update_id IN ({','.join('?' for _ in update_ids)})"
+            params = tuple(int(i) for i in update_ids)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(f"SELECT MIN(update_id), COUNT(*) FROM inbox WHERE status = 'failed'{where}",
+                                  params) as cursor:
+                first, count = await cursor.fetchone()
+            await db.execute(f"UPDATE inbox SET status = 'pending', attempts = 0, error = NULL "
+                             f"WHERE status = 'failed'{where}", params)
+            await db.commit()
+        if count:
+            self._rewind = first if self._rewind is None else min(self._rewind, first)
+            self._wakeup.set()
+        return count
+
+    async def run(self, dispatch):
+        """Feed stored updates to `dispatch`, one lane per chat hash so each chat stays ordered."""
+        lanes = [asyncio.Queue() for _ in range(max(1, inbox_workers))]
+        tasks = [asyncio.create_task(self._lane(q, dispatch)) for q in lanes]
+        try:
+            while True:
+                if self._rewind is not None:
+                    # replayed dead letters sit below the rows already dispatched
+                    self._dispatched_upto = min(self._dispatched_upto, self._rewind - 1)
+                    self._rewind = None
+                async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                    async with db.execute(
+                        "SELECT update_id, chat_id, payload, attempts FROM inbox "
+                        "WHERE status = 'pending' AND update_id > ? ORDER BY update_id LIMIT 500",
+                        (self._dispatched_upto,)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+
+                if not rows:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), 5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for update_id, chat_id, payload, attempts in rows:
+                    self._dispatched_upto = update_id
+                    if update_id in self._inflight:
+                        continue  # seen again after a rewind, still being handled
+                    await self._slots.acquire()
+                    self._inflight.add(update_id)
+                    lanes[hash(chat_id) % len(lanes)].put_nowait((update_id, payload, attempts))
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def _lane(self, queue: asyncio.Queue, dispatch):
+        while True:
+            update_id, payload, attempts = await queue.get()
+            update = json.loads(payload)
+            error = None
+            while True:
+                try:
+                    await dispatch(update)
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    attempts += 1
+                    log.warning("update failed: %s", exc, extra={"update_id": update_id, "attempt": attempts})
+                    if attempts >= inbox_max_attempts:
+                        error = str(exc)
+                        break
+                    await self._set_attempts(update_id, attempts)
+                    await asyncio.sleep(min(2 ** attempts, 60))
+            if error is None:
+                await self._done(update_id)
+            else:
+                log.error("update set aside as failed", extra={"update_id": update_id, "attempts": attempts})
+                await self._fail(update_id, attempts, error)
+            self._inflight.discard(update_id)
+            self._slots.release()
+
+    async def _set_attempts(self, update_id: int, attempts: int):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("UPDATE inbox SET attempts = ? WHERE update_id = ?", (attempts, update_id))
+            await db.commit()
+
+    async def _fail(self, update_id: int, attempts: int, error: str):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("UPDATE inbox SET status = 'failed', attempts = ?, error = ? WHERE update_id = ?",
+                             (attempts, error, update_id))
+            await db.commit()
+
+    async def _done(self, update_id: int):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("DELETE FROM inbox WHERE update_id = ?", (update_id,))
+            await db.commit()
+
+
+inbox = Inbox()
@@ -0,0 +1,167 @@
+"""
+Logging. Records are put on a bounded queue by the event loop and written
+by a QueueListener thread, so a slow stdout / journald never stalls
+ingest; when the queue is full records are dropped and counted rather
+than blocking. Levels are set globally (LOG_LEVEL) and per module
+(LOG_LEVELS=handlers=DEBUG,bus=WARNING), and since loggers check their
+level before building a record, disabled debug lines cost one comparison.
+Each call site is rate limited, and LOG_FORMAT=json writes one object per
+line with whatever fields were passed in extra= (chat_id, msg_id, ms, ...).
+"""
+
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+from src.config import (log_level, log_levels, log_format, log_queue_size,
+                        log_rate_limit, log_rate_window)
+
+root = logging.getLogger("telechat")
+
+# attributes every LogRecord has; anything else came from extra=
+_builtin = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for a module: get_logger("handlers") -> telechat.handlers."""
+    return root.getChild(name)
+
+
+def _fields(record) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _builtin and not k.startswith("_")}
+
+
+def _short(name: str) -> str:
+    return name.removeprefix("telechat.")
+
+
+class TextFormatter(logging.Formatter):
+    """`HH:MM:SS LEVEL [module] message key=value ...`"""
+    def format(self, record) -> str:
+        line = f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} " \
+               f"[{_short(record.name)}] {record.getMessage()}"
+        fields = _fields(record)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "module": _short(record.name),
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class RateLimit(logging.Filter):
+    """At most `limit` records per call site (logger + format string) per `window` seconds.
+
+    The first record let through after a quiet spell carries suppressed=N.
+    """
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._sites: dict[tuple, list] = {}  # (name, msg) -> [window start, count, suppressed]
+
+    def filter(self, record) -> bool:
+        if self.limit <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = record.created
+        site = self._sites.get(key)
+        if site is None or now - site[0] >= self.window:
+            suppressed = site[2] if site else 0
+            if len(self._sites) > 10000:
+                self._sites.clear()
+            self._sites[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if site[1] < self.limit:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+class _Enqueue(logging.handlers.QueueHandler):
+    """Never blocks the caller: a full queue drops the record."""
+    dropped = 0
+
+    def prepare(self, record):
+        # render the message now (args may change after we return) but leave
+        # timestamps, field formatting and json to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _Enqueue.dropped += 1
+
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def dropped() -> int:
+    """Records lost to a full queue since startup."""
+    return _Enqueue.dropped
+
+
+def _parse_levels(spec: str) -> dict[str, str]:
+    out = {}
+    for part in spec.split(","):
+        name, _, level = part.strip().partition("=")
+        if name and level:
+            out[name.strip()] = level.strip().upper()
+    return out
+
+
+def setup():
+    """Install the queue handler and start the writer thread. Safe to call twice."""
+    global _listener
+    if _listener is not None:
+        return
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+
+    handler = _Enqueue(queue.Queue(maxsize=log_queue_size))
+    handler.addFilter(RateLimit(log_rate_limit, log_rate_window))
+
+    root.handlers[:] = [handler]
+    root.propagate = False
+    root.setLevel(log_level)
+    for name, level in _parse_levels(log_levels).items():
+        get_logger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, out, respect_handler_level=False)
+    _listener.start()
+
+
+def stop():
+    """Flush what is queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
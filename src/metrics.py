@@ -0,0 +1,225 @@
+"""
+In-process metrics rendered in the Prometheus text format on /metrics.
+Recording is a dict lookup and a couple of additions, nothing is formatted
+until something scrapes the endpoint.
+"""
+
+import asyncio
+import contextvars
+import functools
+import time
+from bisect import bisect_left
+
+from src import tracing
+
+_registry: list = []
+
+# seconds; covers sqlite point reads up to slow telegram uploads
+default_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        out = self._header()
+        for lv, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_fmt_value(v)}")
+        return out
+
+
+class Gauge(_Metric):
+    """A value that is set directly, or read from `fn` at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self._fn = fn
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def render(self) -> list[str]:
+        out = self._header()
+        if self._fn:
+            out.append(f"{self.name} {_fmt_value(self._fn())}")
+        for lv, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {_fmt_value(v)}")
+        return out
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        s = self._series.get(labels)
+        if s is None:
+            s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        s[bisect_left(self.buckets, value)] += 1
+        s[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        out = self._header()
+        for lv, s in sorted(self._series.items()):
+            cumulative = 0
+            for i, le in enumerate(self.buckets + ("+Inf",)):
+                cumulative += s[i]
+                le_label = f'le="{le}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le_label)} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {s[-1]!r}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {cumulative}")
+        return out
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "start")
+
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def render(process: str | None = None) -> str:
+    """The exposition for this process. With `process`, every sample gets a process label."""
+    lines = []
+    for m in _registry:
+        lines.extend(m.render())
+    if process:
+        extra = f'process="{_escape(process)}"'
+        lines = [line if line.startswith("#") else _add_label(line, extra) for line in lines]
+    return "\n".join(lines) + "\n"
+
+
+def _add_label(line: str, label: str) -> str:
+    end = min(i for i in (line.find("{"), line.find(" ")) if i >= 0)
+    if line[end] == "{":
+        return f"{line[:end + 1]}{label},{line[end + 1:]}"
+    return f"{line[:end]}{{{label}}}{line[end:]}"
+
+
+def merge(*texts: str) -> str:
+    """Several expositions as one, each family's HELP / TYPE once with the samples of all of them."""
+    families: dict[str, list] = {}
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                current = line.split(" ", 3)[2]
+                family = families.setdefault(current, [[], []])
+                if len(family[0]) < 2:
+                    family[0].append(line)
+            elif line and current is not None:
+                families[current][1].append(line)
+    return "\n".join(line for head, samples in families.values() for line in head + samples) + "\n"
+
+
+# span an instrumented call is already recording, so nested calls don't count the same time twice
+_open_span: contextvars.ContextVar[str | None] = contextvars.ContextVar("open_span", default=None)
+
+
+def instrument(cls, hist: Histogram, span: str | None = None):
+    """Time every public coroutine method of `cls` into `hist`, labelled by method name.
+
+    With `span`, the time is also added to the current request trace under that name,
+    once: a method called from another instrumented one only shows up in `hist`.
+    """
+    for name, fn in list(vars(cls).items()):
+        if name.startswith("_") or not asyncio.iscoroutinefunction(fn):
+            continue
+
+        def wrap(fn, name=name):
+            @functools.wraps(fn)
+            async def timed(*args, **kwargs):
+                outer = span is not None and _open_span.get() != span
+                token = _open_span.set(span) if outer else None
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    hist.observe(elapsed, name)
+                    if outer:
+                        _open_span.reset(token)
+                        tracing.record(span, elapsed)
+            return timed
+
+        setattr(cls, name, wrap(fn))
+    return cls
+
+
+# hot paths
+
+storage_seconds = Histogram("telechat_storage_seconds", "Storage method latency", ("method",))
+bot_api_seconds = Histogram("telechat_bot_api_seconds", "Bot API call latency", ("method", "status"))
+handler_seconds = Histogram("telechat_handler_seconds", "Incoming message handling latency", ("source",))
+ws_fanout_seconds = Histogram("telechat_ws_fanout_seconds", "Time to queue one event for every websocket client")
+ws_fanout_clients = Histogram("telechat_ws_fanout_clients", "Websocket clients an event was queued for",
+                              buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+media_download_seconds = Histogram("telechat_media_download_seconds", "Media download duration")
+media_download_bytes = Counter("telechat_media_download_bytes_total", "Bytes of media downloaded")
+polling_lag_seconds = Histogram("telechat_polling_lag_seconds",
+                                "Delay between a message being sent and this process receiving it",
+                                buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+loop_lag_seconds = Histogram("telechat_event_loop_lag_seconds", "How late the event loop ran a scheduled wakeup",
+                             buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+
+
+async def watch_loop_lag(interval: float = 0.5):
+    """Measure event-loop stalls by how late a fixed sleep wakes up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - start - interval))
@@ -0,0 +1,324 @@
+"""
+Durable outbound queue. A send from the web UI is stored as an outbox row
+plus a pending message (msg_id = -outbox id) and the request returns right
+away; sender lanes deliver the rows in order per chat, then swap the
+pending message for the real one and emit message_confirmed, or
+message_failed once the attempts run out.
+
+A send that fails is not retried inside its lane: the row gets a
+next_attempt_at (Telegram's retry_after for flood errors, backoff
+otherwise) and the chat is parked until then, its later sends waiting
+behind it, so the lane goes on with other chats meanwhile.
+
+client_id makes a send idempotent: the same client_id posted twice returns
+the first message instead of sending again. The Telegram msg_id is stored
+on the row as soon as the send returns, so a restart between sending and
+reconciling doesn't send twice.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from pathlib import Path
+
+import aiosqlite
+
+from src import fileio
+from src.broadcast import _retry_after
+from src.clients import bot
+from src.config import data_dir, outbox_workers, outbox_max_attempts
+from src.handlers import _notify_ws, _notify_chat
+from src.log import get_logger
+from src.storage import storage, db_path
+
+log = get_logger("outbox")
+
+# uploads for chats that have no media folder wait here until sent
+outbox_dir = data_dir / "outbox"
+
+# delivered rows kept around so a late duplicate POST still finds its message
+_keep_sent = 1000
+
+
+class Outbox:
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._dispatched_upto = 0
+        self._lanes: list[asyncio.Queue] = []
+        self._inflight: set[int] = set()
+        self._discarded: set[int] = set()
+        # chat_id -> its rows waiting for the first one's next attempt, in order
+        self._parked: dict[str, list] = {}
+        self._sent_since_trim = 0
+
+    async def init(self):
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_id TEXT UNIQUE,
+                    chat_id TEXT,
+                    payload TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'pending',
+                    sent_id INTEGER,
+                    error TEXT,
+                    next_attempt_at REAL
+                )
+            """)
+            async with db.execute("PRAGMA table_info(outbox)") as cursor:
+                if "next_attempt_at" not in {r[1] for r in await cursor.fetchall()}:
+                    await db.execute("ALTER TABLE outbox ADD COLUMN next_attempt_at REAL")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, id)")
+            await db.commit()
+
+    async def enqueue(self, chat_id, message: dict, send: dict, client_id: str | None = None) -> dict:
+        """Queue a send and store its pending message. Returns the message as stored.
+
+        `send` is {"kind": "text", "text", "reply_to"} or {"kind": "file", "path", "caption", "reply_to"}.
+        """
+        uid = str(chat_id)
+        client_id = client_id or uuid.uuid4().hex
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            # a concurrent POST with the same client_id waits on our write lock, then finds our row
+            cursor = await db.execute("INSERT INTO outbox (client_id, chat_id) VALUES (?, ?) "
+                                      "ON CONFLICT(client_id) DO NOTHING", (client_id, uid))
+            if not cursor.rowcount:
+                async with db.execute("SELECT payload FROM outbox WHERE client_id = ?", (client_id,)) as cursor:
+                    row = await cursor.fetchone()
+                return json.loads(row[0])["message"]
+            message = {**message, "msg_id": -cursor.lastrowid, "client_id": client_id, "status": "pending"}
+            await db.execute("UPDATE outbox SET payload = ? WHERE id = ?",
+                             (json.dumps({"message": message, "send": send}), cursor.lastrowid))
+            await db.commit()
+
+        await storage.save_message(uid, message)
+        await _notify_ws({"type": "message_sent", "user_id": int(uid), "message": message})
+        await _notify_chat(uid, message)
+        self._wakeup.set()
+        return message
+
+    async def find(self, client_id: str) -> dict | None:
+        """The message already queued (or sent) under client_id, if any."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT payload FROM outbox WHERE client_id = ?", (client_id,)) as cursor:
+                row = await cursor.fetchone()
+        return json.loads(row[0])["message"] if row else None
+
+    async def retry(self, client_id: str) -> dict | None:
+        """Put a failed send back in the queue. Returns its pending message."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT id, chat_id, payload FROM outbox WHERE client_id = ? AND status = 'failed'",
+                                  (client_id,)) as cursor:
+                row = await cursor.fetchone()
+            if not row:
+                return None
+            row_id, uid, payload = row
+            job = json.loads(payload)
+            job["message"]["status"] = "pending"
+            job["message"].pop("error", None)
+            payload = json.dumps(job)
+            await db.execute("UPDATE outbox SET status = 'pending', attempts = 0, error = NULL, "
+                             "next_attempt_at = NULL, payload = ? WHERE id = ?", (payload, row_id))
+            await db.commit()
+
+        await storage.save_message(uid, job["message"])
+        await _notify_ws({"type": "message_sent", "user_id": int(uid), "message": job["message"]})
+        # already behind the dispatcher's cursor, so hand it to its lane directly
+        self._dispatch((row_id, uid, payload, 0, None, None))
+        return job["message"]
+
+    async def discard(self, temp_ids: list):
+        """Drop queued sends whose pending messages were deleted before they went out."""
+        ids = [-int(t) for t in temp_ids if int(t) < 0]
+        if not ids:
+            return
+        # a lane already working on one checks this before sending and again once it is sent
+        self._discarded.update(i for i in ids if i in self._inflight)
+        placeholders = ",".join("?" for _ in ids)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute(f"DELETE FROM outbox WHERE id IN ({placeholders}) AND sent_id IS NULL", ids)
+            await db.commit()
+
+    async def pending(self) -> int:
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'") as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def run(self):
+        """Deliver queued sends, one lane per chat hash so each chat stays ordered."""
+        self._lanes = [asyncio.Queue() for _ in range(max(1, outbox_workers))]
+        tasks = [asyncio.create_task(self._lane(q)) for q in self._lanes]
+        try:
+            while True:
+                self._wakeup.clear()
+                async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                    async with db.execute(
+                        "SELECT id, chat_id, payload, attempts, sent_id, next_attempt_at FROM outbox "
+                        "WHERE status = 'pending' AND id > ? ORDER BY id LIMIT 500",
+                        (self._dispatched_upto,)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+
+                if not rows:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), 5)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                for row in rows:
+                    self._dispatched_upto = row[0]
+                    self._dispatch(row)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def _lane_of(self, chat_id: str) -> asyncio.Queue:
+        return self._lanes[hash(chat_id) % len(self._lanes)]
+
+    def _dispatch(self, row: tuple):
+        row_id, chat_id, next_attempt_at = row[0], row[1], row[5]
+        if row_id in self._inflight or not self._lanes:
+            return
+        self._inflight.add(row_id)
+        if next_attempt_at and next_attempt_at > time.time():
+            # backing off from before a restart
+            self._park(row, next_attempt_at - time.time())
+        else:
+            self._lane_of(chat_id).put_nowait(row)
+
+    def _park(self, row: tuple, delay: float):
+        """Hold a chat's sends until `row` may be tried again; it goes first when they resume."""
+        chat_id = row[1]
+        self._parked.setdefault(chat_id, []).insert(0, row)
+        # resumed through the lane, so sends of the chat queued there meanwhile stay behind
+        asyncio.get_running_loop().call_later(delay, self._lane_of(chat_id).put_nowait, (None, chat_id))
+
+    async def _lane(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item[0] is None:
+                rows = self._parked.pop(item[1], [])
+            elif item[1] in self._parked:
+                self._parked[item[1]].append(item)
+                continue
+            else:
+                rows = [item]
+            for i, row in enumerate(rows):
+                if await self._attempt(row):
+                    self._parked[row[1]].extend(rows[i + 1:])
+                    break
+
+    async def _attempt(self, row: tuple) -> bool:
+        """Try one send. Returns True if it was parked for a later attempt."""
+        row_id, chat_id, payload, attempts, sent_id, _ = row
+        parked = False
+        try:
+            parked = await self._deliver(row_id, chat_id, payload, attempts, sent_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("outbox row failed", extra={"chat_id": chat_id, "outbox_id": row_id})
+        finally:
+            if not parked:
+                self._inflight.discard(row_id)
+                self._discarded.discard(row_id)
+        return parked
+
+    async def _deliver(self, row_id: int, chat_id: str, payload: str, attempts: int, sent_id: int | None) -> bool:
+        job = json.loads(payload)
+        message, send = job["message"], job["send"]
+        if sent_id is None:
+            if row_id in self._discarded:
+                return False
+            try:
+                sent = await self._send(chat_id, send)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                attempts += 1
+                log.warning("send failed: %s", exc,
+                            extra={"chat_id": chat_id, "client_id": message["client_id"], "attempt": attempts})
+                if attempts >= outbox_max_attempts:
+                    await self._fail(row_id, chat_id, message, send, str(exc))
+                    return False
+                delay = float(_retry_after(exc) or min(2 ** attempts, 60))
+                await self._update(row_id, attempts=attempts, error=str(exc), next_attempt_at=time.time() + delay)
+                self._park((row_id, chat_id, payload, attempts, None, None), delay)
+                return True
+            sent_id = sent.id
+            if row_id not in self._discarded:
+                await self._update(row_id, sent_id=sent_id)
+        if row_id in self._discarded:
+            await self._recall(row_id, chat_id, message, send, sent_id)
+            return False
+        await self._confirm(row_id, chat_id, message, send, sent_id)
+        return False
+
+    async def _recall(self, row_id: int, chat_id: str, message: dict, send: dict, sent_id: int):
+        """The pending message was deleted while its send was in flight: delete it on Telegram too."""
+        try:
+            await bot.delete_messages(int(chat_id), [sent_id])
+        except Exception as exc:
+            log.warning("could not delete a send discarded in flight: %s", exc,
+                        extra={"chat_id": chat_id, "client_id": message["client_id"], "msg_id": sent_id})
+        if send["kind"] == "file":
+            await fileio.unlink(Path(send["path"]))
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            await db.commit()
+
+    async def _send(self, chat_id: str, send: dict):
+        if send["kind"] == "file":
+            return await bot.send_file(int(chat_id), send["path"], caption=send.get("caption") or None,
+                                       reply_to=send.get("reply_to"))
+        return await bot.send_message(int(chat_id), send["text"], reply_to=send.get("reply_to"))
+
+    async def _confirm(self, row_id: int, chat_id: str, message: dict, send: dict, sent_id: int):
+        temp_id = message["msg_id"]
+        confirmed = {**message, "msg_id": sent_id}
+        confirmed.pop("status", None)
+        confirmed.pop("error", None)
+
+        if send["kind"] == "file":
+            path = Path(send["path"])
+            if message.get("media_file"):
+                # the upload already sits in the chat's media folder, give it its real name
+                name = f"{sent_id}{path.suffix}"
+                if await fileio.exists(path):
+                    await fileio.rename(path, path.with_name(name))
+                confirmed["media_file"] = name
+            else:
+                await fileio.unlink(path)
+
+        await storage.confirm_message(chat_id, temp_id, confirmed)
+        await self._update(row_id, status="sent", payload=json.dumps({"message": confirmed, "send": send}))
+        await _notify_ws({"type": "message_confirmed", "user_id": int(chat_id),
+                          "client_id": message["client_id"], "temp_id": temp_id, "message": confirmed})
+        await _notify_chat(chat_id, confirmed)
+
+        self._sent_since_trim += 1
+        if self._sent_since_trim >= 100:
+            self._sent_since_trim = 0
+            async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                await db.execute("DELETE FROM outbox WHERE status = 'sent' AND id <= ?", (row_id - _keep_sent,))
+                await db.commit()
+
+    async def _fail(self, row_id: int, chat_id: str, message: dict, send: dict, error: str):
+        failed = {**message, "status": "failed", "error": error}
+        await self._update(row_id, status="failed", error=error,
+                           payload=json.dumps({"message": failed, "send": send}))
+        await storage.save_message(chat_id, failed)
+        await _notify_ws({"type": "message_failed", "user_id": int(chat_id), "client_id": message["client_id"],
+                          "temp_id": message["msg_id"], "error": error})
+
+    async def _update(self, row_id: int, **fields):
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            await db.execute(f"UPDATE outbox SET {cols} WHERE id = ?", (*fields.values(), row_id))
+            await db.commit()
+
+
+outbox = Outbox()
@@ -0,0 +1,68 @@
+"""
+Compact in-memory records. A slotted object costs a fraction of a dict
+with the same keys, which matters once thousands of chats are cached.
+Records keep the mapping interface the rest of the code already uses
+(rec["key"], rec.get(), {**rec}) and convert to a plain dict for JSON.
+"""
+
+
+class UserRecord:
+    """One row of the users table."""
+    __slots__ = ("user_id", "first_name", "last_name", "username", "full_name", "type",
+                 "folder_name", "unread_count", "last_seen", "last_interaction")
+
+    def __init__(self, user_id, first_name=None, last_name=None, username=None, full_name=None,
+                 type="private", folder_name=None, unread_count=0, last_seen=None, last_interaction=None):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+        self.full_name = full_name
+        self.type = type
+        self.folder_name = folder_name
+        self.unread_count = unread_count
+        self.last_seen = last_seen
+        self.last_interaction = last_interaction
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "UserRecord":
+        """Build from a row or event dict; keys that aren't columns are ignored."""
+        return cls(**{k: d[k] for k in cls.__slots__ if k in d})
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    # mapping interface
+
+    def keys(self):
+        return self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__slots__
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def items(self):
+        return ((k, getattr(self, k)) for k in self.__slots__)
+
+    def update(self, **kwargs):
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_dict()!r})"
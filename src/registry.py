@@ -0,0 +1,78 @@
+"""
+Bounded in-memory view of the users table. The most recently touched
+user_cache_size entries stay in memory; anything else is read back with a
+primary-key lookup on a plain sqlite3 connection, which is cheap enough to
+do synchronously. Every mutation is written through by Storage, so an
+evicted entry can always be reloaded from the database.
+"""
+
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+
+from src.records import UserRecord
+
+
+class UserRegistry:
+    def __init__(self, size: int):
+        self.size = size
+        self._hot: OrderedDict[str, UserRecord] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._columns: list[str] = []
+
+    def attach(self, path: Path):
+        if self._db is not None:
+            self._db.close()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA query_only=ON")
+        self._columns = [r[1] for r in self._db.execute("PRAGMA table_info(users)")]
+        self._hot.clear()
+
+    def warm(self, rows: list[dict]):
+        """Seed the hot set, most recent last so it is evicted last."""
+        self._hot.clear()
+        for row in rows:
+            self._put(row["user_id"], UserRecord.from_dict(row))
+
+    def _load(self, uid: str) -> UserRecord | None:
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT * FROM users WHERE user_id = ?", (uid,)).fetchone()
+        return UserRecord.from_dict(dict(zip(self._columns, row))) if row else None
+
+    def _put(self, uid: str, info: UserRecord):
+        self._hot[uid] = info
+        self._hot.move_to_end(uid)
+        while len(self._hot) > self.size:
+            self._hot.popitem(last=False)
+
+    def get(self, uid, default=None) -> UserRecord | None:
+        uid = str(uid)
+        info = self._hot.get(uid)
+        if info is not None:
+            self._hot.move_to_end(uid)
+            return info
+        info = self._load(uid)
+        if info is None:
+            return default
+        self._put(uid, info)
+        return info
+
+    def __getitem__(self, uid) -> UserRecord:
+        info = self.get(uid)
+        if info is None:
+            raise KeyError(uid)
+        return info
+
+    def __setitem__(self, uid, info):
+        self._put(str(uid), info if isinstance(info, UserRecord) else UserRecord.from_dict(info))
+
+    def __contains__(self, uid) -> bool:
+        return self.get(uid) is not None
+
+    def pop(self, uid, default=None):
+        return self._hot.pop(str(uid), default)
+
+    def __len__(self) -> int:
+        """Entries currently in memory, not the size of the table."""
+        return len(self._hot)
@@ -0,0 +1,222 @@
+"""
+Retention. Rules (RETENTION_RULES, a json list) delete old messages, or
+only their media files, by chat type, media type and age:
+
+    [{"older_than_days": 730},
+     {"chat_type": "group", "older_than_days": 90},
+     {"media_type": "video", "older_than_days": 30, "drop": "media"}]
+
+chat_type is private, group or all; media_type is photo, video, audio,
+document, voice, sticker, ... or any; drop is message (default) or media.
+A background pass applies every rule to the hot table and the archive in
+small transactions and removes the media files of what it purged.
+
+Freed pages are handed back to the filesystem with incremental_vacuum,
+one step at a time. Each step is sized to stay under vacuum_step_ms and
+followed by a pause as long as the step, so writers never queue behind a
+long vacuum. New databases are created with auto_vacuum=INCREMENTAL; an
+older one is converted with a single VACUUM at startup when it is small
+enough, otherwise a warning says how to do it offline.
+"""
+
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import aiosqlite
+
+from src import fileio
+from src.archive import archive, archive_path
+from src.config import (retention_rules, retention_interval_minutes, retention_batch,
+                        vacuum_step_ms, vacuum_convert_max_mb)
+from src.handlers import _notify_ws
+from src.log import get_logger
+from src.shards import shards
+from src.storage import storage, db_path
+
+log = get_logger("retention")
+
+chat_types = {"private": ("private",), "group": ("group", "supergroup"), "all": None}
+drops = ("message", "media")
+
+
+def parse_rules(spec: str) -> list[dict]:
+    """Validate RETENTION_RULES. Raises ValueError on anything it doesn't understand."""
+    if not spec.strip():
+        return []
+    try:
+        rules = json.loads(spec)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"RETENTION_RULES is not valid json: {exc}")
+    if not isinstance(rules, list):
+        raise ValueError("RETENTION_RULES must be a list of rules")
+    out = []
+    for rule in rules:
+        days = rule.get("older_than_days")
+        if not isinstance(days, (int, float)) or days <= 0:
+            raise ValueError(f"rule needs older_than_days > 0: {rule}")
+        chat_type = rule.get("chat_type", "all")
+        if chat_type not in chat_types:
+            raise ValueError(f"chat_type must be one of {', '.join(chat_types)}: {rule}")
+        drop = rule.get("drop", "message")
+        if drop not in drops:
+            raise ValueError(f"drop must be message or media: {rule}")
+        out.append({"older_than_days": days, "chat_type": chat_type,
+                    "media_type": rule.get("media_type", "any"), "drop": drop})
+    return out
+
+
+def _matcher(rule: dict):
+    media_type, media_only = rule["media_type"], rule["drop"] == "media"
+
+    def match(msg: dict) -> bool:
+        if msg["msg_id"] <= 0:
+            return False  # still in the outbox
+        if media_type != "any" and msg.get("media_type") != media_type:
+            return False
+        return not media_only or bool(msg.get("media_file"))
+    return match
+
+
+class Retention:
+    def __init__(self):
+        self.rules: list[dict] = []
+
+    async def init(self):
+        self.rules = parse_rules(retention_rules)
+        for path in (db_path, archive_path):
+            await self._ensure_incremental(Path(path))
+
+    async def _ensure_incremental(self, path: Path):
+        async with aiosqlite.connect(path, timeout=30.0) as db:
+            async with db.execute("PRAGMA auto_vacuum") as cursor:
+                mode = (await cursor.fetchone())[0]
+            if mode == 2:
+                return
+            size_mb = path.stat().st_size / 2 ** 20
+            if size_mb > vacuum_convert_max_mb:
+                log.warning("%s cannot give space back until it is converted; with the bot stopped run: "
+                            "sqlite3 %s 'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;'", path.name, path,
+                            extra={"size_mb": round(size_mb)})
+                return
+            start = time.perf_counter()
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+            log.info("switched %s to incremental vacuum", path.name,
+                     extra={"size_mb": round(size_mb), "ms": round((time.perf_counter() - start) * 1000)})
+
+    async def run(self):
+        """Apply the rules and reclaim free pages every retention_interval_minutes."""
+        while True:
+            try:
+                purged = await self.apply()
+                if purged:
+                    log.info("retention pass", extra={"purged": purged})
+                for path in (db_path, archive_path, *shards.files()):
+                    pages = await self.vacuum(path)
+                    if pages:
+                        log.info("reclaimed free pages", extra={"db": Path(path).name, "pages": pages})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("retention pass failed")
+            await asyncio.sleep(retention_interval_minutes * 60)
+
+    async def apply(self) -> int:
+        """One pass over every rule. Returns how many messages were purged or stripped."""
+        total = 0
+        for rule in self.rules:
+            before = (datetime.now() - timedelta(days=rule["older_than_days"])).isoformat()
+            for uid in await self._chats(rule["chat_type"]):
+                total += await self._apply_hot(uid, rule, before)
+                total += await self._apply_cold(uid, rule, before)
+        return total
+
+    async def _chats(self, chat_type: str) -> list[str]:
+        types = chat_types[chat_type]
+        where = ""
+        if types:
+            where = f"WHERE COALESCE(type, 'private') IN ({','.join('?' for _ in types)})"
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(f"SELECT user_id FROM users {where}", types or ()) as cursor:
+                return [r[0] for r in await cursor.fetchall()]
+
+    async def _apply_hot(self, uid: str, rule: dict, before: str) -> int:
+        match, media_only = _matcher(rule), rule["drop"] == "media"
+        where = "chat_id = ? AND timestamp < ? AND msg_id > 0"
+        params = [uid, before]
+        if rule["media_type"] != "any":
+            where += " AND json_extract(payload, '$.media_type') = ?"
+            params.append(rule["media_type"])
+        if media_only:
+            where += " AND json_extract(payload, '$.media_file') IS NOT NULL"
+        done = 0
+        while True:
+            async with shards.writer(uid) as db:
+                async with db.execute(f"SELECT payload FROM messages WHERE {where} LIMIT ?",
+                                      (*params, retention_batch)) as cursor:
+                    msgs = [m for m in (json.loads(r[0]) for r in await cursor.fetchall()) if match(m)]
+                if not msgs:
+                    return done
+                if media_only:
+                    await db.executemany(
+                        "UPDATE messages SET payload = ? WHERE chat_id = ? AND msg_id = ?",
+                        [(json.dumps({**m, "media_file": None, "media_expired": True}), uid, m["msg_id"])
+                         for m in msgs])
+                else:
+                    await db.executemany("DELETE FROM messages WHERE chat_id = ? AND msg_id = ?",
+                                         [(uid, m["msg_id"]) for m in msgs])
+                await db.commit()
+            await self._purged(uid, msgs, media_only)
+            done += len(msgs)
+            if len(msgs) < retention_batch:
+                return done
+            await asyncio.sleep(0.05)
+
+    async def _apply_cold(self, uid: str, rule: dict, before: str) -> int:
+        media_only = rule["drop"] == "media"
+        msgs = await archive.purge(uid, before, _matcher(rule), strip_media=media_only)
+        if msgs:
+            await self._purged(uid, msgs, media_only)
+        return len(msgs)
+
+    async def _purged(self, uid: str, msgs: list, media_only: bool):
+        folder = storage.get_user_folder(uid)
+        if folder:
+            files = [folder / "media" / m["media_file"] for m in msgs if m.get("media_file")]
+            if files:
+                await fileio.unlink(*files)
+        storage.touch_chat(uid)
+        if not media_only:
+            await _notify_ws({"type": "messages_deleted", "user_id": int(uid),
+                              "msg_ids": [m["msg_id"] for m in msgs]})
+
+    async def vacuum(self, path) -> int:
+        """Give free pages back in paced incremental_vacuum steps. Returns pages freed."""
+        pages, freed = 64, 0
+        async with aiosqlite.connect(path, timeout=30.0) as db:
+            while True:
+                async with db.execute("PRAGMA freelist_count") as cursor:
+                    free = (await cursor.fetchone())[0]
+                if not free:
+                    break
+                step = min(pages, free)
+                start = time.perf_counter()
+                # executescript steps the pragma to completion; execute() would free a single page
+                await db.executescript(f"PRAGMA incremental_vacuum({step});")
+                ms = (time.perf_counter() - start) * 1000
+                freed += step
+                if ms < vacuum_step_ms / 2:
+                    pages = min(pages * 2, 16384)
+                elif ms > vacuum_step_ms:
+                    pages = max(pages // 2, 8)
+                await asyncio.sleep(max(ms / 1000, 0.005))
+            if freed:
+                # the file shrinks once the wal is checkpointed
+                await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return freed
+
+
+retention = Retention()
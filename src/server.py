@@ -1,19 +1,38 @@
 """aiohttp web server with REST API, WebSocket, and static files."""
 
+import asyncio
 import json
 import mimetypes
-import shutil
-import tempfile
+import uuid
 from datetime import datetime
 from pathlib import Path
 
 import aiohttp
 from aiohttp import web
 
+from src.acl import acl, lists as acl_lists
+from src.assets import AssetStore, respond, revalidate
+from src.avatars import avatars
+from src.broadcast import broadcasts, broadcast_dir
 from src.clients import bot, is_http_bot
-from src.config import messages_per_load, base_dir, data_dir
-from src.handlers import ws_clients, _notify_ws
-from src.storage import storage
+from src import fileio
+from src.config import (messages_per_load, users_per_page, base_dir, avatar_max_age, avatar_miss_ttl_minutes,
+                        ws_heartbeat, ws_compress, change_log_size, profile_max_seconds,
+                        web_workers, is_web_worker, worker_index)
+from src.handlers import _notify_ws, _notify_chat
+from src.inbox import inbox
+from src.http_cache import cached_json
+from src.log import get_logger, dropped as log_dropped
+from src.outbox import outbox, outbox_dir
+from src.shards import shards
+from src.snapshots import snapshots
+from src import metrics
+from src.storage import storage, message_cursor
+from src.tracing import trace_middleware, profiler, span
+from src import ws_hub
+from src.ws_hub import WsClient, ws_clients, coalesce
+
+log = get_logger("server")
 
 # register missing mimetypes
 mimetypes.add_type("image/webp", ".webp")
@@ -21,81 +40,143 @@ mimetypes.add_type("video/webm", ".webm")
 mimetypes.add_type("application/x-tgsticker", ".tgs")
 
 web_dir = base_dir / "web"
-avatar_dir = data_dir / "avatars"
-avatar_dir.mkdir(exist_ok=True)
+assets = AssetStore(web_dir)
 
 _bot_info_cache: dict | None = None
 
 
+def json_response(data, **kwargs):
+    """web.json_response, with the encoding time counted in the request trace."""
+    with span("serialize"):
+        return web.json_response(data, **kwargs)
+
+
 # static / index
 
 async def index(request):
-    return web.FileResponse(web_dir / "index.html")
+    return respond(request, assets.index, revalidate)
 
 
 async def static_handler(request):
-    rel = request.match_info.get("path", "")
-    fp = web_dir / rel
-    if fp.exists() and fp.is_file():
-        return web.FileResponse(fp)
-    raise web.HTTPNotFound()
+    found = assets.get(request.match_info.get("path", ""))
+    if not found:
+        raise web.HTTPNotFound()
+    return respond(request, *found)
 
 
 # rest api
 
 async def api_get_users(request):
-    from src.config import banned_users
-    users = storage.get_all_users()
-    result = []
-    for uid, u in users.items():
-        msgs, _ = await storage.get_messages(uid, offset=0, limit=1)
-        last = msgs[0] if msgs else None
-        result.append({**u, "last_message": last, "is_banned": int(uid) in banned_users})
-    result.sort(key=lambda x: x.get("last_seen", ""), reverse=True)
-    return web.json_response(result)
+    """A page of the chat list: ?offset, ?limit, ?sort=recent|name, ?q=<name or username>."""
+    offset = max(int(request.query.get("offset", 0)), 0)
+    limit = min(max(int(request.query.get("limit", users_per_page)), 1), 200)
+    sort = request.query.get("sort", "recent")
+    q = request.query.get("q", "").strip()
+
+    async def build():
+        users, total = await storage.list_users(offset, limit, sort, q)
+        last = await storage.last_messages([u["user_id"] for u in users])
+        return {
+            "users": [{**u, "last_message": last.get(u["user_id"]), "is_banned": acl.is_banned(u["user_id"])}
+                      for u in users],
+            "total": total,
+            "has_more": offset + len(users) < total,
+        }
+
+    key = ("users", offset, limit, sort, q)
+    return await cached_json(request, key, storage.list_version(), build)
 
 
 async def api_get_messages(request):
+    """History of a chat. By offset from the newest end, or a keyed window:
+    around=<msg_id>, at=<date>, before=<cursor>, after=<cursor>."""
     uid = request.match_info["user_id"]
+    limit = min(int(request.query.get("limit", messages_per_load)), 200)
+    window = {k: request.query[k] for k in ("around", "at", "before", "after") if request.query.get(k)}
+
+    if window:
+        async def build():
+            try:
+                data = await storage.get_window(uid, limit=limit, **window)
+            except ValueError as exc:
+                raise web.HTTPBadRequest(text=json.dumps({"status": "error", "error": str(exc)}),
+                                         content_type="application/json")
+            if data is None:
+                raise web.HTTPNotFound(text=json.dumps({"status": "error", "error": "message not found"}),
+                                       content_type="application/json")
+            return data
+
+        key = ("window", uid, limit, *sorted(window.items()))
+        return await cached_json(request, key, storage.chat_version(uid), build)
+
     offset = int(request.query.get("offset", 0))
-    limit = int(request.query.get("limit", messages_per_load))
-    msgs, total = await storage.get_messages(uid, offset, limit)
-    return web.json_response({
-        "messages": msgs, "total": total,
-        "offset": offset, "limit": limit,
-        "has_more": (offset + limit) < total,
-    })
+
+    async def build():
+        msgs, total = await storage.get_messages(uid, offset, limit)
+        return {
+            "messages": msgs, "total": total,
+            "offset": offset, "limit": limit,
+            "has_more": (offset + limit) < total,
+            # cursors, so a client can continue with before= / after=
+            "before": message_cursor(msgs[0]) if msgs else None,
+            "after": message_cursor(msgs[-1]) if msgs else None,
+        }
+
+    return await cached_json(request, ("messages", uid, offset, limit), storage.chat_version(uid), build)
+
+
+def _client_id(value) -> str:
+    """The browser's id for a send, or a fresh one. Also used in file names, so keep it plain."""
+    value = str(value or "")
+    if value and len(value) <= 64 and all(c.isalnum() or c in "-_" for c in value):
+        return value
+    return uuid.uuid4().hex
+
+
+def _media_type(file_name: str) -> str:
+    mime, _ = mimetypes.guess_type(file_name)
+    mime = mime or ""
+    if mime.startswith("image"):
+        return "photo"
+    if mime.startswith("video"):
+        return "video"
+    if mime.startswith("audio"):
+        return "audio"
+    return "document"
+
+
+def _outgoing(text, reply_to, media_type=None, media_file=None) -> dict:
+    return {
+        "direction": "out",
+        "text": text,
+        "timestamp": datetime.now().isoformat(),
+        "media_type": media_type, "media_file": media_file,
+        "reply_to": reply_to,
+        "forwarded_from": None,
+        "forwarded_from_username": None,
+        "source": "bot",
+    }
 
 
 async def api_send_message(request):
+    """Queue a text message; it is stored as pending and delivered by the outbox."""
     data = await request.json()
     uid = int(data["user_id"])
     text = data.get("text", "")
     reply_to = data.get("reply_to")
 
-    try:
-        sent = await bot.send_message(uid, text, reply_to=reply_to)
-        msg_data = {
-            "msg_id": sent.id,
-            "direction": "out",
-            "text": text,
-            "timestamp": datetime.now().isoformat(),
-            "media_type": None, "media_file": None,
-            "reply_to": reply_to,
-            "forwarded_from": None,
-            "forwarded_from_username": None,
-            "source": "bot",
-        }
-        await storage.save_message(uid, msg_data)
-        await _notify_ws({"type": "message_sent", "user_id": uid, "message": msg_data})
-        return web.json_response({"status": "ok", "message": msg_data})
-    except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=500)
+    msg_data = await outbox.enqueue(
+        uid, _outgoing(text, reply_to),
+        {"kind": "text", "text": text, "reply_to": reply_to},
+        client_id=_client_id(data.get("client_id")),
+    )
+    return json_response({"status": "ok", "message": msg_data})
 
 
 async def api_upload(request):
+    """Store an upload next to the chat's media and queue it like a text send."""
     reader = await request.multipart()
-    uid = reply_to = None
+    uid = reply_to = client_id = None
     caption = ""
     file_data = file_name = None
 
@@ -107,52 +188,42 @@ async def api_upload(request):
             reply_to = int(v) if v else None
         elif part.name == "caption":
             caption = await part.text()
+        elif part.name == "client_id":
+            client_id = await part.text()
         elif part.name == "file":
             file_name = part.filename
             file_data = await part.read()
 
-    if not uid or not file_data:
-        return web.json_response({"status": "error", "error": "missing data"}, status=400)
+    if not uid or not file_data or not file_name:
+        return json_response({"status": "error", "error": "missing data"}, status=400)
 
-    tmp = Path(tempfile.mkdtemp()) / file_name
-    tmp.write_bytes(file_data)
+    client_id = _client_id(client_id)
+    # a repeated POST must not write the file again: the first one may already be sent and renamed
+    existing = await outbox.find(client_id)
+    if existing:
+        return json_response({"status": "ok", "message": existing})
+    ext = Path(file_name).suffix
+    folder = storage.get_user_folder(uid)
+    # the pending message can show its media straight away; unknown chats just queue the file
+    media_file = f"out_{client_id}{ext}" if folder else None
+    path = folder / "media" / media_file if folder else outbox_dir / f"{client_id}{ext}"
+    await fileio.makedirs(path.parent)
+    await fileio.write_bytes(path, file_data)
 
-    try:
-        sent = await bot.send_file(uid, str(tmp), caption=caption or None, reply_to=reply_to)
-
-        ext = Path(file_name).suffix
-        media_file = f"{sent.id}{ext}"
-        folder = storage.get_user_folder(uid)
-        if folder:
-            (folder / "media").mkdir(exist_ok=True)
-            shutil.copy2(str(tmp), str(folder / "media" / media_file))
-
-        mime, _ = mimetypes.guess_type(file_name)
-        mime = mime or ""
-        if mime.startswith("image"):
-            mt = "photo"
-        elif mime.startswith("video"):
-            mt = "video"
-        elif mime.startswith("audio"):
-            mt = "audio"
-        else:
-            mt = "document"
-
-        msg_data = {
-            "msg_id": sent.id, "direction": "out",
-            "text": caption, "timestamp": datetime.now().isoformat(),
-            "media_type": mt, "media_file": media_file,
-            "reply_to": reply_to,
-            "forwarded_from": None, "forwarded_from_username": None,
-            "source": "bot",
-        }
-        await storage.save_message(uid, msg_data)
-        await _notify_ws({"type": "message_sent", "user_id": uid, "message": msg_data})
-        return web.json_response({"status": "ok", "message": msg_data})
-    except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=500)
-    finally:
-        shutil.rmtree(tmp.parent, ignore_errors=True)
+    msg_data = await outbox.enqueue(
+        uid, _outgoing(caption, reply_to, _media_type(file_name), media_file),
+        {"kind": "file", "path": str(path), "caption": caption, "reply_to": reply_to},
+        client_id=client_id,
+    )
+    return json_response({"status": "ok", "message": msg_data})
+
+
+async def api_outbox_retry(request):
+    data = await request.json()
+    msg = await outbox.retry(data["client_id"])
+    if msg is None:
+        return json_response({"status": "error", "error": "nothing to retry"}, status=404)
+    return json_response({"status": "ok", "message": msg})
 
 
 async def api_delete_messages(request):
@@ -161,16 +232,23 @@ async def api_delete_messages(request):
     ids = data["msg_ids"]
     for_everyone = data.get("for_everyone", True)
 
-    if for_everyone:
+    # negative ids are sends still in the outbox; they only exist here
+    queued = [i for i in ids if int(i) < 0]
+    if queued:
+        await outbox.discard(queued)
+    sent = [i for i in ids if int(i) > 0]
+
+    if for_everyone and sent:
         try:
-            await bot.delete_messages(int(uid), ids)
+            await bot.delete_messages(int(uid), sent)
         except Exception as exc:
-            print(f"[tg delete] {exc}")
-            return web.json_response({"status": "error", "error": f"Failed to delete in Telegram: {exc}"}, status=400)
+            log.warning("telegram delete failed: %s", exc, extra={"chat_id": uid, "msg_ids": ids})
+            return json_response({"status": "error", "error": f"Failed to delete in Telegram: {exc}"}, status=400)
 
     await storage.delete_messages(uid, ids)
     await _notify_ws({"type": "messages_deleted", "user_id": int(uid), "msg_ids": ids, "for_everyone": for_everyone})
-    return web.json_response({"status": "ok"})
+    await _notify_chat(uid)
+    return json_response({"status": "ok"})
 
 
 async def api_forward_messages(request):
@@ -195,7 +273,7 @@ async def api_forward_messages(request):
             try:
                 if m.get("media_file") and folder:
                     mp = folder / "media" / m["media_file"]
-                    if mp.exists():
+                    if await fileio.exists(mp):
                         sent = await bot.send_file(tid, str(mp), caption=fwd_text or None)
                     else:
                         sent = await bot.send_message(tid, fwd_text)
@@ -213,17 +291,32 @@ async def api_forward_messages(request):
                 }
                 await storage.save_message(tid, md)
                 await _notify_ws({"type": "message_sent", "user_id": tid, "message": md})
+                await _notify_chat(tid, md)
                 results.append({"to": tid, "msg_id": sent.id, "status": "ok"})
             except Exception as exc:
                 results.append({"to": tid, "error": str(exc), "status": "error"})
 
-    return web.json_response({"status": "ok", "results": results})
+    return json_response({"status": "ok", "results": results})
+
+
+async def api_get_changes(request):
+    """Change log entries after ?since=<seq>, for clients catching up after a disconnect."""
+    since = int(request.query.get("since", 0))
+    limit = min(int(request.query.get("limit", 500)), change_log_size)
+    changes, last_seq, reset = await storage.get_changes(since, limit)
+    return json_response({
+        "changes": [] if reset else changes,
+        "last_seq": last_seq,
+        "reset": reset,
+        "has_more": not reset and len(changes) == limit,
+    })
 
 
 async def api_clear_unread(request):
     data = await request.json()
     await storage.clear_unread(data["user_id"])
-    return web.json_response({"status": "ok"})
+    await _notify_chat(data["user_id"])
+    return json_response({"status": "ok"})
 
 
 async def api_media(request):
@@ -233,12 +326,13 @@ async def api_media(request):
     if not folder:
         raise web.HTTPNotFound()
     fp = folder / "media" / fname
-    if not fp.exists():
+    if not await fileio.exists(fp):
         raise web.HTTPNotFound()
     ct, _ = mimetypes.guess_type(fname)
     if not ct:
         ct = "application/octet-stream"
-    return web.Response(body=fp.read_bytes(), content_type=ct)
+    # streamed from disk (sendfile where available) instead of read into memory
+    return web.FileResponse(fp, headers={"Content-Type": ct})
 
 
 async def api_bot_info(request):
@@ -250,27 +344,21 @@ async def api_bot_info(request):
             "name": getattr(me, 'first_name', '') or 'Bot',
             "username": getattr(me, 'username', '') or '',
         }
-    return web.json_response(_bot_info_cache)
+    return json_response(_bot_info_cache)
 
 
 async def api_avatar(request):
     """Serve cached user profile photo."""
-    uid = request.match_info["user_id"]
-    cached = avatar_dir / f"{uid}.jpg"
-
-    if not cached.exists():
-        if is_http_bot:
-            ok = await bot.get_user_profile_photo(int(uid), str(cached))
-        else:
-            try:
-                result = await bot.download_profile_photo(int(uid), file=str(cached))
-                ok = result is not None
-            except Exception:
-                ok = False
-        if not ok:
-            raise web.HTTPNotFound()
+    avatar = await avatars.get(request.match_info["user_id"])
+    if avatar is None:
+        raise web.HTTPNotFound(headers={
+            "Cache-Control": f"private, max-age={avatar_miss_ttl_minutes * 60}"})
 
-    return web.FileResponse(cached)
+    headers = {"ETag": f'"{avatar.etag}"', "Cache-Control": f"private, max-age={avatar_max_age}"}
+    inm = request.if_none_match
+    if inm and any(e.value == avatar.etag for e in inm):
+        raise web.HTTPNotModified(headers=headers)
+    return web.FileResponse(avatar.path, headers=headers)
 
 
 # ── reactions API ──────────────────────────────────────
@@ -297,8 +385,8 @@ async def api_add_reaction(request):
             await bot.set_reaction(uid, msg_id, emoji=emoji)
             await storage.add_reaction(uid, msg_id, emoji, "me")
     except Exception as exc:
-        print(f"[api_react] Failed: {exc}")
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        log.warning("react failed: %s", exc, extra={"chat_id": uid, "msg_id": msg_id})
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
     # Notify web UI
     msg = await storage.get_message_by_id(uid, msg_id)
@@ -308,7 +396,7 @@ async def api_add_reaction(request):
         "msg_id": msg_id,
         "reactions": msg.get("reactions", {}) if msg else {},
     })
-    return web.json_response({"status": "ok"})
+    return json_response({"status": "ok"})
 
 
 async def api_remove_reaction(request):
@@ -321,8 +409,8 @@ async def api_remove_reaction(request):
         await bot.set_reaction(uid, msg_id, emoji=None)
         await storage.remove_reaction(uid, msg_id, "me")
     except Exception as exc:
-        print(f"[api_unreact] Failed: {exc}")
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        log.warning("unreact failed: %s", exc, extra={"chat_id": uid, "msg_id": msg_id})
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
     msg = await storage.get_message_by_id(uid, msg_id)
     await _notify_ws({
@@ -331,7 +419,7 @@ async def api_remove_reaction(request):
         "msg_id": msg_id,
         "reactions": msg.get("reactions", {}) if msg else {},
     })
-    return web.json_response({"status": "ok"})
+    return json_response({"status": "ok"})
 
 
 # ── admin actions API ──────────────────────────────────
@@ -341,9 +429,9 @@ async def api_ban_member(request):
     user_id = int(data["user_id"])
     try:
         await bot.ban_member(chat_id, user_id)
-        return web.json_response({"status": "ok"})
+        return json_response({"status": "ok"})
     except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
 async def api_unban_member(request):
     data = await request.json()
@@ -351,9 +439,9 @@ async def api_unban_member(request):
     user_id = int(data["user_id"])
     try:
         await bot.unban_member(chat_id, user_id)
-        return web.json_response({"status": "ok"})
+        return json_response({"status": "ok"})
     except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
 async def api_pin_message(request):
     data = await request.json()
@@ -361,9 +449,9 @@ async def api_pin_message(request):
     msg_id = int(data["msg_id"])
     try:
         await bot.pin_message(chat_id, msg_id)
-        return web.json_response({"status": "ok"})
+        return json_response({"status": "ok"})
     except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
 async def api_unpin_message(request):
     data = await request.json()
@@ -371,43 +459,128 @@ async def api_unpin_message(request):
     msg_id = int(data["msg_id"])
     try:
         await bot.unpin_message(chat_id, msg_id)
-        return web.json_response({"status": "ok"})
+        return json_response({"status": "ok"})
     except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
-
-from src.config import update_banned_users
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
 async def api_block_user(request):
     data = await request.json()
     user_id = data["user_id"]
-    from src.config import update_banned_users
-    update_banned_users(user_id, block=True)
-    return web.json_response({"status": "ok"})
+    await acl.set("banned", user_id, True)
+    storage.touch_list()
+    await _notify_chat(user_id)
+    return json_response({"status": "ok"})
 
 async def api_unblock_user(request):
     data = await request.json()
     user_id = data["user_id"]
-    from src.config import update_banned_users
-    update_banned_users(user_id, block=False)
-    return web.json_response({"status": "ok"})
+    await acl.set("banned", user_id, False)
+    storage.touch_list()
+    await _notify_chat(user_id)
+    return json_response({"status": "ok"})
+
+# ── access lists API ───────────────────────────────────
+async def api_acl_export(request):
+    name = request.match_info["list"]
+    if name not in acl_lists:
+        raise web.HTTPNotFound()
+    return json_response({"list": name, "ids": acl.export(name)})
+
+
+async def api_acl_import(request):
+    """Bulk update one list in a single transaction: {"ids": [...], "mode": "add"|"remove"|"replace"}."""
+    name = request.match_info["list"]
+    if name not in acl_lists:
+        raise web.HTTPNotFound()
+    data = await request.json()
+    mode = data.get("mode", "add")
+    if mode not in ("add", "remove", "replace"):
+        return json_response({"status": "error", "error": "mode must be add, remove or replace"}, status=400)
+    try:
+        size = await acl.bulk(name, data.get("ids", []), mode)
+    except (TypeError, ValueError):
+        return json_response({"status": "error", "error": "ids must be integers"}, status=400)
+    storage.touch_list()
+    return json_response({"status": "ok", "count": size})
+
+
+async def api_acl_reload(request):
+    """Pick up edits made to the acl table outside the app."""
+    await acl.reload(notify=True)
+    storage.touch_list()
+    return json_response({"status": "ok", "allowed": len(acl.allowed), "banned": len(acl.banned)})
+
+
+async def api_broadcast_create(request):
+    """Start a broadcast. JSON {text, selector: {type, active_days, inactive_days}, dry_run},
+    or multipart with the same fields flattened plus `file`. dry_run only counts the targets."""
+    file_name = file_data = None
+    if request.content_type.startswith("multipart/"):
+        fields = {}
+        async for part in await request.multipart():
+            if part.name == "file":
+                file_name, file_data = part.filename, await part.read()
+            else:
+                fields[part.name] = await part.text()
+        selector = {k: fields[k] for k in ("type", "active_days", "inactive_days") if fields.get(k)}
+        text, dry_run = fields.get("text", ""), fields.get("dry_run") in ("1", "true")
+    else:
+        data = await request.json()
+        selector, text, dry_run = data.get("selector") or {}, data.get("text", ""), bool(data.get("dry_run"))
+
+    if not text and not file_data:
+        return json_response({"status": "error", "error": "text or file required"}, status=400)
+    try:
+        if dry_run:
+            return json_response({"status": "ok", "targets": await broadcasts.count_targets(selector)})
+        media_path = media_type = None
+        if file_data:
+            media_path = broadcast_dir / f"{uuid.uuid4().hex}{Path(file_name).suffix}"
+            await fileio.makedirs(broadcast_dir)
+            await fileio.write_bytes(media_path, file_data)
+            media_path, media_type = str(media_path), _media_type(file_name)
+        job = await broadcasts.create(text, selector, media_path, media_type)
+    except ValueError as exc:
+        return json_response({"status": "error", "error": str(exc)}, status=400)
+    return json_response({"status": "ok", "job": job})
+
+
+async def api_broadcast_list(request):
+    return json_response({"jobs": await broadcasts.list()})
+
+
+async def api_broadcast_get(request):
+    job = await broadcasts.get(int(request.match_info["job_id"]))
+    if job is None:
+        raise web.HTTPNotFound()
+    return json_response({"job": job})
+
+
+async def api_broadcast_control(request):
+    """POST /api/broadcasts/{id}/pause|resume|cancel"""
+    try:
+        job = await broadcasts.control(int(request.match_info["job_id"]), request.match_info["action"])
+    except ValueError as exc:
+        return json_response({"status": "error", "error": str(exc)}, status=400)
+    return json_response({"status": "ok", "job": job})
+
 
 async def api_leave_group(request):
     data = await request.json()
     chat_id = int(data["chat_id"])
     try:
         await bot.leave_chat(chat_id)
-        return web.json_response({"status": "ok"})
+        return json_response({"status": "ok"})
     except Exception as exc:
-        return web.json_response({"status": "error", "error": str(exc)}, status=400)
+        return json_response({"status": "error", "error": str(exc)}, status=400)
 
 
 async def api_group_info(request):
     chat_id = int(request.match_info["chat_id"])
     
     # Get active members from local DB
-    msgs = storage._users.get(str(chat_id))
     active = {}
-    if msgs:
+    if storage.get_user(chat_id):
         all_m = await storage.get_all_messages(chat_id)
         for m in all_m:
             sid = m.get("sender_id")
@@ -420,10 +593,10 @@ async def api_group_info(request):
         count = await bot.get_chat_member_count(chat_id)
         admins = await bot.get_chat_administrators(chat_id)
     except Exception as e:
-        print(f"[api_group_info] {e}")
+        log.warning("group info failed: %s", e, extra={"chat_id": chat_id})
         pass
         
-    return web.json_response({
+    return json_response({
         "status": "ok", 
         "member_count": count, 
         "admins": admins,
@@ -445,7 +618,7 @@ async def api_edit_message(request):
     try:
         await bot.edit_message(uid, msg_id, new_text)
     except Exception as exc:
-        print(f"[tg edit] {exc}")
+        log.warning("telegram edit failed: %s", exc, extra={"chat_id": uid, "msg_id": msg_id})
 
     msg = await storage.get_message_by_id(uid, msg_id)
     await _notify_ws({
@@ -454,7 +627,8 @@ async def api_edit_message(request):
         "msg_id": msg_id,
         "message": msg,
     })
-    return web.json_response({"status": "ok", "message": msg})
+    await _notify_chat(uid)
+    return json_response({"status": "ok", "message": msg})
 
 
 async def api_get_edit_history(request):
@@ -463,39 +637,204 @@ async def api_get_edit_history(request):
     msg_id = int(request.match_info["msg_id"])
     msg = await storage.get_message_by_id(uid, msg_id)
     history = msg.get("edit_history", []) if msg else []
-    return web.json_response({"edit_history": history})
+    return json_response({"edit_history": history})
 
 
 # websocket
 
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(heartbeat=ws_heartbeat, compress=ws_compress)
     await ws.prepare(request)
-    ws_clients.add(ws)
+    client = WsClient(ws)
+    if "chat" in request.query or "list" in request.query:
+        client.subscribe(request.query.get("chat") or None, request.query.get("list", "1") == "1")
+    since = request.query.get("since")
+
+    client.hold()
+    client.start()
+    ws_clients.add(client)
+
+    # replay what the client missed while it was away, then go live
+    backlog, upto = [], 0
+    if since is not None and since.lstrip("-").isdigit():
+        changes, last_seq, reset = await storage.get_changes(int(since), limit=change_log_size)
+        if reset:
+            backlog.append(json.dumps({"type": "resync", "seq": last_seq}))
+        else:
+            backlog = [json.dumps(c, default=str) for c in coalesce([c for c in changes if client.wants(c)])]
+            upto = changes[-1]["seq"] if changes else int(since)
+    # hello only vouches for what was replayed or already delivered live: a seq committed but
+    # not yet published would reach the client after hello and be dropped as seen
+    hello = json.dumps({"type": "hello", "seq": max(upto, ws_hub.delivered_seq, storage.boot_seq)})
+    if not client.release(backlog, hello, upto):
+        ws_clients.discard(client)
+        await client.kick()
+        return ws
+
     try:
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.ERROR:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    data = json.loads(msg.data)
+                except ValueError:
+                    continue
+                if not isinstance(data, dict):
+                    continue
+                # browsers can't send ping frames, so they ping with a message
+                if data.get("type") == "ping":
+                    client.send('{"type":"pong"}')
+                elif data.get("type") == "subscribe":
+                    client.subscribe(data.get("chat_id"), data.get("chat_list", True))
+            elif msg.type == aiohttp.WSMsgType.ERROR:
                 break
     finally:
-        ws_clients.discard(ws)
+        ws_clients.discard(client)
+        await client.stop()
     return ws
 
 
+# metrics
+
+metrics.Gauge("telechat_ws_clients", "Connected websocket clients", fn=lambda: len(ws_clients))
+metrics.Gauge("telechat_log_dropped", "Log records dropped because the writer thread fell behind", fn=log_dropped)
+
+
+async def metrics_handler(request):
+    """With web workers, whichever process takes the scrape answers for itself and the primary,
+    each series labelled with the process it came from."""
+    if is_web_worker:
+        from src.workers import primary_metrics
+        text = metrics.merge(metrics.render(process=f"worker-{worker_index}"),
+                             await primary_metrics(request.app))
+    else:
+        text = metrics.render(process="primary" if web_workers > 0 else None)
+    return web.Response(text=text, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def api_admin_profile(request):
+    """Sample the event loop for ?seconds=N and return collapsed stacks for a flamegraph."""
+    try:
+        seconds = float(request.query.get("seconds", 10))
+    except ValueError:
+        return json_response({"status": "error", "error": "bad seconds"}, status=400)
+    if profiler.busy:
+        return json_response({"status": "error", "error": "profiler already running"}, status=409)
+    stacks = await profiler.run(min(max(seconds, 0.1), profile_max_seconds))
+    return web.Response(text=stacks, content_type="text/plain")
+
+
+async def api_admin_snapshot(request):
+    """Start a snapshot of the databases and media. ?wait=1 answers when it is written."""
+    running = snapshots.busy
+    job = snapshots.start()
+    if request.query.get("wait") in ("1", "true"):
+        try:
+            return json_response({"status": "ok", "snapshot": await job})
+        except Exception as exc:
+            return json_response({"status": "error", "error": str(exc)}, status=500)
+    return json_response({"status": "running" if running else "started"}, status=202)
+
+
+async def api_admin_snapshots(request):
+    return json_response({"running": snapshots.busy, "snapshots": await snapshots.list()})
+
+
+async def api_admin_shards(request):
+    return json_response({"rebalancing": shards.busy, "shards": await shards.stats()})
+
+
+async def api_admin_shards_rebalance(request):
+    """Migrate chats onto the configured shards. JSON {even, max_moves}; ?wait=1 answers with the moves made."""
+    data = await request.json() if request.can_read_body else {}
+    try:
+        max_moves = int(data.get("max_moves", 50))
+    except (TypeError, ValueError):
+        return json_response({"status": "error", "error": "max_moves must be an integer"}, status=400)
+    running = shards.busy
+    job = shards.start(bool(data.get("even")), max_moves)
+    if request.query.get("wait") in ("1", "true"):
+        return json_response({"status": "ok", "moves": await job})
+    return json_response({"status": "running" if running else "started"}, status=202)
+
+
+async def api_admin_shards_move(request):
+    """Move one chat's messages to another shard: JSON {chat_id, shard}."""
+    data = await request.json()
+    try:
+        copied = await shards.move(int(data["chat_id"]), int(data["shard"]))
+    except (KeyError, TypeError, ValueError) as exc:
+        return json_response({"status": "error", "error": str(exc)}, status=400)
+    return json_response({"status": "ok", "messages": copied})
+
+
+async def api_admin_inbox(request):
+    """Queued bot updates and the dead letters that ran out of attempts."""
+    if not is_http_bot:
+        return json_response({"status": "error", "error": "no update inbox in telethon mode"}, status=409)
+    return json_response({"pending": await inbox.pending(), "failed": await inbox.failed()})
+
+
+async def api_admin_inbox_replay(request):
+    """Queue dead letters again: JSON {update_ids} for some, no body for all."""
+    if not is_http_bot:
+        return json_response({"status": "error", "error": "no update inbox in telethon mode"}, status=409)
+    data = await request.json() if request.can_read_body else {}
+    try:
+        replayed = await inbox.replay(data.get("update_ids"))
+    except (TypeError, ValueError) as exc:
+        return json_response({"status": "error", "error": str(exc)}, status=400)
+    return json_response({"status": "ok", "replayed": replayed})
+
+
+async def _start_lag_watch(app):
+    app["loop_lag"] = asyncio.create_task(metrics.watch_loop_lag())
+
+
+async def _stop_lag_watch(app):
+    app["loop_lag"].cancel()
+
+
 # app factory
 
-def create_app():
-    app = web.Application(client_max_size=50 * 1024 * 1024)
+def create_app(primary_socket=None):
+    """Full app, or for a web worker the local read routes plus a proxy to the primary."""
+    app = web.Application(client_max_size=50 * 1024 * 1024, middlewares=[trace_middleware])
+    assets.build()
 
-    app.router.add_get("/api/bot-info", api_bot_info)
-    app.router.add_get("/api/avatar/{user_id}", api_avatar)
+    # reads: served by every process straight from SQLite
     app.router.add_get("/api/users", api_get_users)
     app.router.add_get("/api/messages/{user_id}", api_get_messages)
+    app.router.add_get("/api/changes", api_get_changes)
+    app.router.add_get("/api/media/{user_id}/{filename:.*}", api_media)
+    app.router.add_get("/api/edit-history/{user_id}/{msg_id}", api_get_edit_history)
+
+    app.router.add_get("/ws", websocket_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.on_startup.append(_start_lag_watch)
+    app.on_cleanup.append(_stop_lag_watch)
+
+    app.router.add_get("/", index)
+    app.router.add_get("/static/{path:.*}", static_handler)
+
+    if primary_socket is not None:
+        from src.workers import proxy_to_primary
+        proxy_to_primary(app, primary_socket)
+        return app
+
+    app.router.add_get("/api/bot-info", api_bot_info)
+    app.router.add_get("/api/avatar/{user_id}", api_avatar)
     app.router.add_post("/api/send", api_send_message)
     app.router.add_post("/api/upload", api_upload)
+    app.router.add_post("/api/outbox/retry", api_outbox_retry)
+
+    # broadcasts
+    app.router.add_get("/api/broadcasts", api_broadcast_list)
+    app.router.add_post("/api/broadcasts", api_broadcast_create)
+    app.router.add_get(r"/api/broadcasts/{job_id:\d+}", api_broadcast_get)
+    app.router.add_post(r"/api/broadcasts/{job_id:\d+}/{action}", api_broadcast_control)
     app.router.add_delete("/api/messages", api_delete_messages)
     app.router.add_post("/api/forward", api_forward_messages)
     app.router.add_post("/api/clear-unread", api_clear_unread)
-    app.router.add_get("/api/media/{user_id}/{filename:.*}", api_media)
 
     # reactions
     app.router.add_post("/api/react", api_add_reaction)
@@ -503,7 +842,6 @@ def create_app():
 
     # edit
     app.router.add_post("/api/edit-message", api_edit_message)
-    app.router.add_get("/api/edit-history/{user_id}/{msg_id}", api_get_edit_history)
 
     # admin actions
     app.router.add_post("/api/ban", api_ban_member)
@@ -515,9 +853,19 @@ def create_app():
     app.router.add_post("/api/leave", api_leave_group)
     app.router.add_get("/api/group-info/{chat_id}", api_group_info)
 
-    app.router.add_get("/ws", websocket_handler)
-
-    app.router.add_get("/", index)
-    app.router.add_get("/static/{path:.*}", static_handler)
+    # access lists
+    app.router.add_get("/api/acl/{list}", api_acl_export)
+    app.router.add_post("/api/acl/reload", api_acl_reload)
+    app.router.add_post("/api/acl/{list}", api_acl_import)
+
+    # diagnostics
+    app.router.add_get("/api/admin/profile", api_admin_profile)
+    app.router.add_get("/api/admin/snapshots", api_admin_snapshots)
+    app.router.add_post("/api/admin/snapshot", api_admin_snapshot)
+    app.router.add_get("/api/admin/shards", api_admin_shards)
+    app.router.add_post("/api/admin/shards/rebalance", api_admin_shards_rebalance)
+    app.router.add_post("/api/admin/shards/move", api_admin_shards_move)
+    app.router.add_get("/api/admin/inbox", api_admin_inbox)
+    app.router.add_post("/api/admin/inbox/replay", api_admin_inbox_replay)
 
     return app
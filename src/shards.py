@@ -0,0 +1,395 @@
+"""
+Message shards. With MESSAGE_SHARDS=N the messages table is split across
+data/shards/messages-0.db .. messages-{N-1}.db by chat; users, queues and
+the change log stay in telechat.db together with the routing map
+(chat_shards: chat_id -> shard). Shard -1 is the messages table in
+telechat.db itself, which is where everything lives with MESSAGE_SHARDS=0
+and where history from before sharding waits to be migrated.
+
+A new chat goes to crc32(chat_id) % N and its route is recorded on its
+first write; after that only move() changes it, so changing N never
+strands history. Writes to a shard are serialized by that shard's lock
+and go through one long-lived connection per shard, so shards commit in
+parallel and a busy group only slows down the chats that share its file.
+
+move() copies a chat in batches while its writes wait (reads keep using
+the old shard), flips the route, tells web workers, then deletes the old
+rows. rebalance() uses it to migrate the single-file layout and chats on
+shards beyond N, and optionally to even out message counts.
+"""
+
+import asyncio
+import zlib
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import aiosqlite
+
+from src.config import data_dir, is_web_worker, message_shards, shard_move_batch
+from src.log import get_logger
+from src.ws_hub import forwarders
+
+log = get_logger("shards")
+
+shards_dir = data_dir / "shards"
+legacy = -1
+
+
+async def create_messages_table(db):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            msg_id INTEGER,
+            chat_id TEXT,
+            direction TEXT,
+            timestamp TEXT,
+            payload TEXT,
+            PRIMARY KEY (msg_id, chat_id)
+        )
+    """)
+    # history is paged by (timestamp, msg_id); msg_id breaks ties between messages of the same instant
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_time_id ON messages (chat_id, timestamp, msg_id)")
+
+
+def shard_path(index: int) -> Path:
+    return shards_dir / f"messages-{index}.db"
+
+
+class Shards:
+    def __init__(self):
+        self.central: Path | None = None
+        self._routes: dict[str, int] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._conns: dict[Path, aiosqlite.Connection] = {}
+        self._moving: dict[str, asyncio.Event] = {}
+        self._rebalancing: asyncio.Task | None = None
+        # held for the whole of a move; snapshots take it too, so they never copy a chat half moved
+        self.moves = asyncio.Lock()
+
+    async def init(self, central: Path):
+        """Open (or create) the shard files and load the routing map. `central` is telechat.db."""
+        await self.close()
+        self.central = central
+        async with aiosqlite.connect(central, timeout=30.0) as db:
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS chat_shards (
+                    chat_id TEXT PRIMARY KEY,
+                    shard INTEGER
+                ) WITHOUT ROWID
+            """)
+            if message_shards > 0 and not is_web_worker:
+                # history written before sharding stays where it is until it has been moved
+                await db.execute("INSERT OR IGNORE INTO chat_shards (chat_id, shard) "
+                                 "SELECT DISTINCT chat_id, ? FROM messages", (legacy,))
+            await db.commit()
+        if message_shards > 0:
+            shards_dir.mkdir(parents=True, exist_ok=True)
+            for i in range(message_shards):
+                async with aiosqlite.connect(shard_path(i), timeout=30.0) as db:
+                    await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    await db.execute("PRAGMA journal_mode=WAL")
+                    await create_messages_table(db)
+                    await db.commit()
+        await self.reload()
+
+    async def reload(self):
+        async with aiosqlite.connect(self.central, timeout=30.0) as db:
+            async with db.execute("SELECT chat_id, shard FROM chat_shards") as cursor:
+                self._routes = {uid: shard async for uid, shard in cursor}
+
+    def apply_remote(self, event: dict):
+        """Web workers: a chat was moved (or deleted, shard None) by the primary."""
+        if event["shard"] is None:
+            self._routes.pop(str(event["chat_id"]), None)
+        else:
+            self._routes[str(event["chat_id"])] = event["shard"]
+
+    # routing
+    def targets(self) -> list[int]:
+        """Shards new chats may go to."""
+        return list(range(message_shards)) if message_shards > 0 else [legacy]
+
+    def _default(self, uid: str) -> int:
+        if message_shards <= 0:
+            return legacy
+        return zlib.crc32(uid.encode()) % message_shards
+
+    def shard_of(self, chat_id) -> int:
+        uid = str(chat_id)
+        return self._routes.get(uid, self._default(uid))
+
+    def path(self, chat_id) -> Path:
+        """File holding a chat's messages (for reads)."""
+        return self.path_of(self.shard_of(chat_id))
+
+    def path_of(self, shard: int) -> Path:
+        return self.central if shard == legacy else shard_path(shard)
+
+    def paths(self) -> list[Path]:
+        """Every file that may hold messages: telechat.db plus each shard file in use."""
+        used = {legacy, *self.targets(), *self._routes.values()}
+        return [self.path_of(s) for s in sorted(used)]
+
+    def files(self) -> list[Path]:
+        """Shard files on disk (telechat.db not included)."""
+        return sorted(shards_dir.glob("messages-*.db")) if shards_dir.exists() else []
+
+    def groups(self, chat_ids) -> dict[Path, list]:
+        """chat ids grouped by the file that holds them."""
+        out: dict[Path, list] = {}
+        for uid in chat_ids:
+            out.setdefault(self.path(uid), []).append(uid)
+        return out
+
+    def _lock(self, shard: int) -> asyncio.Lock:
+        lock = self._locks.get(shard)
+        if lock is None:
+            lock = self._locks[shard] = asyncio.Lock()
+        return lock
+
+    async def _assign(self, uids: set) -> dict:
+        """Current shard of each chat. With shards in use, chats seen for the first time get
+        their default route recorded, so changing MESSAGE_SHARDS later doesn't move them."""
+        new = {uid: self._default(uid) for uid in uids if uid not in self._routes}
+        if new and message_shards > 0:
+            async with aiosqlite.connect(self.central, timeout=30.0) as db:
+                await db.executemany("INSERT OR IGNORE INTO chat_shards (chat_id, shard) VALUES (?, ?)",
+                                     new.items())
+                await db.commit()
+            for uid, shard in new.items():
+                self._routes.setdefault(uid, shard)
+        return {uid: self.shard_of(uid) for uid in uids}
+
+    async def _connection(self, shard: int) -> aiosqlite.Connection:
+        """The shard's writer connection, opened on first use and kept; only used under its lock."""
+        path = self.path_of(shard)
+        db = self._conns.get(path)
+        if db is None:
+            db = self._conns[path] = await aiosqlite.connect(path, timeout=30.0)
+        return db
+
+    async def close(self):
+        conns, self._conns = self._conns, {}
+        for db in conns.values():
+            await db.close()
+
+    @asynccontextmanager
+    async def _hold(self, uids: set):
+        """Lock the shards holding these chats, waiting while any of them is being moved.
+        Yields {shard: writer connection}; an open transaction is rolled back if the block raises."""
+        while True:
+            gates = [self._moving[uid] for uid in uids if uid in self._moving]
+            if gates:
+                await asyncio.gather(*(gate.wait() for gate in gates))
+                continue
+            routes = await self._assign(uids)
+            # always taken in shard order, so two writers can't deadlock
+            locks = [self._lock(s) for s in sorted(set(routes.values()))]
+            held = []
+            try:
+                for lock in locks:
+                    await lock.acquire()
+                    held.append(lock)
+            except BaseException:
+                for lock in held:
+                    lock.release()
+                raise
+            # a move may have started (or finished) while we waited for the locks
+            if any(uid in self._moving or self.shard_of(uid) != routes[uid] for uid in uids):
+                for lock in held:
+                    lock.release()
+                continue
+            break
+        try:
+            conns = {s: await self._connection(s) for s in set(routes.values())}
+            try:
+                yield conns
+            except BaseException:
+                for db in conns.values():
+                    if db.in_transaction:
+                        await db.rollback()
+                raise
+        finally:
+            for lock in held:
+                lock.release()
+
+    @asynccontextmanager
+    async def writer(self, chat_id):
+        """Exclusive write access to a chat's shard. Yields its writer connection; commit before leaving."""
+        async with self._hold({str(chat_id)}) as conns:
+            yield next(iter(conns.values()))
+
+    @asynccontextmanager
+    async def writers(self, chat_ids):
+        """writer() for many chats at once. Yields {chat id: its shard's writer connection}."""
+        uids = {str(c) for c in chat_ids}
+        async with self._hold(uids) as conns:
+            yield {uid: conns[self.shard_of(uid)] for uid in uids}
+
+    async def forget(self, chat_id):
+        """Drop a deleted chat's route. Call while holding its writer."""
+        uid = str(chat_id)
+        if self._routes.pop(uid, None) is None:
+            return
+        async with aiosqlite.connect(self.central, timeout=30.0) as db:
+            await db.execute("DELETE FROM chat_shards WHERE chat_id = ?", (uid,))
+            await db.commit()
+        _broadcast({"type": "shard_route", "chat_id": uid, "shard": None})
+
+    # moving chats
+    async def move(self, chat_id, target: int) -> int:
+        """Move a chat's messages to another shard. Returns how many were copied."""
+        if target not in self.targets() and target != legacy:
+            raise ValueError(f"no shard {target}")
+        async with self.moves:
+            return await self._move(str(chat_id), target)
+
+    async def _move(self, uid: str, target: int) -> int:
+        source = self.shard_of(uid)
+        if source == target:
+            return 0
+        gate = self._moving[uid] = asyncio.Event()
+        copied = 0
+        try:
+            # let a write that got in before us finish
+            async with self._lock(source):
+                pass
+            src = self.path_of(source)
+            last = None
+            while True:
+                async with aiosqlite.connect(src, timeout=30.0) as db:
+                    async with db.execute(
+                        "SELECT msg_id, chat_id, direction, timestamp, payload FROM messages "
+                        "WHERE chat_id = ? AND msg_id > ? ORDER BY msg_id LIMIT ?",
+                        (uid, last if last is not None else -2 ** 63, shard_move_batch)
+                    ) as cursor:
+                        rows = await cursor.fetchall()
+                if not rows:
+                    break
+                async with self._lock(target):
+                    db = await self._connection(target)
+                    await db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+                    await db.commit()
+                copied += len(rows)
+                last = rows[-1][0]
+
+            async with aiosqlite.connect(self.central, timeout=30.0) as db:
+                if target == self._default(uid) == legacy:
+                    # unsharded chats need no route
+                    await db.execute("DELETE FROM chat_shards WHERE chat_id = ?", (uid,))
+                    self._routes.pop(uid, None)
+                else:
+                    await db.execute("INSERT INTO chat_shards (chat_id, shard) VALUES (?, ?) "
+                                     "ON CONFLICT(chat_id) DO UPDATE SET shard = excluded.shard", (uid, target))
+                    self._routes[uid] = target
+                await db.commit()
+            _broadcast({"type": "shard_route", "chat_id": uid, "shard": target})
+        finally:
+            del self._moving[uid]
+            gate.set()
+
+        # web workers switch over on the bus event; give them a moment before the old rows go
+        await asyncio.sleep(1)
+        async with self._lock(source):
+            db = await self._connection(source)
+            await db.execute("DELETE FROM messages WHERE chat_id = ?", (uid,))
+            await db.commit()
+        return copied
+
+    async def _counts(self) -> dict[str, tuple[int, int]]:
+        """chat_id -> (shard, messages) for every chat that has messages."""
+        out = {}
+        for shard in sorted({legacy, *self.targets(), *self._routes.values()}):
+            path = self.path_of(shard)
+            if not path.exists():
+                continue
+            async with aiosqlite.connect(path, timeout=30.0) as db:
+                async with db.execute("SELECT chat_id, COUNT(*) FROM messages GROUP BY chat_id") as cursor:
+                    async for uid, n in cursor:
+                        if self.shard_of(uid) == shard:
+                            out[uid] = (shard, n)
+        return out
+
+    async def stats(self) -> list[dict]:
+        """Chats, messages and file size per shard."""
+        per: dict[int, dict] = {s: {"shard": s, "chats": 0, "messages": 0} for s in self.targets()}
+        for shard, n in (await self._counts()).values():
+            row = per.setdefault(shard, {"shard": shard, "chats": 0, "messages": 0})
+            row["chats"] += 1
+            row["messages"] += n
+        for row in per.values():
+            path = self.path_of(row["shard"])
+            row["file"] = str(path)
+            row["bytes"] = path.stat().st_size if path.exists() else 0
+        return sorted(per.values(), key=lambda r: r["shard"])
+
+    async def rebalance(self, even=False, max_moves=50) -> list[dict]:
+        """Move chats off shards that are no longer in use (the single-file layout, or beyond
+        MESSAGE_SHARDS) onto the lightest ones; with `even`, also move up to max_moves chats from
+        the heaviest shard to the lightest while that narrows the gap. Returns the moves made."""
+        targets = self.targets()
+        counts = await self._counts()
+        load = {t: 0 for t in targets}
+        stray = []
+        for uid, (shard, n) in counts.items():
+            if shard in load:
+                load[shard] += n
+            else:
+                stray.append((n, uid))
+
+        plan = []
+        for n, uid in sorted(stray, reverse=True):
+            t = min(load, key=load.get)
+            plan.append((uid, t, n))
+            load[t] += n
+        if even:
+            placed = {uid: (shard, n) for uid, (shard, n) in counts.items() if shard in load}
+            while len(plan) - len(stray) < max_moves and len(load) > 1:
+                hi, lo = max(load, key=load.get), min(load, key=load.get)
+                gap = load[hi] - load[lo]
+                fits = [(n, uid) for uid, (shard, n) in placed.items() if shard == hi and 0 < n < gap]
+                if not fits:
+                    break
+                n, uid = max(fits)
+                plan.append((uid, lo, n))
+                placed[uid] = (lo, n)
+                load[hi] -= n
+                load[lo] += n
+
+        moves = []
+        for uid, target, n in plan:
+            source = self.shard_of(uid)
+            copied = await self.move(uid, target)
+            moves.append({"chat_id": uid, "from": source, "to": target, "messages": copied})
+            log.info("moved chat", extra={"chat_id": uid, "from": source, "to": target, "messages": copied})
+        return moves
+
+    @property
+    def busy(self) -> bool:
+        return self._rebalancing is not None and not self._rebalancing.done()
+
+    def start(self, even=False, max_moves=50) -> asyncio.Task:
+        """Rebalance in the background (or return the pass already running)."""
+        if not self.busy:
+            self._rebalancing = asyncio.create_task(self.rebalance(even, max_moves))
+        return self._rebalancing
+
+    async def run(self):
+        """Primary: migrate history left in the single-file layout (or on dropped shards) in the background."""
+        if not any(s not in self.targets() for s in set(self._routes.values())):
+            return
+        try:
+            moves = await self.start()
+            log.info("shard migration finished", extra={"chats": len(moves)})
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("shard migration failed")
+
+
+def _broadcast(event: dict):
+    """Tell web workers where a chat lives now; browsers don't need these."""
+    for forward in forwarders:
+        forward(event)
+
+
+shards = Shards()
@@ -0,0 +1,302 @@
+"""
+Online snapshots of the databases and media, taken while the bot runs.
+
+telechat.db, the message shards and then archive.db are copied with
+SQLite's backup API in steps of snapshot_step_pages with a pause in
+between; the archive goes last so history archived during the copy is
+in the hot tier's copy instead. The source connection holds
+one read transaction for the whole copy, so the snapshot is consistent and
+(under WAL) writers are never blocked by it; without that, every write
+would restart the backup. Media is incremental: a manifest records the
+size and mtime of each file under data/chats, and a file that hasn't
+changed since the previous snapshot is hard-linked from it instead of
+copied. Every snapshot is therefore a complete tree on its own and old
+ones can simply be deleted.
+
+Snapshots are written to SNAPSHOT_DIR/<id>.partial and renamed when done.
+They run every SNAPSHOT_INTERVAL_HOURS, or on POST /api/admin/snapshot.
+Restore with the bot stopped:
+
+    python -m src.snapshots list
+    python -m src.snapshots restore <id>
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from src.config import (data_dir, chats_dir, web_host, web_port, snapshot_dir, snapshot_interval_hours,
+                        snapshot_keep, snapshot_step_pages, snapshot_step_sleep_ms, snapshot_copy_mb_s)
+from src.log import get_logger
+from src.shards import shards
+
+log = get_logger("snapshots")
+
+manifest_name = "manifest.json"  # media file list, read by the next snapshot
+info_name = "snapshot.json"      # summary, what list shows
+
+# one snapshot at a time, on its own thread so it never holds an I/O pool slot for minutes
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+
+def _database_names(root: Path) -> list[str]:
+    """Databases under root, relative to it, in copy order: telechat.db, the message shards, archive.db.
+    Hot tiers come before the archive, so messages archived mid-snapshot are copied from one or the other."""
+    shard_files = sorted(p.relative_to(root).as_posix() for p in (root / "shards").glob("messages-*.db"))
+    return ["telechat.db", *shard_files, "archive.db"]
+
+
+def _backup_db(src: Path, dst: Path) -> int:
+    """Paced online copy of one database. Returns its page count."""
+    source = sqlite3.connect(src, isolation_level=None, timeout=30.0)
+    target = sqlite3.connect(dst)
+    try:
+        # pin one read snapshot for the whole copy
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        pages = source.execute("PRAGMA page_count").fetchone()[0]
+        source.backup(target, pages=snapshot_step_pages, sleep=snapshot_step_sleep_ms / 1000)
+        source.execute("COMMIT")
+        return pages
+    finally:
+        target.close()
+        source.close()
+
+
+class _Throttle:
+    """Keeps media copying under snapshot_copy_mb_s."""
+    def __init__(self, mb_s: float):
+        self.rate = mb_s * 2 ** 20
+        self.start = time.monotonic()
+        self.done = 0
+
+    def spent(self, nbytes: int):
+        if self.rate <= 0:
+            return
+        self.done += nbytes
+        ahead = self.done / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def _scan(root: Path) -> dict:
+    """rel path -> [size, mtime_ns] for every file under root."""
+    out = {}
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            p = Path(dirpath) / name
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue  # deleted while we walked
+            out[p.relative_to(root).as_posix()] = [st.st_size, st.st_mtime_ns]
+    return out
+
+
+def _copy_media(dst: Path, previous: Path | None) -> dict:
+    """Copy data/chats into dst/chats, linking files unchanged since `previous`. Returns stats."""
+    current = _scan(chats_dir)
+    old = {}
+    if previous and (previous / manifest_name).exists():
+        old = json.loads((previous / manifest_name).read_text()).get("media", {})
+    throttle = _Throttle(snapshot_copy_mb_s)
+    stats = {"files": 0, "linked": 0, "copied": 0, "copied_bytes": 0}
+    manifest = {}
+    for rel, meta in current.items():
+        target = dst / "chats" / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if old.get(rel) == meta:
+            try:
+                os.link(previous / "chats" / rel, target)
+                manifest[rel] = meta
+                stats["linked"] += 1
+                continue
+            except OSError:
+                pass  # missing in the old snapshot, or no hard links here: copy instead
+        try:
+            shutil.copy2(chats_dir / rel, target)
+        except FileNotFoundError:
+            continue
+        manifest[rel] = meta
+        stats["copied"] += 1
+        stats["copied_bytes"] += meta[0]
+        throttle.spent(meta[0])
+    stats["files"] = len(manifest)
+    return {"media": manifest, "stats": stats}
+
+
+def list_snapshots() -> list[dict]:
+    """Finished snapshots, newest first."""
+    if not snapshot_dir.exists():
+        return []
+    out = []
+    for d in sorted(snapshot_dir.iterdir(), reverse=True):
+        if d.is_dir() and not d.name.endswith(".partial") and (d / info_name).exists():
+            out.append({"id": d.name, **json.loads((d / info_name).read_text())})
+    return out
+
+
+def _copy_databases() -> dict:
+    """First half of a snapshot: the databases, into a new .partial directory."""
+    snap_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+    work = snapshot_dir / f"{snap_id}.partial"
+    work.mkdir(parents=True, exist_ok=True)
+    job = {"id": snap_id, "work": work, "start": time.monotonic(), "pages": {}}
+    try:
+        for name in _database_names(data_dir):
+            if (data_dir / name).exists():
+                (work / name).parent.mkdir(parents=True, exist_ok=True)
+                job["pages"][name] = _backup_db(data_dir / name, work / name)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    return job
+
+
+def _finish(job: dict) -> dict:
+    """Second half: media, manifest, then the rename that makes the snapshot visible."""
+    snap_id, work, start, pages = job["id"], job["work"], job["start"], job["pages"]
+    previous = next((snapshot_dir / s["id"] for s in list_snapshots()), None)
+    try:
+        media = _copy_media(work, previous)
+        info = {"created": datetime.now().isoformat(timespec="seconds"), "db_pages": pages,
+                **media["stats"], "seconds": round(time.monotonic() - start, 1)}
+        (work / manifest_name).write_text(json.dumps({"media": media["media"]}))
+        (work / info_name).write_text(json.dumps(info))
+        work.rename(snapshot_dir / snap_id)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+    for old in list_snapshots()[snapshot_keep:]:
+        shutil.rmtree(snapshot_dir / old["id"], ignore_errors=True)
+    return {"id": snap_id, **info}
+
+
+def _take() -> dict:
+    return _finish(_copy_databases())
+
+
+class Snapshots:
+    def __init__(self):
+        self._running: asyncio.Future | None = None
+
+    @property
+    def busy(self) -> bool:
+        return self._running is not None and not self._running.done()
+
+    def start(self) -> asyncio.Future:
+        """Begin a snapshot in the background (or return the one already running)."""
+        if not self.busy:
+            self._running = asyncio.ensure_future(self._take())
+            self._running.add_done_callback(self._done)
+        return self._running
+
+    async def _take(self) -> dict:
+        loop = asyncio.get_running_loop()
+        # each database is copied on its own; keep chats from moving between shards meanwhile
+        async with shards.moves:
+            job = await loop.run_in_executor(_executor, _copy_databases)
+        return await loop.run_in_executor(_executor, _finish, job)
+
+    def _done(self, fut: asyncio.Future):
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc:
+            log.error("snapshot failed: %s", exc)
+        else:
+            info = fut.result()
+            log.info("snapshot written", extra={k: info[k] for k in ("id", "files", "copied", "seconds")})
+
+    async def list(self) -> list[dict]:
+        return await asyncio.get_running_loop().run_in_executor(None, list_snapshots)
+
+    async def run(self):
+        """Take a snapshot whenever the newest one is older than snapshot_interval_hours."""
+        if snapshot_interval_hours <= 0:
+            return
+        while True:
+            latest = await self.list()
+            age = (datetime.now() - datetime.fromisoformat(latest[0]["created"])).total_seconds() \
+                if latest else float("inf")
+            wait = snapshot_interval_hours * 3600 - age
+            if wait <= 0:
+                try:
+                    await self.start()
+                    continue
+                except Exception:
+                    wait = 3600  # already logged; try again in an hour
+            await asyncio.sleep(min(wait, 3600))
+
+
+snapshots = Snapshots()
+
+
+# restore (command line, bot stopped)
+
+def _bot_running() -> bool:
+    try:
+        with socket.create_connection((web_host, web_port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def restore(snap_id: str):
+    """Put a snapshot back in place. The current files are kept in data/pre-restore-<time>/."""
+    src = snapshot_dir / snap_id
+    if not (src / info_name).exists():
+        raise SystemExit(f"no snapshot {snap_id!r} in {snapshot_dir}")
+    if _bot_running():
+        raise SystemExit(f"something is listening on {web_host}:{web_port}; stop the bot first")
+    for name in _database_names(src):
+        if (src / name).exists():
+            ok = sqlite3.connect(src / name).execute("PRAGMA quick_check").fetchone()[0]
+            if ok != "ok":
+                raise SystemExit(f"{name} in snapshot {snap_id} is damaged: {ok}")
+
+    keep = data_dir / f"pre-restore-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    keep.mkdir(parents=True)
+    for name in _database_names(data_dir):
+        for suffix in ("", "-wal", "-shm"):
+            p = data_dir / f"{name}{suffix}"
+            if p.exists():
+                (keep / name).parent.mkdir(parents=True, exist_ok=True)
+                p.rename(keep / f"{name}{suffix}")
+    if chats_dir.exists():
+        chats_dir.rename(keep / "chats")
+
+    for name in _database_names(src):
+        if (src / name).exists():
+            (data_dir / name).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(src / name, data_dir / name)
+    if (src / "chats").exists():
+        shutil.copytree(src / "chats", chats_dir, copy_function=shutil.copy2)
+    else:
+        chats_dir.mkdir()
+    print(f"restored snapshot {snap_id}; the previous data is in {keep}")
+
+
+def main(argv: list[str]):
+    if argv[:1] == ["list"]:
+        for s in list_snapshots():
+            print(f"{s['id']}  {s['created']}  {s['files']} files ({s['copied']} copied)  {s['seconds']}s")
+    elif argv[:1] == ["restore"] and len(argv) == 2:
+        restore(argv[1])
+    elif argv[:1] == ["take"]:
+        info = _take()
+        print(f"snapshot {info['id']} written in {info['seconds']}s")
+    else:
+        raise SystemExit("usage: python -m src.snapshots list | take | restore <id>")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,27 +4,46 @@ Messages are stored as JSON blobs in a hyper-fast indexed SQLite database.
 Media still goes to: data/chats/{folder_name}/media/
 """
 
+import asyncio
 import json
-import shutil
+import os
 from datetime import datetime
 from pathlib import Path
 
 import aiosqlite
 
-from src.config import data_dir, chats_dir
+from src import fileio
+from src.archive import archive, key as _key
+from src.config import data_dir, chats_dir, change_log_size, user_cache_size, archive_batch
+from src.metrics import instrument, storage_seconds
+from src.records import UserRecord
+from src.registry import UserRegistry
+from src.shards import shards, create_messages_table
 
 db_path = data_dir / "telechat.db"
 
 
 class Storage:
     def __init__(self):
-        self._users: dict = {}
+        self._users = UserRegistry(user_cache_size)
+        self._changes_since_trim = 0
+        # change log: seqs are handed out here and rows written in batches (append_change)
+        self.boot_seq = 0
+        self._seq = 0
+        self._change_buf: list = []
+        self._change_writer: asyncio.Task | None = None
+        # bumped on every write; the boot id keeps old ETags from matching after a restart
+        self._boot = os.urandom(4).hex()
+        self._list_version = 0
+        self._chat_versions: dict = {}
 
     async def init(self):
         """Must be called on startup to create tables if they do not exist."""
         # Enable WAL via synchronous driver before async connections to prevent locking deadlocks
         import sqlite3
         raw_db = sqlite3.connect(db_path, isolation_level=None)
+        # only takes effect on a new file; src/retention.py converts existing ones
+        raw_db.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         raw_db.execute("PRAGMA journal_mode=WAL;")
         raw_db.close()
         
@@ -43,33 +62,114 @@ class Storage:
                     last_interaction TEXT
                 )
             """)
+            # with MESSAGE_SHARDS set this only holds history from before sharding (src/shards.py)
+            await create_messages_table(db)
+            await db.execute("DROP INDEX IF EXISTS idx_messages_chat_time")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users (full_name COLLATE NOCASE)")
             await db.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    msg_id INTEGER,
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
                     chat_id TEXT,
-                    direction TEXT,
-                    timestamp TEXT,
-                    payload TEXT,
-                    PRIMARY KEY (msg_id, chat_id)
+                    type TEXT,
+                    payload TEXT
                 )
             """)
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, timestamp)")
             await db.commit()
+        self._users.attach(db_path)
+        await shards.init(db_path)
+        await archive.init()
+        self.boot_seq = self._seq = await self.last_change_seq()
 
     async def load_users(self):
-        """Load users into memory cache on startup."""
-        self._users = {}
+        """Warm the user registry with the most recently active chats; the rest load on demand."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute(
+                "SELECT * FROM users ORDER BY last_seen DESC LIMIT ?", (self._users.size,)
+            ) as cursor:
+                columns = [col[0] for col in cursor.description]
+                rows = [dict(zip(columns, row)) for row in await cursor.fetchall()]
+        self._users.warm(reversed(rows))
+        return len(rows)
+
+    async def list_users(self, offset=0, limit=50, sort="recent", q="") -> tuple[list, int]:
+        """One page of the chat list, sorted by recent activity or name, optionally filtered by name/username."""
+        order = "full_name COLLATE NOCASE ASC, user_id" if sort == "name" else "last_seen DESC, user_id"
+        where, params = "", []
+        if q:
+            like = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where = "WHERE full_name LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\'"
+            params = [like, like]
         async with aiosqlite.connect(db_path, timeout=30.0) as db:
-            async with db.execute("SELECT * FROM users") as cursor:
+            async with db.execute(f"SELECT COUNT(*) FROM users {where}", params) as cursor:
+                total = (await cursor.fetchone())[0]
+            async with db.execute(
+                f"SELECT * FROM users {where} ORDER BY {order} LIMIT ? OFFSET ?", params + [limit, offset]
+            ) as cursor:
                 columns = [col[0] for col in cursor.description]
-                for row in await cursor.fetchall():
-                    user_dict = dict(zip(columns, row))
-                    self._users[user_dict["user_id"]] = user_dict
-        return self._users
+                users = [dict(zip(columns, row)) for row in await cursor.fetchall()]
+        return users, total
+
+    async def last_messages(self, user_ids: list) -> dict:
+        """Newest message of each chat, in one connection per shard."""
+        out = {}
+        for path, uids in shards.groups(user_ids).items():
+            async with aiosqlite.connect(path, timeout=30.0) as db:
+                for uid in uids:
+                    async with db.execute(
+                        "SELECT payload FROM messages WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 1", (str(uid),)
+                    ) as cursor:
+                        row = await cursor.fetchone()
+                    if row:
+                        out[str(uid)] = json.loads(row[0])
+                    elif archive.edge(uid):
+                        # everything in this chat is old enough to be archived
+                        out[str(uid)] = (await archive.before(uid, ("\uffff", 0), 1))[0]
+        return out
+
+    # versions for conditional GET
+    def _bump(self, user_id=None):
+        """Mark the chat list (and, given a chat, that chat's history) as changed."""
+        self._list_version += 1
+        if user_id is not None:
+            uid = str(user_id)
+            self._chat_versions[uid] = self._chat_versions.get(uid, 0) + 1
+
+    def list_version(self) -> str:
+        return f"{self._boot}.{self._list_version}"
+
+    def chat_version(self, user_id) -> str:
+        return f"{self._boot}.{self._chat_versions.get(str(user_id), 0)}"
+
+    def touch_list(self):
+        """For changes the chat list shows that don't go through Storage (e.g. bans)."""
+        self._bump()
+
+    def touch_chat(self, user_id):
+        """For history changes made outside Storage (retention purges)."""
+        self._bump(user_id)
+
+    def touch_all(self):
+        """Invalidate every version at once."""
+        self._boot = os.urandom(4).hex()
+
+    def apply_remote_event(self, event: dict):
+        """Web workers: mirror a write the primary made, so the user list and caches stay current."""
+        info = event.get("chat") if event.get("type") == "chat_updated" else event.get("user_info")
+        if info:
+            self._users[str(info["user_id"])] = {
+                k: v for k, v in info.items() if k not in ("last_message", "is_banned")}
+        if event.get("type") == "chat_updated":
+            self._bump()
+        else:
+            self._bump(event.get("user_id"))
 
-    async def _save_user_to_db(self, uid):
+    async def _save_user_to_db(self, uid, user=None):
         """Push memory user dict to SQL."""
-        user = self._users[uid]
+        if user is None:
+            user = self._users[uid]
+        # the record being written is the cached one, even if it was evicted meanwhile
+        self._users[uid] = user
         async with aiosqlite.connect(db_path, timeout=30.0) as db:
             await db.execute("""
                 INSERT INTO users (user_id, first_name, last_name, username, full_name, type, folder_name, unread_count, last_seen, last_interaction)
@@ -90,6 +190,7 @@ class Storage:
                 user.get("unread_count", 0), user.get("last_seen"), user.get("last_interaction")
             ))
             await db.commit()
+        self._bump()
 
     async def update_user(self, user) -> dict:
         uid = str(user.id)
@@ -102,61 +203,62 @@ class Storage:
             last = getattr(user, 'last_name', '') or ""
             full = f"{first} {last}".strip()
         folder = uid
+        user_dir = chats_dir / folder
 
-        if uid not in self._users:
-            self._users[uid] = {
-                "user_id": uid,
-                "first_name": first,
-                "last_name": last,
-                "username": getattr(user, 'username', ''),
-                "full_name": full,
-                "type": getattr(user, 'type', 'private'),
-                "folder_name": folder,
-                "unread_count": 0,
-            }
+        info = self._users.get(uid)
+        if info is None:
+            info = UserRecord(
+                user_id=uid,
+                first_name=first,
+                last_name=last,
+                username=getattr(user, 'username', ''),
+                full_name=full,
+                type=getattr(user, 'type', 'private'),
+                folder_name=folder,
+                unread_count=0,
+            )
         else:
-            old_folder = self._users[uid].get("folder_name", "")
+            old_folder = info.get("folder_name", "")
             if old_folder != folder:
                 old_dir = chats_dir / old_folder
-                new_dir = chats_dir / folder
-                if old_dir.exists() and not new_dir.exists():
-                    old_dir.rename(new_dir)
-                self._users[uid]["folder_name"] = folder
+                if await fileio.exists(old_dir) and not await fileio.exists(user_dir):
+                    await fileio.rename(old_dir, user_dir)
+                info["folder_name"] = folder
 
-            self._users[uid].update(
+            info.update(
                 first_name=first, last_name=last,
                 username=getattr(user, 'username', ''), full_name=full,
                 type=getattr(user, 'type', 'private')
             )
 
-        self._users[uid]["last_seen"] = datetime.now().isoformat()
-
-        user_dir = chats_dir / folder
-        user_dir.mkdir(parents=True, exist_ok=True)
-        (user_dir / "media").mkdir(exist_ok=True)
+        info["last_seen"] = datetime.now().isoformat()
 
-        await self._save_user_to_db(uid)
-        return self._users[uid]
+        await fileio.makedirs(user_dir / "media")
+        await self._save_user_to_db(uid, info)
+        return info.to_dict()
 
     def get_user_folder(self, user_id) -> Path | None:
         info = self._users.get(str(user_id))
         return chats_dir / info["folder_name"] if info else None
 
-    def get_user(self, user_id) -> dict | None:
+    def get_user(self, user_id) -> UserRecord | None:
         return self._users.get(str(user_id))
 
-    def get_all_users(self) -> dict:
-        return self._users
-
     async def delete_user(self, user_id):
         folder = self.get_user_folder(user_id)
-        if folder and folder.exists():
-            shutil.rmtree(folder, ignore_errors=True)
+        if folder:
+            # the folder can hold gigabytes of media; it vanishes now and is removed in the background
+            await fileio.deletions.remove_tree(folder)
         self._users.pop(str(user_id), None)
         async with aiosqlite.connect(db_path, timeout=30.0) as db:
             await db.execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+            await db.commit()
+        async with shards.writer(user_id) as db:
             await db.execute("DELETE FROM messages WHERE chat_id = ?", (str(user_id),))
             await db.commit()
+            await shards.forget(user_id)
+        await archive.drop_chat(user_id)
+        self._bump(user_id)
 
     # unread count
     async def increment_unread(self, user_id):
@@ -181,7 +283,7 @@ class Storage:
     # messages
     async def save_message(self, user_id, msg: dict):
         uid = str(user_id)
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+        async with shards.writer(uid) as db:
             await db.execute("""
                 INSERT INTO messages (msg_id, chat_id, direction, timestamp, payload)
                 VALUES (?, ?, ?, ?, ?)
@@ -193,10 +295,51 @@ class Storage:
                 msg["msg_id"], uid, msg.get("direction"), msg.get("timestamp"), json.dumps(msg)
             ))
             await db.commit()
+        self._bump(uid)
+
+    async def save_messages(self, rows: list):
+        """save_message for many (user_id, msg) pairs: one transaction per shard, shards in parallel."""
+        if not rows:
+            return
+
+        async def write(db, batch):
+            await db.executemany("""
+                INSERT INTO messages (msg_id, chat_id, direction, timestamp, payload)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(msg_id, chat_id) DO UPDATE SET
+                    direction=excluded.direction,
+                    timestamp=excluded.timestamp,
+                    payload=excluded.payload
+            """, [(m["msg_id"], str(uid), m.get("direction"), m.get("timestamp"), json.dumps(m)) for uid, m in batch])
+            await db.commit()
+
+        async with shards.writers(uid for uid, _ in rows) as conns:
+            batches = {}
+            for uid, m in rows:
+                batches.setdefault(conns[str(uid)], []).append((uid, m))
+            await asyncio.gather(*(write(db, batch) for db, batch in batches.items()))
+        for uid, _ in rows:
+            self._bump(str(uid))
+
+    async def confirm_message(self, user_id, temp_id, msg: dict):
+        """Swap a pending outbox row (negative temp_id) for the sent message, atomically."""
+        uid = str(user_id)
+        async with shards.writer(uid) as db:
+            await db.execute("DELETE FROM messages WHERE chat_id = ? AND msg_id = ?", (uid, temp_id))
+            await db.execute("""
+                INSERT INTO messages (msg_id, chat_id, direction, timestamp, payload)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(msg_id, chat_id) DO UPDATE SET
+                    direction=excluded.direction,
+                    timestamp=excluded.timestamp,
+                    payload=excluded.payload
+            """, (msg["msg_id"], uid, msg.get("direction"), msg.get("timestamp"), json.dumps(msg)))
+            await db.commit()
+        self._bump(uid)
 
     async def get_messages(self, user_id, offset=0, limit=30):
         uid = str(user_id)
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+        async with aiosqlite.connect(shards.path(uid), timeout=30.0) as db:
             # Count total
             async with db.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (uid,)) as cursor:
                 total = (await cursor.fetchone())[0]
@@ -212,30 +355,119 @@ class Storage:
                 rows = await cursor.fetchall()
                 # we need to reverse rows so they return in chronological order [oldest ... newest]
                 msgs = [json.loads(r[0]) for r in reversed(rows)]
-                
+
+        # the page reaches past the hot rows: continue in the archive (offsets assume archived
+        # messages are older than every hot one; get_window merges the two tiers exactly)
+        if archive.count(uid):
+            if len(msgs) < limit:
+                msgs = await archive.newest(uid, max(0, offset - total), limit - len(msgs)) + msgs
+            total += archive.count(uid)
         return msgs, total
 
+    async def get_window(self, user_id, around=None, at=None, before=None, after=None, limit=30) -> dict | None:
+        """A page of history, oldest first, found by key instead of offset.
+
+        around=msg_id or at=date (first message at or after it) give a window
+        centered on that message; before / after take a cursor from a previous
+        page. Cursors are "timestamp~msg_id", so they stay valid when the
+        message they point at is deleted. Returns None when `around` is unknown.
+        """
+        uid = str(user_id)
+        async with aiosqlite.connect(shards.path(uid), timeout=30.0) as db:
+            async def page(op, key, n):
+                order = "DESC" if op[0] == "<" else "ASC"
+                async with db.execute(
+                    f"SELECT payload FROM messages WHERE chat_id = ? AND (timestamp, msg_id) {op} (?, ?) "
+                    f"ORDER BY timestamp {order}, msg_id {order} LIMIT ?", (uid, *key, n + 1)
+                ) as cursor:
+                    rows = [json.loads(r[0]) for r in await cursor.fetchall()]
+                edge = archive.edge(uid)
+                if edge and order == "DESC" and (len(rows) <= n or _key(rows[-1]) <= edge):
+                    rows = _merge(rows, await archive.before(uid, key, n + 1), n + 1, desc=True)
+                elif edge and order == "ASC" and key <= edge:
+                    rows = _merge(rows, await archive.after(uid, key, n + 1, inclusive=op == ">="), n + 1)
+                more = len(rows) > n
+                rows = rows[:n]
+                return (rows[::-1] if order == "DESC" else rows), more
+
+            target = None
+            if before is not None:
+                msgs, has_before = await page("<", _parse_cursor(before), limit)
+                has_after = True
+            elif after is not None:
+                msgs, has_after = await page(">", _parse_cursor(after), limit)
+                has_before = True
+            else:
+                key = None
+                if around is not None:
+                    async with db.execute("SELECT timestamp FROM messages WHERE chat_id = ? AND msg_id = ?",
+                                          (uid, int(around))) as cursor:
+                        row = await cursor.fetchone()
+                    if not row:
+                        cold = await archive.get(uid, around)
+                        if cold is None:
+                            return None
+                        row = (cold.get("timestamp"),)
+                    key = (row[0], int(around))
+                elif at is not None:
+                    async with db.execute(
+                        "SELECT timestamp, msg_id FROM messages WHERE chat_id = ? AND timestamp >= ? "
+                        "ORDER BY timestamp, msg_id LIMIT 1", (uid, str(at))
+                    ) as cursor:
+                        row = await cursor.fetchone()
+                    key = tuple(row) if row else None
+                    edge = archive.edge(uid)
+                    if edge and edge[0] >= str(at):
+                        cold = await archive.after(uid, (str(at), float("-inf")), 1, inclusive=True)
+                        if cold and (key is None or _key(cold[0]) < key):
+                            key = _key(cold[0])
+                if key is None:
+                    # nothing after the date (or no target at all): the newest page
+                    msgs, has_before = await page("<", ("\uffff", 0), limit)
+                    has_after = False
+                else:
+                    target = key[1]
+                    older, has_before = await page("<", key, limit // 2)
+                    newer, has_after = await page(">=", key, limit - len(older))
+                    msgs = older + newer
+
+        return {
+            "messages": msgs, "target": target,
+            "has_before": has_before, "has_after": has_after,
+            "before": message_cursor(msgs[0]) if msgs else before,
+            "after": message_cursor(msgs[-1]) if msgs else after,
+        }
+
     async def get_all_messages(self, user_id) -> list:
         uid = str(user_id)
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+        async with aiosqlite.connect(shards.path(uid), timeout=30.0) as db:
             async with db.execute("SELECT payload FROM messages WHERE chat_id = ? ORDER BY timestamp ASC", (uid,)) as cursor:
                 rows = await cursor.fetchall()
-                return [json.loads(r[0]) for r in rows]
+                msgs = [json.loads(r[0]) for r in rows]
+        if archive.edge(uid):
+            msgs = _merge(msgs, await archive.all(uid), None)
+        return msgs
 
     async def get_message_by_id(self, user_id, msg_id) -> dict | None:
         uid, mid = str(user_id), msg_id
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+        async with aiosqlite.connect(shards.path(uid), timeout=30.0) as db:
             async with db.execute("SELECT payload FROM messages WHERE chat_id = ? AND msg_id = ?", (uid, mid)) as cursor:
                 row = await cursor.fetchone()
                 if row:
                     return json.loads(row[0])
-        return None
+        return await archive.get(uid, mid)
 
     async def get_chat_id_by_msg_id(self, msg_id) -> str | None:
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
-            async with db.execute("SELECT chat_id FROM messages WHERE msg_id = ?", (msg_id,)) as cursor:
-                row = await cursor.fetchone()
-                return str(row[0]) if row else None
+        for path in shards.paths():
+            if not path.exists():
+                continue
+            async with aiosqlite.connect(path, timeout=30.0) as db:
+                async with db.execute("SELECT chat_id FROM messages WHERE msg_id = ?", (msg_id,)) as cursor:
+                    async for (chat_id,) in cursor:
+                        # skip copies left behind by an interrupted move
+                        if shards.path(chat_id) == path:
+                            return str(chat_id)
+        return await archive.chat_of(msg_id)
 
 
 
@@ -246,23 +478,71 @@ class Storage:
         # before wiping the rows from SQL.
         folder = self.get_user_folder(uid)
         
-        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+        async with shards.writer(uid) as db:
             if folder:
+                files = []
                 for mid in msg_ids:
                     async with db.execute("SELECT payload FROM messages WHERE chat_id = ? AND msg_id = ?", (uid, mid)) as cursor:
                         row = await cursor.fetchone()
                         if row:
                             msg = json.loads(row[0])
                             if msg.get("media_file"):
-                                fp = folder / "media" / msg["media_file"]
-                                if fp.exists():
-                                    fp.unlink()
+                                files.append(folder / "media" / msg["media_file"])
+                if files:
+                    await fileio.unlink(*files)
             
             # Now wipe rows
             placeholders = ",".join("?" for _ in msg_ids)
             await db.execute(f"DELETE FROM messages WHERE chat_id = ? AND msg_id IN ({placeholders})", [uid] + msg_ids)
             await db.commit()
 
+        cold = await archive.remove(uid, msg_ids)
+        if folder:
+            files = [folder / "media" / m["media_file"] for m in cold if m.get("media_file")]
+            if files:
+                await fileio.unlink(*files)
+        self._bump(uid)
+
+    async def archive_old(self, before: str) -> list:
+        """Move sent messages older than `before` into the archive. Returns the chats touched."""
+        chats = []
+        for path in shards.paths():
+            if not path.exists():
+                continue
+            async with aiosqlite.connect(path, timeout=30.0) as db:
+                async with db.execute("SELECT DISTINCT chat_id FROM messages WHERE timestamp < ? AND msg_id > 0",
+                                      (before,)) as cursor:
+                    chats += [r[0] for r in await cursor.fetchall() if shards.path(r[0]) == path]
+        for uid in chats:
+            while True:
+                async with shards.writer(uid) as db:
+                    async with db.execute(
+                        "SELECT payload FROM messages WHERE chat_id = ? AND timestamp < ? AND msg_id > 0 "
+                        "ORDER BY timestamp, msg_id LIMIT ?", (uid, before, archive_batch)
+                    ) as cursor:
+                        msgs = [json.loads(r[0]) for r in await cursor.fetchall()]
+                    if not msgs:
+                        break
+                    # archive first: a crash in between leaves a copy in both tiers, which reads tolerate
+                    await archive.store(uid, msgs)
+                    await db.executemany("DELETE FROM messages WHERE chat_id = ? AND msg_id = ?",
+                                         [(uid, m["msg_id"]) for m in msgs])
+                    await db.commit()
+                if len(msgs) < archive_batch:
+                    break
+        return chats
+
+    async def _rewrite(self, uid: str, m: dict):
+        """Store a changed message back in the tier it was read from. An archived message
+        saved hot would be in both tiers, and offset paging would list and count it twice."""
+        async with shards.writer(uid) as db:
+            cursor = await db.execute("UPDATE messages SET payload = ? WHERE chat_id = ? AND msg_id = ?",
+                                      (json.dumps(m), uid, m["msg_id"]))
+            await db.commit()
+            if not cursor.rowcount and await archive.get(uid, m["msg_id"]) is not None:
+                await archive.store(uid, [m])
+        self._bump(uid)
+
     async def add_reaction(self, user_id, msg_id, emoji, reactor="me", reactor_name=None):
         uid = str(user_id)
         m = await self.get_message_by_id(uid, msg_id)
@@ -287,7 +567,20 @@ class Storage:
             m.pop("reactions", None)
             m.pop("reactor_names", None)
             
-        await self.save_message(uid, m)
+        await self._rewrite(uid, m)
+
+    async def set_reaction(self, user_id, msg_id, emoji, reactor, reactor_name=None):
+        """Set a reactor's emoji outright (no toggling), so replaying an update is harmless."""
+        uid = str(user_id)
+        m = await self.get_message_by_id(uid, msg_id)
+        if not m:
+            return
+        if m.get("reactions", {}).get(str(reactor)) == emoji:
+            return
+        m.setdefault("reactions", {})[str(reactor)] = emoji
+        if reactor_name:
+            m.setdefault("reactor_names", {})[str(reactor)] = reactor_name
+        await self._rewrite(uid, m)
 
     async def remove_reaction(self, user_id, msg_id, reactor="me"):
         uid = str(user_id)
@@ -302,12 +595,12 @@ class Storage:
             if not m["reactions"]:
                 m.pop("reactions", None)
                 m.pop("reactor_names", None)
-            await self.save_message(uid, m)
+            await self._rewrite(uid, m)
 
     async def edit_message(self, user_id, msg_id, new_text):
         uid = str(user_id)
         m = await self.get_message_by_id(uid, msg_id)
-        if not m:
+        if not m or m.get("text", "") == new_text:
             return
             
         if "edit_history" not in m:
@@ -319,7 +612,91 @@ class Storage:
         m["text"] = new_text
         m["edited"] = True
         
-        await self.save_message(uid, m)
+        await self._rewrite(uid, m)
+
+    # change log
+    async def append_change(self, event: dict) -> int:
+        """Record a websocket event and return its sequence number once it is committed.
+
+        Seqs are assigned in call order. Events that arrive while a commit is in flight share
+        the next one, so a burst costs one commit rather than one each, and callers are woken
+        in seq order.
+        """
+        self._seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._change_buf.append((self._seq, event, fut))
+        if self._change_writer is None or self._change_writer.done():
+            self._change_writer = asyncio.create_task(self._write_changes())
+        return await fut
+
+    async def _write_changes(self):
+        while self._change_buf:
+            batch, self._change_buf = self._change_buf, []
+            try:
+                async with aiosqlite.connect(db_path, timeout=30.0) as db:
+                    await db.executemany(
+                        "INSERT INTO changes (seq, chat_id, type, payload) VALUES (?, ?, ?, ?)",
+                        [(seq, str(e.get("user_id")), e.get("type"), json.dumps(e, default=str))
+                         for seq, e, _ in batch])
+                    self._changes_since_trim += len(batch)
+                    if self._changes_since_trim >= 100:
+                        self._changes_since_trim = 0
+                        await db.execute("DELETE FROM changes WHERE seq <= ?", (batch[-1][0] - change_log_size,))
+                    await db.commit()
+            except Exception as exc:
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                continue
+            for seq, _, fut in batch:
+                if not fut.done():
+                    fut.set_result(seq)
+
+    async def last_change_seq(self) -> int:
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT MAX(seq) FROM changes") as cursor:
+                return (await cursor.fetchone())[0] or 0
+
+    async def get_changes(self, since: int, limit=500):
+        """Changes after `since`, plus the newest seq and whether `since` fell off the log."""
+        async with aiosqlite.connect(db_path, timeout=30.0) as db:
+            async with db.execute("SELECT MIN(seq), MAX(seq) FROM changes") as cursor:
+                oldest, last = await cursor.fetchone()
+            async with db.execute(
+                "SELECT seq, payload FROM changes WHERE seq > ? ORDER BY seq LIMIT ?", (since, limit)
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+        changes = []
+        for seq, payload in rows:
+            event = json.loads(payload)
+            event["seq"] = seq
+            changes.append(event)
+
+        last = last or 0
+        # gap if entries after `since` were trimmed, or the db is older than the client
+        reset = (oldest is not None and since < oldest - 1) or since > last
+        return changes, last, reset
+
+
+def _merge(hot: list, cold: list, n: int | None, desc=False) -> list:
+    """Hot and archived messages in key order, first n. A message in both tiers is taken from the hot one."""
+    seen = {m["msg_id"] for m in hot}
+    rows = hot + [m for m in cold if m["msg_id"] not in seen]
+    rows.sort(key=_key, reverse=desc)
+    return rows if n is None else rows[:n]
+
+
+def message_cursor(msg: dict) -> str:
+    return f"{msg.get('timestamp')}~{msg['msg_id']}"
+
+
+def _parse_cursor(cursor: str) -> tuple:
+    ts, _, mid = str(cursor).rpartition("~")
+    if not ts:
+        raise ValueError(f"bad cursor: {cursor!r}")
+    return ts, int(mid)
 
 
+instrument(Storage, storage_seconds, span="db")
 storage = Storage()
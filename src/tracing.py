@@ -0,0 +1,116 @@
+"""
+Per-request tracing and an on-demand sampling profiler.
+
+The middleware gives every request a span dict in a contextvar; storage,
+Bot API and serialization code add their elapsed time to it, and requests
+slower than slow_request_ms are printed with that breakdown. The profiler
+samples the event loop thread's stack from a side thread and returns
+collapsed stacks ("a;b;c count" lines) that flamegraph.pl / speedscope read.
+"""
+
+import asyncio
+import contextvars
+import sys
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from src.config import slow_request_ms
+from src.log import get_logger
+
+log = get_logger("tracing")
+
+_spans: contextvars.ContextVar[dict | None] = contextvars.ContextVar("spans", default=None)
+
+
+def record(kind: str, seconds: float):
+    """Add time to the current request's span, if there is one."""
+    spans = _spans.get()
+    if spans is not None:
+        spans[kind] = spans.get(kind, 0.0) + seconds
+
+
+class span:
+    """with span("serialize"): ... adds the block's duration to the request trace."""
+    __slots__ = ("kind", "start")
+
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.kind, time.perf_counter() - self.start)
+
+
+def _route(request: web.Request) -> str:
+    info = request.match_info.route.resource
+    return info.canonical if info is not None else request.path
+
+
+@web.middleware
+async def trace_middleware(request: web.Request, handler):
+    # websockets live for hours, timing them says nothing
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await handler(request)
+
+    spans = {}
+    token = _spans.set(spans)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        _spans.reset(token)
+        total = time.perf_counter() - start
+        if total * 1000 >= slow_request_ms:
+            spans["other"] = max(0.0, total - sum(spans.values()))
+            log.warning("slow request", extra={
+                "method": request.method, "route": _route(request), "status": status,
+                "ms": round(total * 1000, 1),
+                **{f"{k}_ms": round(v * 1000, 1) for k, v in spans.items()},
+                "params": {**request.match_info, **request.query},
+            })
+
+
+class Profiler:
+    """Samples one thread's stack at a fixed interval and counts collapsed stacks."""
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def run(self, seconds: float, interval: float = 0.005) -> str:
+        async with self._lock:
+            target = threading.get_ident()
+            return await asyncio.to_thread(self._sample, target, seconds, interval)
+
+    @staticmethod
+    def _sample(target: int, seconds: float, interval: float) -> str:
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+profiler = Profiler()
@@ -0,0 +1,144 @@
+"""
+Multi-process web tier. The primary process owns the Telegram clients and
+every storage write; web workers share the public port (SO_REUSEPORT),
+serve reads and websockets straight from SQLite, and proxy everything else
+to the primary over a unix socket.
+"""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+
+import aiohttp
+from aiohttp import web
+
+from src.acl import acl
+from src.archive import archive
+from src.config import base_dir, change_log_size
+from src.log import get_logger
+from src.shards import shards
+from src.storage import storage
+from src.ws_hub import publish
+
+log = get_logger("workers")
+
+# hop-by-hop and length headers aiohttp sets itself
+_skip_headers = {"host", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+def supported() -> bool:
+    return sys.platform != "win32" and hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX")
+
+
+# worker side
+
+def proxy_to_primary(app: web.Application, primary_socket):
+    """Forward every route this worker doesn't serve itself to the primary."""
+    async def on_startup(app):
+        app["primary"] = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=str(primary_socket)), auto_decompress=False)
+
+    async def on_cleanup(app):
+        await app["primary"].close()
+
+    async def proxy(request):
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in _skip_headers}
+        async with request.app["primary"].request(
+            request.method, f"http://primary{request.rel_url}",
+            headers=headers, data=await request.read(), allow_redirects=False,
+        ) as r:
+            out = {k: v for k, v in r.headers.items() if k.lower() not in _skip_headers}
+            return web.Response(status=r.status, body=await r.read(), headers=out)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_route("*", "/api/{tail:.*}", proxy)
+
+
+async def primary_metrics(app: web.Application) -> str:
+    """The primary's /metrics; it only listens on its unix socket, so workers serve it. Empty if it's down."""
+    try:
+        async with app["primary"].get("http://primary/metrics", timeout=aiohttp.ClientTimeout(total=5)) as r:
+            return await r.text() if r.status == 200 else ""
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        log.warning("could not fetch the primary's metrics")
+        return ""
+
+
+class WorkerSync:
+    """Applies bus events to this worker's view of storage, then fans them out."""
+    def __init__(self):
+        self.last_seq = 0
+
+    async def on_event(self, data: dict):
+        if data.get("type", "").startswith("acl_"):
+            await acl.apply_remote(data)
+            return
+        if data.get("type") == "archive_reload":
+            await archive.reload(data.get("chat_ids"))
+            return
+        if data.get("type") == "shard_route":
+            shards.apply_remote(data)
+            return
+        seq = data.get("seq")
+        if seq is not None:
+            if seq <= self.last_seq:
+                return
+            self.last_seq = seq
+        storage.apply_remote_event(data)
+        publish(data)
+
+    async def catch_up(self):
+        """Replay whatever the primary published while the bus was down."""
+        await acl.reload()
+        await shards.reload()
+        changes, _, reset = await storage.get_changes(self.last_seq, limit=change_log_size)
+        if reset:
+            await storage.load_users()
+            storage.touch_all()
+            return
+        for c in changes:
+            await self.on_event(c)
+
+
+# primary side
+
+class WorkerPool:
+    """Spawns the web workers and restarts any that die."""
+    def __init__(self, count: int):
+        self.count = count
+        self._procs: dict[int, subprocess.Popen] = {}
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        env = {**os.environ, "TELECHAT_WORKER": str(index)}
+        self._procs[index] = subprocess.Popen([sys.executable, str(base_dir / "bot.py")], env=env)
+
+    async def start(self):
+        for i in range(self.count):
+            self._spawn(i)
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        while not self._stopping:
+            await asyncio.sleep(1)
+            for i, p in list(self._procs.items()):
+                if p.poll() is not None and not self._stopping:
+                    log.warning("worker exited, restarting", extra={"worker": i, "returncode": p.returncode})
+                    self._spawn(i)
+
+    async def stop(self):
+        self._stopping = True
+        if self._task:
+            self._task.cancel()
+        for p in self._procs.values():
+            if p.poll() is None:
+                p.terminate()
+        for p in self._procs.values():
+            try:
+                await asyncio.to_thread(p.wait, 10)
+            except subprocess.TimeoutExpired:
+                p.kill()
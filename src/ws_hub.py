@@ -0,0 +1,211 @@
+"""
+WebSocket fan-out. Every connection gets a bounded outbound queue drained by
+its own writer task, so publishing an event never waits on a socket.
+"""
+
+import asyncio
+import json
+from collections import deque
+
+from aiohttp import WSCloseCode
+
+from src.config import ws_queue_size, ws_overflow_policy, ws_batch_ms
+
+# events that only ever matter in their latest form (chat_updated is keyed per chat)
+_coalescable = ("reaction_update", "message_edited")
+
+
+class WsClient:
+    """One connected browser: its socket, outbound queue and writer task."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.dropped = 0
+        # topics: until the client subscribes it gets everything (old frontends)
+        self.subscribed = False
+        self.chat: str | None = None
+        self.chat_list = True
+        self._queue: deque = deque()  # (coalesce key, payload)
+        self._held: list | None = None  # live frames parked while a backlog is replayed
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, chat_id=None, chat_list=True):
+        """Limit this client to one open chat plus, optionally, the chat-list channel."""
+        self.subscribed = True
+        self.chat = str(chat_id) if chat_id is not None else None
+        self.chat_list = bool(chat_list)
+
+    def wants(self, data: dict) -> bool:
+        if not self.subscribed:
+            return True
+        # chat list deltas and events that belong to no chat (e.g. broadcast progress)
+        if data.get("type") == "chat_updated" or "user_id" not in data:
+            return self.chat_list
+        return self.chat is not None and str(data.get("user_id")) == self.chat
+
+    def hold(self):
+        """Park live frames until release(), so a replayed backlog goes out first."""
+        self._held = []
+
+    def release(self, backlog: list, hello: str, upto: int) -> bool:
+        """Queue the replayed backlog and hello ahead of the parked live frames, then those
+        of the parked frames the backlog didn't cover. The backlog bypasses the queue limit;
+        one that wouldn't fit becomes a resync, so the client reloads instead of missing the
+        start of it. Returns False if the client must be dropped."""
+        held, self._held = self._held or [], None
+        if len(backlog) > ws_queue_size:
+            backlog = [json.dumps({"type": "resync", "seq": upto})]
+        self._queue.extend((None, payload) for payload in (*backlog, hello))
+        self._wakeup.set()
+        return all(self.send(payload, key) for payload, key, seq in held if seq is None or seq > upto)
+
+    def send(self, payload: str, key=None, seq=None) -> bool:
+        """Queue a frame without blocking. Returns False if the client must be dropped."""
+        if self._held is not None:
+            self._held.append((payload, key, seq))
+            return True
+        if len(self._queue) >= ws_queue_size:
+            if ws_overflow_policy == "disconnect":
+                return False
+            self.dropped += 1
+            if ws_overflow_policy == "coalesce" and key is not None:
+                for i, (k, _) in enumerate(self._queue):
+                    if k == key:
+                        del self._queue[i]
+                        break
+                else:
+                    self._queue.popleft()
+            else:
+                self._queue.popleft()
+        self._queue.append((key, payload))
+        self._wakeup.set()
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, payload = self._queue.popleft()
+                await self.ws.send_str(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # socket is gone; the handler loop notices and cleans up
+            ws_clients.discard(self)
+
+    async def kick(self):
+        """Disconnect a client that can't keep up."""
+        await self.stop()
+        try:
+            await self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"too slow")
+        except Exception:
+            pass
+
+
+ws_clients: set[WsClient] = set()
+
+# extra consumers of every event, e.g. the bus feeding web worker processes
+forwarders: list = []
+
+# newest change-log seq handed to the connected clients; a new client's hello can't claim more
+delivered_seq = 0
+
+
+def _delivered(events):
+    global delivered_seq
+    seqs = [e["seq"] for e in events if e.get("seq") is not None]
+    if seqs:
+        delivered_seq = max(delivered_seq, *seqs)
+
+
+def _coalesce_key(data: dict):
+    if data.get("type") in _coalescable:
+        return (data["type"], str(data.get("user_id")), data.get("msg_id"))
+    if data.get("type") == "chat_updated":
+        return ("chat_updated", str(data.get("user_id")))
+    if data.get("type") == "broadcast_progress":
+        return ("broadcast_progress", data["job"]["id"])
+    return None
+
+
+def coalesce(events: list) -> list:
+    """Drop events superseded by a later one with the same key, keeping order."""
+    seen = set()
+    kept = []
+    for e in reversed(events):
+        key = _coalesce_key(e)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(e)
+    kept.reverse()
+    return kept
+
+
+def _deliver(client: WsClient, payload: str, key=None, seq=None):
+    if not client.send(payload, key, seq):
+        ws_clients.discard(client)
+        asyncio.ensure_future(client.kick())
+
+
+def publish(data: dict):
+    """Queue a json payload for every connected client. Never awaits a socket."""
+    for forward in forwarders:
+        forward(data)
+
+    if ws_batch_ms > 0:
+        _pending.append(data)
+        if len(_pending) == 1:
+            asyncio.get_running_loop().call_later(ws_batch_ms / 1000, _flush)
+        return
+
+    _delivered((data,))
+    targets = [c for c in ws_clients if c.wants(data)]
+    if not targets:
+        return
+    payload = json.dumps(data, default=str)
+    key = _coalesce_key(data)
+    seq = data.get("seq")
+    for client in targets:
+        _deliver(client, payload, key, seq)
+
+
+# batching: events collected during one window go out as a single frame
+_pending: list = []
+
+
+def _flush():
+    _delivered(_pending)
+    events = coalesce(_pending)
+    _pending.clear()
+    if not ws_clients:
+        return
+
+    encoded = [json.dumps(e, default=str) for e in events]
+    for client in list(ws_clients):
+        mine = [i for i, e in enumerate(events) if client.wants(e)]
+        if not mine:
+            continue
+        if len(mine) == 1:
+            e = events[mine[0]]
+            _deliver(client, encoded[mine[0]], _coalesce_key(e), e.get("seq"))
+            continue
+        payload = '{"type": "batch", "events": [' + ", ".join(encoded[i] for i in mine) + "]}"
+        seqs = [events[i]["seq"] for i in mine if events[i].get("seq") is not None]
+        _deliver(client, payload, None, max(seqs) if seqs else None)
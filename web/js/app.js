@@ -2,19 +2,29 @@
 const s = {
   ws: null,
   currentUserId: null,
-  users: [],
+  users: [], // loaded pages of the chat list, newest activity first
+  usersHasMore: false,
+  usersLoading: false,
+  usersQuery: '',
   selectedMsgs: new Set(),
   selecting: false,
   replyTo: null,
-  offset: 0,
-  hasMore: false,
+  before: null, // cursor of the oldest loaded message
+  after: null, // cursor of the newest loaded message
+  hasMore: false, // older messages exist
+  hasAfter: false, // window is detached from the newest end (after a jump)
   loading: false,
   emojiOpen: false,
   forwardTargets: new Set(),
+  forwardQuery: '', // search in the forward dialog, separate from the chat list's
+  forwardLoaded: 0, // chats listed in the forward dialog so far
+  forwardHasMore: false,
+  forwardLoading: false,
   pendingFiles: [], // File objects
   dragSelecting: false,
   contextMenuEl: null,
   contextMsgId: null,
+  lastSeq: null, // newest change-log seq applied to this page
   groupMembers: {} // chat_id -> {id: name}
 };
 
@@ -65,6 +75,8 @@ const messagesEl = $('messages');
 const messagesWrap = $('messagesWrap');
 const loadMoreDiv = $('loadMore');
 const loadMoreBtn = $('loadMoreBtn');
+const jumpLatestBtn = $('jumpLatestBtn');
+const jumpDateInput = $('jumpDate');
 const msgInput = $('msgInput');
 const sendBtn = $('sendBtn');
 const attachBtn = $('attachBtn');
@@ -85,6 +97,7 @@ const sidebar = $('sidebar');
 const backBtn = $('backBtn');
 const forwardModal = $('forwardModal');
 const forwardList = $('forwardUserList');
+const forwardSearch = $('forwardSearch');
 const mediaViewer = $('mediaViewer');
 const mediaContent = $('mediaContent');
 const filePreviewBar = $('filePreviewBar');
@@ -113,33 +126,97 @@ async function api(url, opts = {}) {
 // WebSocket
 function connectWS() {
   const proto = location.protocol === 'https:' ? 'wss' : 'ws';
-  s.ws = new WebSocket(`${proto}://${location.host}/ws`);
-  s.ws.onmessage = e => {
+  // resume from the last change we applied; the server replays the gap
+  const q = new URLSearchParams({ list: '1' });
+  if (s.currentUserId) q.set('chat', s.currentUserId);
+  if (s.lastSeq !== null) q.set('since', s.lastSeq);
+  const ws = new WebSocket(`${proto}://${location.host}/ws?${q}`);
+  s.ws = ws;
+  let lastPong = Date.now();
+  // app-level keepalive: a half-open socket never fires onclose on its own
+  const keepalive = setInterval(() => {
+    if (Date.now() - lastPong > 60000) { ws.close(); return; }
+    if (ws.readyState === WebSocket.OPEN) ws.send('{"type":"ping"}');
+  }, 25000);
+  ws.onmessage = e => {
     const d = JSON.parse(e.data);
-    if (d.type === 'new_message') onNewMessage(d);
-    if (d.type === 'message_sent') onMessageSent(d);
-    if (d.type === 'messages_deleted') onMessagesDeleted(d);
-    if (d.type === 'reaction_update') onReactionUpdate(d);
-    if (d.type === 'message_edited') onMessageEdited(d);
+    lastPong = Date.now();
+    // a batch frame carries several events collected over a short window
+    if (d.type === 'batch') d.events.forEach(applyEvent);
+    else applyEvent(d);
+  };
+  ws.onclose = () => {
+    clearInterval(keepalive);
+    setTimeout(connectWS, 2000);
   };
-  s.ws.onclose = () => setTimeout(connectWS, 2000);
+}
+
+function applyEvent(d) {
+  if (d.seq != null && d.type !== 'hello' && d.type !== 'resync') {
+    if (s.lastSeq !== null && d.seq <= s.lastSeq) return; // already applied
+    s.lastSeq = d.seq;
+  }
+  if (d.type === 'hello') s.lastSeq = Math.max(s.lastSeq ?? 0, d.seq);
+  if (d.type === 'resync') onResync(d);
+  if (d.type === 'chat_updated') onChatUpdated(d);
+  if (d.type === 'new_message') onNewMessage(d);
+  if (d.type === 'message_sent') onMessageSent(d);
+  if (d.type === 'message_confirmed') onMessageConfirmed(d);
+  if (d.type === 'message_failed') onMessageFailed(d);
+  if (d.type === 'messages_deleted') onMessagesDeleted(d);
+  if (d.type === 'reaction_update') onReactionUpdate(d);
+  if (d.type === 'message_edited') onMessageEdited(d);
+}
+
+// we were away longer than the change log reaches back: reload everything
+async function onResync(d) {
+  s.lastSeq = d.seq;
+  await refreshUsers();
+  if (s.currentUserId) await jumpToLatest();
+}
+
+// only the open chat plus the chat-list channel
+function subscribeWS() {
+  if (!s.ws || s.ws.readyState !== WebSocket.OPEN) return;
+  s.ws.send(JSON.stringify({ type: 'subscribe', chat_id: s.currentUserId, chat_list: true }));
+}
+
+function onChatUpdated(d) {
+  const uid = String(d.user_id);
+  const i = s.users.findIndex(x => String(x.user_id) === uid);
+  if (i >= 0) s.users[i] = { ...s.users[i], ...d.chat };
+  else if (matchesSearch(d.chat)) s.users.push(d.chat);
+  else return;
+  s.users.sort(byLastSeen);
+  updateChatItem(s.users.find(x => String(x.user_id) === uid));
 }
 
 function onNewMessage(d) {
-  refreshUsers();
   if (String(d.user_id) === String(s.currentUserId)) {
+    if (s.hasAfter) return; // looking at older history; it shows up on the way back down
     appendMessage(d.message);
     scrollBottom();
     clearUnread(d.user_id);
   }
 }
 function onMessageSent(d) {
-  refreshUsers();
   if (String(d.user_id) === String(s.currentUserId)) {
-    appendMessage(d.message);
+    // our own optimistic row, or the same send seen from another tab
+    if (!replaceMessage(d.message, d.message.client_id) && !s.hasAfter) appendMessage(d.message);
     scrollBottom();
   }
 }
+// the outbox delivered a send: swap the pending row for the real message
+function onMessageConfirmed(d) {
+  if (String(d.user_id) === String(s.currentUserId)) {
+    if (!replaceMessage(d.message, d.client_id, d.temp_id) && !s.hasAfter) appendMessage(d.message);
+  }
+}
+function onMessageFailed(d) {
+  if (String(d.user_id) !== String(s.currentUserId)) return;
+  const row = findOutgoingRow(d.client_id, d.temp_id);
+  if (row) markFailed(row, d.error);
+}
 function onMessagesDeleted(d) {
   if (String(d.user_id) === String(s.currentUserId)) {
     d.msg_ids.forEach(id => {
@@ -147,7 +224,6 @@ function onMessagesDeleted(d) {
       if (el) el.remove();
     });
   }
-  refreshUsers();
 }
 
 function onReactionUpdate(d) {
@@ -187,61 +263,118 @@ function onMessageEdited(d) {
   }
 }
 
-// users
+// users: the server pages, sorts and searches; we keep what has been scrolled into view
+async function fetchUsers(offset) {
+  const q = new URLSearchParams({ offset, sort: 'recent' });
+  if (s.usersQuery) q.set('q', s.usersQuery);
+  return api(`/api/users?${q}`);
+}
+
 async function refreshUsers() {
-  s.users = await api('/api/users');
+  const query = s.usersQuery;
+  const page = await fetchUsers(0);
+  if (query !== s.usersQuery) return; // a newer search is already on its way
+  s.users = page.users;
+  s.usersHasMore = page.has_more;
   renderUserList(s.users);
 }
 
-function renderUserList(users) {
-  const q = searchInput.value.trim().toLowerCase();
-  const filtered = q ? users.filter(u =>
+async function loadMoreUsers() {
+  if (!s.usersHasMore || s.usersLoading) return;
+  s.usersLoading = true;
+  const query = s.usersQuery;
+  try {
+    const page = await fetchUsers(s.users.length);
+    if (query !== s.usersQuery) return;
+    const have = new Set(s.users.map(u => String(u.user_id)));
+    page.users.forEach(u => { if (!have.has(String(u.user_id))) s.users.push(u); });
+    s.usersHasMore = page.has_more;
+    renderUserList(s.users);
+  } finally {
+    s.usersLoading = false;
+  }
+}
+
+function byLastSeen(a, b) {
+  return (b.last_seen || '').localeCompare(a.last_seen || '');
+}
+
+// same rule as the server's ?q=, for chats that arrive over the websocket
+function matchesSearch(u) {
+  const q = s.usersQuery.toLowerCase();
+  return !q ||
     (u.full_name || '').toLowerCase().includes(q) ||
-    (u.username || '').toLowerCase().includes(q)
-  ) : users;
+    (u.username || '').toLowerCase().includes(q);
+}
 
-  emptyUsers.classList.toggle('hidden', filtered.length > 0);
+function renderUserList(users) {
+  emptyUsers.classList.toggle('hidden', users.length > 0);
 
-  const newIds = new Set(filtered.map(u => String(u.user_id)));
+  const newIds = new Set(users.map(u => String(u.user_id)));
 
   // remove old
   chatList.querySelectorAll('.chat-item').forEach(el => {
     if (!newIds.has(el.dataset.uid)) el.remove();
   });
 
-  filtered.forEach(u => {
-    const uid = String(u.user_id);
-    let el = chatList.querySelector(`.chat-item[data-uid="${uid}"]`);
-    if (!el) {
-      el = document.createElement('div');
-      el.className = 'chat-item';
-      el.dataset.uid = uid;
-      el.onclick = () => selectChat(u.user_id);
-      chatList.appendChild(el);
-    }
-    const lm = u.last_message;
-    const preview = lm ? (lm.media_type ? `📎 ${lm.media_type}` : lm.text || '') : '';
-    const time = lm ? fmtTime(lm.timestamp) : '';
-    const badge = u.unread_count > 0 ? `<span class="chat-badge">${u.unread_count}</span>` : '';
-
-    el.innerHTML = `
-      <div class="chat-avatar" style="background:${avatarColor(u.user_id)}">${avatarHtml(u.user_id, u.full_name)}</div>
-      <div class="chat-meta">
-        <div class="chat-name">${esc(u.full_name)} ${u.is_banned ? '<span style="color:var(--danger);font-size:11px;">(Blocked)</span>' : ''}</div>
-        <div class="chat-preview">${esc(preview).slice(0, 50)}</div>
-      </div>
-      <div class="chat-right">
-        <span class="chat-time">${time}</span>
-        ${badge}
-      </div>`;
-    el.classList.toggle('active', uid === String(s.currentUserId));
-  });
+  // appendChild moves existing nodes, so this also fixes the order
+  users.forEach(u => chatList.appendChild(renderChatItem(u)));
+}
+
+function renderChatItem(u) {
+  const uid = String(u.user_id);
+  let el = chatList.querySelector(`.chat-item[data-uid="${uid}"]`);
+  if (!el) {
+    el = document.createElement('div');
+    el.className = 'chat-item';
+    el.dataset.uid = uid;
+    el.onclick = () => selectChat(u.user_id);
+  }
+  const lm = u.last_message;
+  const preview = lm ? (lm.media_type ? `📎 ${lm.media_type}` : lm.text || '') : '';
+  const time = lm ? fmtTime(lm.timestamp) : '';
+  const badge = u.unread_count > 0 ? `<span class="chat-badge">${u.unread_count}</span>` : '';
+
+  el.innerHTML = `
+    <div class="chat-avatar" style="background:${avatarColor(u.user_id)}">${avatarHtml(u.user_id, u.full_name)}</div>
+    <div class="chat-meta">
+      <div class="chat-name">${esc(u.full_name)} ${u.is_banned ? '<span style="color:var(--danger);font-size:11px;">(Blocked)</span>' : ''}</div>
+      <div class="chat-preview">${esc(preview).slice(0, 50)}</div>
+    </div>
+    <div class="chat-right">
+      <span class="chat-time">${time}</span>
+      ${badge}
+    </div>`;
+  el.classList.toggle('active', uid === String(s.currentUserId));
+  return el;
+}
+
+// re-render one row in place and move it to its sorted position
+function updateChatItem(u) {
+  if (!u) return;
+  const uid = String(u.user_id);
+  if (!matchesSearch(u)) {
+    const old = chatList.querySelector(`.chat-item[data-uid="${uid}"]`);
+    if (old) old.remove();
+    return;
+  }
+  const el = renderChatItem(u);
+  const idx = s.users.indexOf(u);
+  let next = null;
+  for (let i = idx + 1; i < s.users.length && !next; i++) {
+    next = chatList.querySelector(`.chat-item[data-uid="${s.users[i].user_id}"]`);
+  }
+  if (next) chatList.insertBefore(el, next);
+  else chatList.appendChild(el);
+  emptyUsers.classList.add('hidden');
 }
 
 // select chat
 async function selectChat(userId) {
   s.currentUserId = String(userId);
-  s.offset = 0;
+  subscribeWS();
+  s.before = s.after = null;
+  s.hasAfter = false;
   s.selectedMsgs.clear();
   s.selecting = false;
   s.replyTo = null;
@@ -272,9 +405,7 @@ async function selectChat(userId) {
   sidebar.classList.add('collapsed');
 
   // load messages
-  messagesEl.innerHTML = '';
-  await loadMessages(false);
-  scrollBottom(true);
+  await jumpToLatest();
 
   // mark read
   clearUnread(userId);
@@ -287,13 +418,29 @@ async function selectChat(userId) {
   msgInput.focus();
 }
 
+// history is paged by cursor: older pages with before=, newer with after=
+function historyUrl(params) {
+  return `/api/messages/${s.currentUserId}?` + new URLSearchParams({ limit: 30, ...params });
+}
+function setWindow(data, { older = true, newer = true } = {}) {
+  if (older) {
+    s.before = data.before;
+    s.hasMore = data.has_before ?? data.has_more;
+    loadMoreDiv.classList.toggle('hidden', !s.hasMore);
+  }
+  if (newer) {
+    s.after = data.after;
+    s.hasAfter = !!data.has_after;
+    jumpLatestBtn.classList.toggle('hidden', !s.hasAfter);
+  }
+}
+
 async function loadMessages(prepend = true) {
   if (s.loading) return;
   s.loading = true;
-  const data = await api(`/api/messages/${s.currentUserId}?offset=${s.offset}&limit=30`);
-  s.hasMore = data.has_more;
-  loadMoreDiv.classList.toggle('hidden', !s.hasMore);
-  s.offset += data.messages.length;
+  const data = await api(prepend && s.before ? historyUrl({ before: s.before }) : historyUrl({}))
+    .finally(() => { s.loading = false; });
+  setWindow(data, { older: true, newer: !prepend });
 
   if (prepend && data.messages.length) {
     const prevH = messagesWrap.scrollHeight;
@@ -305,7 +452,52 @@ async function loadMessages(prepend = true) {
   } else {
     data.messages.forEach(m => appendMessage(m));
   }
+}
+
+async function loadNewer() {
+  if (s.loading || !s.hasAfter) return;
+  s.loading = true;
+  const data = await api(historyUrl({ after: s.after })).finally(() => { s.loading = false; });
+  data.messages.forEach(m => appendMessage(m));
+  setWindow(data, { older: false });
+}
+
+// back to the live end of the chat
+async function jumpToLatest() {
+  s.before = s.after = null;
+  s.hasAfter = false;
   s.loading = false;
+  messagesEl.innerHTML = '';
+  await loadMessages(false);
+  scrollBottom(true);
+}
+
+// open a window centered on a message ({around: msg_id}) or a day ({at: 'YYYY-MM-DD'}), in one request
+async function jumpTo(params) {
+  const shown = params.around != null && messagesEl.querySelector(`.msg-row[data-id="${params.around}"]`);
+  if (shown) return flashRow(shown);
+  if (s.loading) return;
+  s.loading = true;
+  let data;
+  try {
+    data = await api(historyUrl({ ...params, limit: 50 }));
+  } catch (e) {
+    return;
+  } finally {
+    s.loading = false;
+  }
+  messagesEl.innerHTML = '';
+  data.messages.forEach(m => appendMessage(m));
+  setWindow(data);
+  const target = data.target != null && messagesEl.querySelector(`.msg-row[data-id="${data.target}"]`);
+  if (target) flashRow(target, 'auto');
+  else scrollBottom(true);
+}
+
+function flashRow(row, behavior = 'smooth') {
+  row.scrollIntoView({ behavior, block: 'center' });
+  row.style.outline = '2px solid var(--accent)';
+  setTimeout(() => row.style.outline = '', 1500);
 }
 
 // messages
@@ -313,6 +505,9 @@ function createMsgRow(m) {
   const row = document.createElement('div');
   row.className = `msg-row ${m.direction === 'in' ? 'in-row' : 'out-row'}${s.selecting ? ' selecting' : ''}`;
   row.dataset.id = m.msg_id;
+  if (m.client_id) row.dataset.client = m.client_id;
+  if (m.status === 'pending') row.classList.add('pending');
+  if (m.status === 'failed') markFailed(row, m.error);
 
   // checkbox for selection
   const cb = document.createElement('input');
@@ -439,21 +634,16 @@ function createMsgBubble(m) {
 
   // time + edited label
   const editedLabel = m.edited ? `<span class="msg-edited-label" data-msgid="${m.msg_id}">edited</span>` : '';
-  html += `<div class="msg-time">${editedLabel}${fmtTime(m.timestamp)}</div>`;
+  const statusIcon = m.status === 'pending' ? '<span class="msg-status">🕓</span>'
+    : m.status === 'failed' ? '<span class="msg-status">⚠</span>' : '';
+  html += `<div class="msg-time">${editedLabel}${fmtTime(m.timestamp)}${statusIcon}</div>`;
 
   div.innerHTML = html;
 
   // reply link click
   const replyEl = div.querySelector('.msg-reply');
   if (replyEl) {
-    replyEl.addEventListener('click', () => {
-      const target = document.querySelector(`.msg-row[data-id="${m.reply_to}"]`);
-      if (target) {
-        target.scrollIntoView({ behavior: 'smooth', block: 'center' });
-        target.style.outline = '2px solid var(--accent)';
-        setTimeout(() => target.style.outline = '', 1500);
-      }
-    });
+    replyEl.addEventListener('click', () => jumpTo({ around: m.reply_to }));
   }
 
   // edited label click
@@ -550,6 +740,26 @@ function appendMessage(m) {
   messagesEl.appendChild(createMsgRow(m));
 }
 
+// outgoing messages: a client id is attached before the server has assigned any msg_id
+function newClientId() {
+  return Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+}
+function findOutgoingRow(clientId, tempId) {
+  return (clientId && messagesEl.querySelector(`.msg-row[data-client="${clientId}"]`))
+    || (tempId != null && messagesEl.querySelector(`.msg-row[data-id="${tempId}"]`));
+}
+function replaceMessage(m, clientId, tempId) {
+  const row = findOutgoingRow(clientId, tempId);
+  if (!row) return false;
+  row.replaceWith(createMsgRow(m));
+  return true;
+}
+function markFailed(row, error) {
+  row.classList.remove('pending');
+  row.classList.add('failed');
+  row.title = error ? `Not sent: ${error}` : 'Not sent';
+}
+
 function scrollBottom(instant = false) {
   setTimeout(() => {
     messagesWrap.scrollTo({ top: messagesWrap.scrollHeight, behavior: instant ? 'auto' : 'smooth' });
@@ -565,6 +775,12 @@ function showContextMenu(e, m, row) {
   s.contextMenuEl = menu;
   s.contextMsgId = m.msg_id;
 
+  // not on telegram yet: it can only be retried or dropped
+  if (m.status === 'pending' || m.status === 'failed' || !(m.msg_id > 0)) {
+    openContextMenu(menu, outboxMenuItems(m, row), e, row);
+    return;
+  }
+
   // quick reactions row
   const reactRow = document.createElement('div');
   reactRow.className = 'ctx-reaction-row';
@@ -670,6 +886,41 @@ function showContextMenu(e, m, row) {
     }
   }
 
+  openContextMenu(menu, items, e, row);
+}
+
+function outboxMenuItems(m, row) {
+  const items = [
+    { label: '📋 Copy', icon: '', action: () => { if (m.text) { navigator.clipboard.writeText(m.text); toast('Copied'); } } },
+  ];
+  if (m.status === 'failed' && m.msg_id < 0) {
+    items.unshift({
+      label: '↻ Retry', icon: '', action: async () => {
+        await api('/api/outbox/retry', {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ client_id: m.client_id }),
+        });
+      }
+    });
+  }
+  items.push({
+    label: '🗑 Discard', icon: '', cls: 'danger', action: async () => {
+      // never reached the server: nothing to delete there
+      if (!(m.msg_id < 0)) { row.remove(); return; }
+      try {
+        await api('/api/messages', {
+          method: 'DELETE',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ user_id: s.currentUserId, msg_ids: [m.msg_id], for_everyone: false }),
+        });
+      } catch (e) { }
+    }
+  });
+  return items;
+}
+
+function openContextMenu(menu, items, e, row) {
   items.forEach(it => {
     const btn = document.createElement('button');
     btn.className = `ctx-item${it.cls ? ' ' + it.cls : ''}`;
@@ -790,6 +1041,8 @@ async function sendMessage() {
 
   if (!text && !hasFiles) return;
   if (!s.currentUserId) return;
+  // sending from an older window: go back to the live end first
+  if (s.hasAfter) await jumpToLatest();
 
   // If we have files, send them (with caption = text)
   if (hasFiles) {
@@ -805,24 +1058,38 @@ async function sendMessage() {
     return;
   }
 
-  // text only
+  // text only: show it right away, the server's pending / confirmed events take over the row
   msgInput.value = '';
   autoResize();
-  await api('/api/send', {
-    method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({
-      user_id: s.currentUserId,
-      text,
-      reply_to: s.replyTo,
-    }),
-  });
+  const clientId = newClientId();
+  const local = {
+    msg_id: `local-${clientId}`, client_id: clientId, status: 'pending',
+    direction: 'out', text, reply_to: s.replyTo, timestamp: new Date().toISOString(),
+  };
+  appendMessage(local);
+  scrollBottom();
   clearReply();
+  try {
+    await api('/api/send', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        user_id: s.currentUserId,
+        text,
+        reply_to: local.reply_to,
+        client_id: clientId,
+      }),
+    });
+  } catch (e) {
+    const row = findOutgoingRow(clientId);
+    if (row) markFailed(row, e.message);
+  }
 }
 
 async function sendFile(file, caption = '') {
   if (!s.currentUserId) return;
   const fd = new FormData();
+  fd.append('client_id', newClientId());
   fd.append('user_id', s.currentUserId);
   fd.append('reply_to', s.replyTo || '');
   fd.append('caption', caption);
@@ -911,26 +1178,56 @@ function copySelected() {
 
 function openForwardModal() {
   s.forwardTargets.clear();
-  forwardList.innerHTML = '';
-  s.users.forEach(u => {
-    if (u.user_id === s.currentUserId) return;
-    const div = document.createElement('div');
-    div.className = 'fwd-user';
-    div.innerHTML = `
-      <div class="fwd-avatar" style="background:${avatarColor(u.user_id)}">${avatarHtml(u.user_id, u.full_name)}</div>
-      <span class="fwd-name">${esc(u.full_name)}</span>`;
-    div.onclick = () => {
-      if (s.forwardTargets.has(u.user_id)) {
-        s.forwardTargets.delete(u.user_id);
-        div.classList.remove('chosen');
-      } else {
-        s.forwardTargets.add(u.user_id);
-        div.classList.add('chosen');
-      }
-    };
-    forwardList.appendChild(div);
-  });
+  s.forwardQuery = forwardSearch.value = '';
+  loadForwardTargets(true);
   forwardModal.classList.remove('hidden');
+  forwardSearch.focus();
+}
+
+// targets are paged and searched on the server like the chat list, so every chat is reachable
+async function loadForwardTargets(reset) {
+  if (!reset && (!s.forwardHasMore || s.forwardLoading)) return;
+  if (reset) {
+    forwardList.innerHTML = '';
+    s.forwardLoaded = 0;
+  }
+  s.forwardLoading = true;
+  const query = s.forwardQuery;
+  try {
+    const q = new URLSearchParams({ offset: s.forwardLoaded, sort: 'recent' });
+    if (query) q.set('q', query);
+    const page = await api(`/api/users?${q}`);
+    if (query !== s.forwardQuery) return; // a newer search is already on its way
+    s.forwardLoaded += page.users.length;
+    s.forwardHasMore = page.has_more;
+    page.users.forEach(u => {
+      if (String(u.user_id) === String(s.currentUserId)) return;
+      if (forwardList.querySelector(`.fwd-user[data-uid="${u.user_id}"]`)) return;
+      forwardList.appendChild(renderForwardTarget(u));
+    });
+  } finally {
+    s.forwardLoading = false;
+  }
+}
+
+function renderForwardTarget(u) {
+  const div = document.createElement('div');
+  div.className = 'fwd-user';
+  div.dataset.uid = String(u.user_id);
+  div.classList.toggle('chosen', s.forwardTargets.has(u.user_id));
+  div.innerHTML = `
+    <div class="fwd-avatar" style="background:${avatarColor(u.user_id)}">${avatarHtml(u.user_id, u.full_name)}</div>
+    <span class="fwd-name">${esc(u.full_name)}</span>`;
+  div.onclick = () => {
+    if (s.forwardTargets.has(u.user_id)) {
+      s.forwardTargets.delete(u.user_id);
+      div.classList.remove('chosen');
+    } else {
+      s.forwardTargets.add(u.user_id);
+      div.classList.add('chosen');
+    }
+  };
+  return div;
 }
 
 async function confirmForward() {
@@ -956,7 +1253,7 @@ async function clearUnread(uid) {
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ user_id: uid }),
   });
-  refreshUsers();
+  // the server answers with a chat_updated delta
 }
 
 // media viewer
@@ -1260,6 +1557,19 @@ function init() {
   // forward modal
   $('forwardClose').onclick = () => forwardModal.classList.add('hidden');
   $('forwardConfirm').onclick = confirmForward;
+  // chosen chats stay chosen while searching for more
+  let forwardTimer = null;
+  forwardSearch.oninput = () => {
+    clearTimeout(forwardTimer);
+    forwardTimer = setTimeout(() => {
+      s.forwardQuery = forwardSearch.value.trim();
+      forwardList.scrollTop = 0;
+      loadForwardTargets(true);
+    }, 250);
+  };
+  forwardList.addEventListener('scroll', () => {
+    if (forwardList.scrollTop + forwardList.clientHeight >= forwardList.scrollHeight - 200) loadForwardTargets(false);
+  }, { passive: true });
 
   // edit modals
   $('editHistoryClose').onclick = () => editHistoryModal.classList.add('hidden');
@@ -1318,7 +1628,6 @@ function init() {
           items.push({
             label: '✅ Unblock User', action: async () => {
               await api('/api/unblock', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ user_id: s.currentUserId }) });
-              refreshUsers();
             }
           });
         } else {
@@ -1326,7 +1635,6 @@ function init() {
             label: '⛔ Block User', textCls: 'danger', action: async () => {
               if (!(await customConfirm('Block this user? You will not receive their messages.'))) return;
               await api('/api/block', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ user_id: s.currentUserId }) });
-              refreshUsers();
             }
           });
         }
@@ -1362,15 +1670,42 @@ function init() {
   // load older
   loadMoreBtn.onclick = () => loadMessages(true);
 
-  // scroll detection for load more
+  // scroll detection for load more (and, after a jump, load newer)
   messagesWrap.addEventListener('scroll', () => {
     if (messagesWrap.scrollTop < 60 && s.hasMore && !s.loading) {
       loadMessages(true);
     }
+    const fromBottom = messagesWrap.scrollHeight - messagesWrap.scrollTop - messagesWrap.clientHeight;
+    if (fromBottom < 60 && s.hasAfter && !s.loading) {
+      loadNewer();
+    }
   });
 
-  // search
-  searchInput.oninput = () => renderUserList(s.users);
+  // jump to latest / to a date
+  jumpLatestBtn.onclick = () => jumpToLatest();
+  $('jumpDateBtn').onclick = () => {
+    if (jumpDateInput.showPicker) jumpDateInput.showPicker();
+    else jumpDateInput.click();
+  };
+  jumpDateInput.onchange = () => {
+    if (jumpDateInput.value) jumpTo({ at: jumpDateInput.value });
+  };
+
+  // search (server side, debounced)
+  let searchTimer = null;
+  searchInput.oninput = () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+      s.usersQuery = searchInput.value.trim();
+      chatList.scrollTop = 0;
+      refreshUsers();
+    }, 250);
+  };
+
+  // next page of chats when the list is scrolled near its end
+  chatList.addEventListener('scroll', () => {
+    if (chatList.scrollTop + chatList.clientHeight >= chatList.scrollHeight - 200) loadMoreUsers();
+  }, { passive: true });
 
   // back (mobile)
   backBtn.onclick = () => {
@@ -1378,6 +1713,7 @@ function init() {
     activeChat.classList.add('hidden');
     noChat.classList.remove('hidden');
     s.currentUserId = null;
+    subscribeWS();
   };
 
   // close context menu on click outside